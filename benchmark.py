@@ -0,0 +1,303 @@
+"""Measures how long each handler takes to answer, over a fixed corpus of recorded game states.
+
+The corpus is made once by playing simulator games and keeping a sample of the queries asked
+in them. It is a gzipped file of JSON lines: each game's recording is written once, followed by
+its sampled queries, each with the territories and players as they were when it was asked and
+the length of the recording so far. Running the benchmark shows every sample to the handlers
+again with a bot state brought up to date on that game, and reports latencies by query, game
+phase and number of players. A run can be saved as a baseline, and later runs are compared
+against it, exiting with an error when anything got slower.
+
+    python benchmark.py record --games 10 --players 2 3 4 5 6
+    python benchmark.py run --save-baseline
+    python benchmark.py run --memory
+
+The handlers are timed without their lookahead search unless --search-budget says otherwise, as
+the search carries on until its budget runs out and would make every searched query take the same
+time however slow the handler around it got.
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+import my_submission
+import simulator
+from risk_shared.models.card_model import CardModel
+from risk_shared.records.moves.move_attack import MoveAttack
+from risk_shared.records.moves.move_attack_pass import MoveAttackPass
+from risk_shared.records.moves.move_claim_territory import MoveClaimTerritory
+from risk_shared.records.moves.move_defend import MoveDefend
+from risk_shared.records.moves.move_distribute_troops import MoveDistributeTroops
+from risk_shared.records.moves.move_fortify import MoveFortify
+from risk_shared.records.moves.move_fortify_pass import MoveFortifyPass
+from risk_shared.records.moves.move_place_initial_troop import MovePlaceInitialTroop
+from risk_shared.records.moves.move_redeem_cards import MoveRedeemCards
+from risk_shared.records.moves.move_troops_after_attack import MoveTroopsAfterAttack
+from risk_shared.records.record_attack import RecordAttack
+
+CORPUS_PATH = "benchmark_corpus.jsonl.gz"
+BASELINE_PATH = "benchmark_baseline.json"
+
+QUERIES = {query.__name__: query for query in [
+    simulator.QueryClaimTerritory, simulator.QueryPlaceInitialTroop, simulator.QueryRedeemCards, simulator.QueryDistributeTroops,
+    simulator.QueryAttack, simulator.QueryTroopsAfterAttack, simulator.QueryDefend, simulator.QueryFortify,
+]}
+RECORDS = {record.__name__: record for record in [
+    MoveAttack, MoveAttackPass, MoveClaimTerritory, MoveDefend, MoveDistributeTroops, MoveFortify,
+    MoveFortifyPass, MovePlaceInitialTroop, MoveRedeemCards, MoveTroopsAfterAttack, RecordAttack,
+]}
+
+# Turn numbers at which a game counts as being in its middle and late phases
+MID_GAME_TURN = 8
+LATE_GAME_TURN = 25
+
+
+# Records are written as their type and fields. JSON only has string keys, so dictionaries
+# (the troops in a distribution) are written as an object holding a list of pairs.
+def encode_record(record) -> list:
+    return [type(record).__name__, {name: {"items": list(value.items())} if isinstance(value, dict) else value for name, value in vars(record).items()}]
+
+
+def decode_record(encoded: list):
+    kind, fields = encoded
+    return RECORDS[kind](**{name: dict(value["items"]) if isinstance(value, dict) else value for name, value in fields.items()})
+
+
+def phase_of(match: simulator.Match, query) -> str:
+    if isinstance(query, (simulator.QueryClaimTerritory, simulator.QueryPlaceInitialTroop)):
+        return "setup"
+    if match.turns < MID_GAME_TURN:
+        return "early"
+    return "mid" if match.turns < LATE_GAME_TURN else "late"
+
+
+def snapshot(match: simulator.Match, player: int, query) -> dict:
+    return {
+        "query": [type(query).__name__, vars(query)],
+        "me": player,
+        "phase": phase_of(match, query),
+        "territories": [[match.territories[territory].occupier, match.territories[territory].troops] for territory in sorted(match.territories)],
+        "players": [[other.troops_remaining, other.alive, [[card.card_id, card.territory_id, card.symbol] for card in other.cards], other.must_place_territory_bonus]
+                    for _, other in sorted(match.players.items())],
+        "card_sets_redeemed": match.card_sets_redeemed,
+        "recording_length": len(match.recording),
+    }
+
+
+class SamplingBot(simulator.SubmissionBot):
+    """Answers like the submission, first keeping a snapshot of a sample of the queries it is asked."""
+
+    def __init__(self, bot_state: my_submission.BotState, samples: list, rng: random.Random, fraction: float):
+        super().__init__(bot_state)
+        self.match: simulator.Match
+        self.samples = samples
+        self.rng = rng
+        self.fraction = fraction
+
+    def __call__(self, game: simulator.SimGame, query):
+        if self.rng.random() < self.fraction:
+            self.samples.append(snapshot(self.match, game._player_id, query))
+        return super().__call__(game, query)
+
+
+def record(args: argparse.Namespace):
+    lines = []
+    for players in args.players:
+        for game in range(args.games):
+            seed = args.seed + game
+            rng = random.Random(seed*len(simulator.STARTING_TROOPS) + players)
+            samples: list[dict] = []
+            bots = []
+            for player in range(players):
+                bot_state = my_submission.BotState()
+                bot_state.search_budget = args.search_budget
+                bot_state.rng.seed(seed*players + player)
+                bots.append(SamplingBot(bot_state, samples, rng, args.sample))
+            match = simulator.Match(bots, seed=seed, max_turns=args.max_turns)
+            for bot in bots:
+                bot.match = match
+            match.play()
+            lines.append({"players": players, "seed": seed, "recording": [encode_record(record) for record in match.recording]})
+            lines += samples
+            print(f"{players} players, seed {seed}: {len(samples)} samples from {len(match.recording)} records", flush=True)
+
+    with gzip.open(args.corpus, "wt") as file:
+        for line in lines:
+            file.write(json.dumps(line, separators=(",", ":")) + "\n")
+
+
+class FrozenMatch():
+    """Just enough of a Match for a SimGame to show a snapshot to the handlers."""
+
+    def __init__(self, sample: dict, recording: list):
+        self.map = simulator.SimMap(simulator.CLASSIC_EDGES, simulator.CLASSIC_CONTINENTS, simulator.CLASSIC_CONTINENT_BONUSES)
+        self.territories = {territory: simulator.SimTerritory(territory, occupier, troops) for territory, (occupier, troops) in enumerate(sample["territories"])}
+        self.players = {player: simulator.SimPlayer(player, troops_remaining, alive, [CardModel(card_id=card_id, territory_id=territory_id, symbol=symbol) for card_id, territory_id, symbol in cards], must_place)
+                        for player, (troops_remaining, alive, cards, must_place) in enumerate(sample["players"])}
+        self.card_sets_redeemed = sample["card_sets_redeemed"]
+        self.recording = recording[:sample["recording_length"]]
+
+
+# Each sample comes back with the recording of its game and a label for the group it is reported in
+def load_corpus(path: str) -> list[tuple[dict, list, str]]:
+    samples = []
+    with gzip.open(path, "rt") as file:
+        for line in file:
+            entry = json.loads(line)
+            if "recording" in entry:
+                players = entry["players"]
+                recording = [decode_record(encoded) for encoded in entry["recording"]]
+            else:
+                samples.append((entry, recording, f"{entry['query'][0]}/{entry['phase']}/{players}p"))
+    return samples
+
+
+# A handler in a real game finds the tracker and opponent model already up to date with the
+# recording, so they are brought up to date here before the clock is started
+def prepared(sample: dict, recording: list, search_budget: float) -> tuple[simulator.SubmissionBot, simulator.SimGame, object]:
+    game = simulator.SimGame(FrozenMatch(sample, recording), sample["me"])  # type: ignore[arg-type]
+    bot_state = my_submission.BotState()
+    bot_state.search_budget = search_budget
+    bot_state.rng.seed(0)
+    my_submission.get_tracker(game, bot_state)
+    my_submission.get_opponent_model(game, bot_state)
+    kind, fields = sample["query"]
+    return simulator.SubmissionBot(bot_state), game, QUERIES[kind](**fields)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*fraction))]
+
+
+def measure(samples: list[tuple[dict, list, str]], repeat: int, search_budget: float, memory: bool) -> dict[str, dict]:
+    times: dict[str, list[float]] = defaultdict(list)
+    peaks: dict[str, list[int]] = defaultdict(list)
+    blocks: dict[str, list[int]] = defaultdict(list)
+    for sample, recording, group in samples:
+        handler = sample["query"][0]
+        for _ in range(repeat):
+            bot, game, query = prepared(sample, recording, search_budget)
+            start = time.perf_counter()
+            bot(game, query)
+            elapsed = time.perf_counter() - start
+            times[group].append(elapsed)
+            times[handler].append(elapsed)
+
+        # Tracing slows everything down, so memory is measured on a separate call
+        if memory:
+            bot, game, query = prepared(sample, recording, search_budget)
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            bot(game, query)
+            after = tracemalloc.take_snapshot()
+            peaks[handler].append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            blocks[handler].append(sum(stat.count_diff for stat in after.compare_to(before, "filename")))
+
+    results = {}
+    for group, values in sorted(times.items()):
+        results[group] = {"count": len(values), "p50": percentile(values, 0.5), "p99": percentile(values, 0.99), "max": max(values)}
+        if group in peaks:
+            results[group]["peak_bytes"] = percentile(peaks[group], 0.5)
+            results[group]["max_peak_bytes"] = max(peaks[group])
+            results[group]["blocks_kept"] = percentile(blocks[group], 0.5)
+    return results
+
+
+def report(results: dict[str, dict]):
+    print(f"{'group':<48}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for group, result in results.items():
+        print(f"{group:<48}{result['count']:>7}{result['p50']*1000:>10.3f}{result['p99']*1000:>10.3f}{result['max']*1000:>10.3f}")
+
+    measured = {group: result for group, result in results.items() if "peak_bytes" in result}
+    if measured:
+        print(f"\n{'handler':<48}{'peak KiB':>10}{'max KiB':>10}{'blocks kept':>13}")
+        for group, result in measured.items():
+            print(f"{group:<48}{result['peak_bytes']/1024:>10.1f}{result['max_peak_bytes']/1024:>10.1f}{result['blocks_kept']:>13}")
+
+
+def regressions(results: dict[str, dict], baseline: dict[str, dict], tolerance: float, slack: float) -> list[str]:
+    found = []
+    for group, result in results.items():
+        before = baseline.get(group)
+        if before is None:
+            continue
+        for statistic in ["p50", "p99"]:
+            if result[statistic] > before[statistic]*tolerance + slack:
+                found.append(f"{group} {statistic}: {before[statistic]*1000:.3f} ms -> {result[statistic]*1000:.3f} ms")
+        if "peak_bytes" in result and "peak_bytes" in before and result["peak_bytes"] > before["peak_bytes"]*tolerance:
+            found.append(f"{group} peak memory: {before['peak_bytes']/1024:.1f} KiB -> {result['peak_bytes']/1024:.1f} KiB")
+    return found
+
+
+def run(args: argparse.Namespace) -> int:
+    samples = load_corpus(args.corpus)
+    if args.only:
+        samples = [(sample, recording, group) for sample, recording, group in samples if sample["query"][0] in args.only]
+
+    # The odds table is built once per process in a real game, so it is left out of the timings
+    my_submission.get_battle_odds()
+    results = measure(samples, args.repeat, args.search_budget, args.memory)
+    report(results)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=1)
+        print(f"\nsaved baseline to {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        return 0
+    found = regressions(results, baseline, args.tolerance, args.slack/1000)
+    print()
+    for regression in found:
+        print(f"regression: {regression}")
+    print(f"{len(found)} regressions against {args.baseline}")
+    return 1 if found else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="play games and keep a sample of their queries")
+    record_parser.add_argument("--games", type=int, default=10, help="games for each number of players")
+    record_parser.add_argument("--players", type=int, nargs="+", default=[2, 3, 4, 5, 6])
+    record_parser.add_argument("--seed", type=int, default=0)
+    record_parser.add_argument("--sample", type=float, default=0.02, help="fraction of queries kept")
+    record_parser.add_argument("--max-turns", type=int, default=400)
+    record_parser.add_argument("--search-budget", type=float, default=0.0, help="seconds of search per query while playing the games")
+
+    run_parser = commands.add_parser("run", help="time the handlers on the sampled queries")
+    run_parser.add_argument("--repeat", type=int, default=3, help="timed calls per sample")
+    run_parser.add_argument("--search-budget", type=float, default=0.0, help="seconds of search per query, left at 0 by default as the search fills whatever it is given and would hide the cost of the handlers")
+    run_parser.add_argument("--only", nargs="+", choices=sorted(QUERIES), help="only time these queries")
+    run_parser.add_argument("--memory", action="store_true", help="also measure memory with tracemalloc")
+    run_parser.add_argument("--baseline", default=BASELINE_PATH)
+    run_parser.add_argument("--save-baseline", action="store_true")
+    run_parser.add_argument("--tolerance", type=float, default=1.25, help="ratio to the baseline counted as a regression")
+    run_parser.add_argument("--slack", type=float, default=0.5, help="milliseconds allowed on top of the ratio, since short timings are noisy")
+
+    for command in [record_parser, run_parser]:
+        command.add_argument("--corpus", default=CORPUS_PATH)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args)
+    else:
+        sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Builds the opening book that my_submission.py answers claims and initial placements from.
+
+Openings are played in the simulator for each number of players, answering every claim and
+initial troop query with the handlers as usual and noting the position hash and the answer
+given. So the book covers more than the one opening the bots play against themselves, a
+fraction of the moves actually made are random. Games stop once the opening is over. Positions
+seen at least --min-count times are written to the book, the most common first up to --limit.
+
+    python build_opening_book.py --games 2000 --workers 16
+
+The book only matches the map, parameters and my_submission.py it was built with, so it needs
+building again after any of them change.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+
+import my_submission
+import simulator
+from my_submission import territories_in
+
+
+class OpeningOver(Exception):
+    pass
+
+
+class OpeningBot(simulator.SubmissionBot):
+    """Answers opening queries like the submission, noting each position and answer, and stops the
+    game at the first query after the opening."""
+
+    def __init__(self, rng: random.Random, explore: float, seen: list[tuple[int, int]]):
+        super().__init__()
+        self.rng = rng
+        self.explore = explore
+        self.seen = seen
+
+    def __call__(self, game: simulator.SimGame, query):
+        if not isinstance(query, (simulator.QueryClaimTerritory, simulator.QueryPlaceInitialTroop)):
+            raise OpeningOver()
+        move = super().__call__(game, query)
+        tracker = self.bot_state.tracker
+        assert tracker is not None
+        if max(tracker.troops) < my_submission.ZOBRIST_TROOPS - 1:
+            self.seen.append((tracker.position_hash, move.territory))
+
+        if self.rng.random() < self.explore:
+            if isinstance(query, simulator.QueryClaimTerritory):
+                return game.move_claim_territory(query, self.rng.choice(territories_in(tracker.unclaimed_mask)))
+            return game.move_place_initial_troop(query, self.rng.choice(territories_in(tracker.my_mask)))
+        return move
+
+
+def play_opening(seed: int, players: int, explore: float) -> list[tuple[int, int]]:
+    seen: list[tuple[int, int]] = []
+    rng = random.Random(seed*len(simulator.STARTING_TROOPS) + players)
+    try:
+        simulator.Match([OpeningBot(rng, explore, seen) for _ in range(players)], seed=seed).play()
+    except OpeningOver:
+        pass
+    return seen
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=500, help="openings for each number of players")
+    parser.add_argument("--players", type=int, nargs="+", default=[2, 3, 4, 5, 6])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--explore", type=float, default=0.1, help="fraction of moves made at random")
+    parser.add_argument("--min-count", type=int, default=2, help="times a position must be seen to go in the book")
+    parser.add_argument("--limit", type=int, default=200000, help="most positions in the book")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default=my_submission.OPENING_BOOK_PATH)
+    args = parser.parse_args()
+
+    tasks = [(args.seed + game, players, args.explore) for players in args.players for game in range(args.games)]
+    if args.workers > 1:
+        with Pool(args.workers) as pool:
+            openings = pool.starmap(play_opening, tasks)
+    else:
+        openings = [play_opening(*task) for task in tasks]
+
+    # Every answer for a position should be the same, but the most common is kept to be safe
+    answers: defaultdict[int, Counter[int]] = defaultdict(Counter)
+    for seen in openings:
+        for position_hash, territory in seen:
+            answers[position_hash][territory] += 1
+    counts = {position_hash: sum(counter.values()) for position_hash, counter in answers.items()}
+    kept = sorted((position_hash for position_hash in counts if counts[position_hash] >= args.min_count), key=lambda position_hash: -counts[position_hash])[:args.limit]
+    book = {position_hash: answers[position_hash].most_common(1)[0][0] for position_hash in kept}
+
+    game = simulator.Match([simulator.SubmissionBot()]).games[0]
+    fingerprint = my_submission.opening_book_fingerprint(my_submission.MapIndex(game), my_submission.load_parameters())
+    my_submission.OpeningBook.write(args.output, fingerprint, book)
+
+    queries = sum(counts.values())
+    covered = sum(counts[position_hash] for position_hash in kept)
+    print(f"{len(answers)} positions in {queries} queries, {len(book)} kept covering {covered/max(1, queries):.1%} of the queries")
+    print(f"wrote {args.output} ({os.path.getsize(args.output)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Hosts many games at once in one process for evaluation runs, each game on its own thread.
+
+Every seat still has its own BotState, but the map index, battle odds table and opening book are
+built once per process and shared by all of its games (see my_submission.get_map_index), so a
+game only costs its own state. Searches are timed on each thread's CPU time rather than the wall
+clock, so a search gets as much done as it would alone however many games are being played. Only
+one thread runs Python at a time, so throughput comes from running several processes, each
+hosting its share of the games.
+
+    python evaluation_server.py --games 200 --players 5 --threads 16 --processes 4
+    python evaluation_server.py --serve < jobs.jsonl > results.jsonl
+
+With --serve each line on standard input is a JSON object describing a game, with any of id,
+seed, players, max_turns, search_budget and parameters (coefficients by seat), the rest coming
+from the command line. A line with the result is written for each game as soon as it finishes.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import Pool
+
+import my_submission
+import simulator
+
+
+def play_job(job: dict) -> simulator.MatchResult:
+    parameters = job.get("parameters")
+    if parameters is not None:
+        parameters = {int(seat): coefficients for seat, coefficients in parameters.items()}
+    return simulator.play_match(job["seed"], job["players"], job["max_turns"], job["search_budget"], parameters, None, time.thread_time)
+
+
+def result_line(job: dict, result: simulator.MatchResult) -> dict:
+    return {"id": job.get("id"), "seed": result.seed, "winner": result.winner, "turns": result.turns, "territories": result.territories, "eliminated_order": result.eliminated_order}
+
+
+class EvaluationServer():
+    """Plays the games it is given on a pool of threads in this process."""
+
+    def __init__(self, threads: int):
+        # Everything shared is built before the first game starts, so no game waits on the others for it
+        my_submission.get_battle_odds()
+        bot_state = my_submission.BotState()
+        game = simulator.Match([simulator.SubmissionBot(bot_state)]).games[0]
+        my_submission.get_opening_book(game, bot_state)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="game")
+
+    def submit(self, job: dict) -> Future[simulator.MatchResult]:
+        return self.executor.submit(play_job, job)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self) -> EvaluationServer:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# One process's share of a batch, with the most memory the process used
+def host(jobs: list[dict], threads: int) -> tuple[list[simulator.MatchResult], int]:
+    with EvaluationServer(threads) as server:
+        futures = [server.submit(job) for job in jobs]
+        results = [future.result() for future in futures]
+    return results, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def batch(args: argparse.Namespace, defaults: dict):
+    jobs = [dict(defaults, seed=seed) for seed in range(args.seed, args.seed + args.games)]
+    shares = [jobs[i::args.processes] for i in range(args.processes)]
+    start = time.perf_counter()
+    if args.processes > 1:
+        with Pool(args.processes) as pool:
+            hosted = pool.starmap(host, [(share, args.threads) for share in shares])
+    else:
+        hosted = [host(jobs, args.threads)]
+    elapsed = time.perf_counter() - start
+
+    simulator.summarise([result for results, _ in hosted for result in results])
+    peak = max(peak_kib for _, peak_kib in hosted)
+    print(f"{args.games} games in {elapsed:.1f} s ({args.games/elapsed:.2f} games/s) on {args.processes} processes of {args.threads} threads, peak {peak/1024:.1f} MiB per process")
+
+
+def serve(args: argparse.Namespace, defaults: dict):
+    lock = threading.Lock()
+
+    def write(job: dict, future: Future):
+        try:
+            line = result_line(job, future.result())
+        except Exception as error:
+            line = {"id": job.get("id"), "error": repr(error)}
+        with lock:
+            sys.stdout.write(json.dumps(line, separators=(",", ":")) + "\n")
+            sys.stdout.flush()
+
+    with EvaluationServer(args.threads) as server:
+        for text in sys.stdin:
+            if not text.strip():
+                continue
+            job = dict(defaults, **json.loads(text))
+            server.submit(job).add_done_callback(lambda future, job=job: write(job, future))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--players", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-turns", type=int, default=400)
+    parser.add_argument("--search-budget", type=float, default=my_submission.SEARCH_TIME_BUDGET, help="seconds of search (thread CPU time) per query, 0 to turn it off")
+    parser.add_argument("--threads", type=int, default=8, help="games played at once in each process")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--serve", action="store_true", help="play the games described on standard input instead")
+    args = parser.parse_args()
+
+    defaults = {"seed": args.seed, "players": args.players, "max_turns": args.max_turns, "search_budget": args.search_budget}
+    if args.serve:
+        serve(args, defaults)
+    else:
+        batch(args, defaults)
+
+
+if __name__ == "__main__":
+    main()
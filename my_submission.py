@@ -1,6 +1,6 @@
-from collections import defaultdict, deque
+from collections import defaultdict
 import random
-from typing import Optional, Tuple, Union, cast
+from typing import Callable, Optional, Sequence, Union, cast
 from risk_helper.game import Game
 from risk_shared.models.card_model import CardModel
 from risk_shared.queries.query_attack import QueryAttack
@@ -26,14 +26,1960 @@ from risk_shared.records.record_attack import RecordAttack
 from risk_shared.records.types.move_type import MoveType
 import time
 import math
+import heapq
+import os
+import struct
+from array import array
+from functools import lru_cache
+from itertools import combinations, combinations_with_replacement, product
+import atexit
+import json
+import signal
+import sys
+import hashlib
+import mmap
+from bisect import bisect_left
+import copy
+import threading
+from types import SimpleNamespace
+import zlib
+
+
+# Profiling is off unless RISK_PROFILE names a file to write the summary to. When it is off, the
+# instrumented decorator hands back the function untouched, so there is no cost at all.
+PROFILE_PATH = os.environ.get("RISK_PROFILE")
+
+# Histogram buckets are a quarter of a doubling wide, starting from a microsecond.
+PROFILE_BUCKETS = 112
+
+
+class Profiler():
+    """Call counts, total and maximum wall time, and a log scale histogram of wall times, for each
+    instrumented name."""
+
+    def __init__(self):
+        self.stats: dict[str, dict] = {}
+
+    def record(self, name: str, seconds: float):
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = self.stats[name] = {"calls": 0, "total": 0.0, "max": 0.0, "buckets": [0]*PROFILE_BUCKETS}
+        stat["calls"] += 1
+        stat["total"] += seconds
+        if seconds > stat["max"]:
+            stat["max"] = seconds
+        bucket = int(math.log2(seconds*1e6)*4) + 1 if seconds >= 1e-6 else 0
+        stat["buckets"][min(bucket, PROFILE_BUCKETS - 1)] += 1
+
+    def merge(self, stats: dict[str, dict]):
+        for name, other in stats.items():
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = {"calls": 0, "total": 0.0, "max": 0.0, "buckets": [0]*PROFILE_BUCKETS}
+            stat["calls"] += other["calls"]
+            stat["total"] += other["total"]
+            stat["max"] = max(stat["max"], other["max"])
+            stat["buckets"] = [a + b for a, b in zip(stat["buckets"], other["buckets"])]
+
+    # The upper edge of the bucket holding the given fraction of calls, capped at the true maximum
+    @staticmethod
+    def percentile(stat: dict, fraction: float) -> float:
+        needed = fraction*stat["calls"]
+        seen = 0
+        for bucket, count in enumerate(stat["buckets"]):
+            seen += count
+            if seen >= needed and count > 0:
+                return min(stat["max"], 2**(bucket/4)/1e6)
+        return stat["max"]
+
+    def summary(self) -> str:
+        lines = [f"{'name':<56}{'calls':>10}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for name, stat in sorted(self.stats.items(), key=lambda item: item[1]["total"], reverse=True):
+            lines.append(f"{name:<56}{stat['calls']:>10}{stat['total']:>10.3f}{stat['total']/stat['calls']*1000:>10.3f}"
+                         f"{self.percentile(stat, 0.5)*1000:>10.3f}{self.percentile(stat, 0.99)*1000:>10.3f}{stat['max']*1000:>10.3f}")
+        return "\n".join(lines)
+
+    def dump(self, path: str):
+        with open(path, "w") as file:
+            json.dump(self.stats, file)
+        with open(path + ".txt", "w") as file:
+            file.write(self.summary() + "\n")
+
+
+PROFILER: Optional[Profiler] = Profiler() if PROFILE_PATH else None
+
+
+def instrumented(name: str) -> Callable[[Callable], Callable]:
+    def decorate(function: Callable) -> Callable:
+        if PROFILER is None:
+            return function
+        record = PROFILER.record
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, clock() - start)
+        return timed
+    return decorate
+
+
+# Every coefficient the handlers weigh things by, named "<handler>.<coefficient>", so they can be
+# tuned together as one vector (see tune.py). Tuned values can be dropped into parameters.json
+# next to this file, which overrides these.
+DEFAULT_PARAMETERS: dict[str, Union[float, list[float]]] = {
+    "claim.adjacent": 2,
+    "claim.same_continent": 6,
+    "claim.swap_continent": 0.05,
+    "claim.break_continent": 2,
+    "claim.guarding": 0.6,
+    "claim.enclose_territory": 5,
+    "claim.favouring": 1,
+    "claim.continent_weightings": [0.7, 0.5, 0.5, 0.8, 0.8, 0.7],
+    "place.same_continent": 9,
+    "place.enemies_close": 1,
+    "place.adjacency": 1,
+    "place.blobiness": 1,
+    "distribute.same_continent": 7,
+    "distribute.same_continent2": 4,
+    "distribute.adjacency": 1,
+    "distribute.blobiness": 2,
+    "distribute.troopiness": 0.1,
+    "distribute.defence": 10,
+    "distribute.offence": 10,
+    "attack.same_continent": 4,
+    "attack.chokehold": 1.5,
+    "attack.staychoke": 0.5,
+    "attack.cardwant": 2,
+    "attack.adjacencybonus": 0.1,
+    "attack.borderincrease": 0.5,
+    "attack.keep_border_safe": 0,
+    "attack.threshold": 2.5,
+    "attack.weak_continent": 3.5,
+    "attack.min_win_chance": 0.3,
+    "attack.sweep_bonus": 3,
+    "attack.replan_tolerance": 0.2,
+    "attack.garrison_aggression": 1,
+}
+PARAMETERS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parameters.json")
+
+
+# The parameters flattened into a list of floats, in DEFAULT_PARAMETERS order
+def parameter_vector(parameters: dict[str, Union[float, list[float]]]) -> list[float]:
+    vector = []
+    for name, default in DEFAULT_PARAMETERS.items():
+        value = parameters.get(name, default)
+        vector.extend(value if isinstance(value, list) else [value])
+    return vector
+
+
+def parameters_from_vector(vector: list[float]) -> dict[str, Union[float, list[float]]]:
+    parameters: dict[str, Union[float, list[float]]] = {}
+    position = 0
+    for name, default in DEFAULT_PARAMETERS.items():
+        if isinstance(default, list):
+            parameters[name] = list(vector[position:position + len(default)])
+            position += len(default)
+        else:
+            parameters[name] = vector[position]
+            position += 1
+    return parameters
+
+
+def load_parameters(path: str = PARAMETERS_PATH) -> dict[str, Union[float, list[float]]]:
+    parameters = dict(DEFAULT_PARAMETERS)
+    try:
+        with open(path) as file:
+            parameters.update({name: value for name, value in json.load(file).items() if name in DEFAULT_PARAMETERS})
+    except (OSError, ValueError):
+        pass
+    return parameters
+
+
 # We will store our enemy in the bot state.
 class BotState():
     def __init__(self):
         self.enemy: Optional[int] = None
+        self.map_index: Optional[MapIndex] = None
+        self.tracker: Optional[StateTracker] = None
+        self.attack_plan: Optional[AttackPlan] = None
+        self.owned_distances: Optional[OwnedDistances] = None
+        self.threat_map: Optional[ThreatMap] = None
+        self.threat_map_seen = 0
+        self.opponent_model: Optional[OpponentModel] = None
+        self.opening_book: Optional[OpeningBook] = None
+        self.value_model: Optional[ValueModel] = get_value_model()
+        self.transpositions = TranspositionCache()
+        self.speculations: dict[tuple, tuple[str, tuple, BotState]] = {}
+        self.stop: Optional[threading.Event] = None
+        self.search_budget = SEARCH_TIME_BUDGET
+        # Searches are timed on this clock. Games hosted side by side in threads use each thread's
+        # CPU time, so a search gets the same work done however many games share the interpreter.
+        self.clock: Callable[[], float] = time.monotonic
+        self.query_started: Optional[float] = None
+        self.rng = random.Random()
+        self.parameters = load_parameters()
+
+
+# Sets of territories are stored as Python ints, with bit i set when territory i is in the set.
+def mask_of(territories: list[int]) -> int:
+    mask = 0
+    for territory in territories:
+        mask |= 1 << territory
+    return mask
+
+
+def territories_in(mask: int) -> list[int]:
+    territories = []
+    while mask:
+        lowest = mask & -mask
+        territories.append(lowest.bit_length() - 1)
+        mask ^= lowest
+    return territories
+
+
+UNREACHABLE = 255
+
+# Positions are hashed Zobrist style, with a random 64-bit key for each territory and owner and
+# each territory and troop count, so a position's hash is the xor of its territories' keys and
+# can be updated as they change. Owners are numbered relative to us (0 for unclaimed, 1 for us,
+# then the other players in seat order after us) so a position hashes the same from any seat.
+# Troop counts from ZOBRIST_TROOPS - 1 up all share a key.
+ZOBRIST_SEED = 0x5EED
+ZOBRIST_OWNERS = 8
+ZOBRIST_TROOPS = 64
+
+# Cached scores are keyed by hashes that put troop counts into buckets about a quarter of a
+# doubling wide (small counts keep their own), so a few troops more or less in a big army still hit.
+# The buckets carry on past ZOBRIST_TROOPS, so big armies of different sizes are still told apart.
+TROOP_BUCKET = bytes(troops if troops < 6 else 6 + int(4*math.log2(troops/6)) for troops in range(256))
+
+
+def troop_bucket(troops: int) -> int:
+    if troops < len(TROOP_BUCKET):
+        return TROOP_BUCKET[troops]
+    return min(ZOBRIST_TROOPS - 1, 6 + int(4*math.log2(troops/6)))
+
+
+class MapIndex():
+    """Everything about the map that never changes during a game, so the handlers can
+    answer adjacency and continent questions with a few bitwise operations."""
+
+    def __init__(self, game: Game):
+        continents = game.state.map.get_continents()
+        self.territories = sorted(game.state.territories)
+        size = max(self.territories) + 1
+
+        self.all_mask = mask_of(self.territories)
+        self.neighbours: list[list[int]] = [[] for _ in range(size)]
+        self.neighbour_mask = [0]*size
+        for territory in self.territories:
+            self.neighbours[territory] = list(game.state.map.get_adjacent_to(territory))
+            self.neighbour_mask[territory] = mask_of(self.neighbours[territory])
+
+        self.continent_of = [-1]*size
+        self.continent_mask = [0]*(max(continents) + 1)
+        self.continent_size = [0]*(max(continents) + 1)
+        self.continent_bonus = [0]*(max(continents) + 1)
+        bonuses = game.state.map.get_continent_bonuses()
+        for continent in continents:
+            self.continent_mask[continent] = mask_of(continents[continent])
+            self.continent_size[continent] = len(continents[continent])
+            self.continent_bonus[continent] = bonuses.get(continent, 0)
+            for territory in continents[continent]:
+                self.continent_of[territory] = continent
+
+        self.size = size
+
+        # Zobrist keys, flattened as [territory*ZOBRIST_OWNERS + owner] and [territory*ZOBRIST_TROOPS + troops]
+        rng = random.Random(ZOBRIST_SEED)
+        self.zobrist_owner = [rng.getrandbits(64) for _ in range(size*ZOBRIST_OWNERS)]
+        self.zobrist_troops = [rng.getrandbits(64) for _ in range(size*ZOBRIST_TROOPS)]
+        self.zobrist_move = [rng.getrandbits(64) for _ in range(size)]
+
+        # A territory's score in the handlers only looks at the territories within two hops of it
+        # and the rest of its continent. influence lists the territories whose scores look at each one.
+        self.influence: list[list[int]] = [[] for _ in range(size)]
+        for territory in self.territories:
+            region = self.neighbour_mask[territory] | (1 << territory)
+            region |= self.adjacent_mask(region)
+            if self.continent_of[territory] != -1:
+                region |= self.continent_mask[self.continent_of[territory]]
+            for other in territories_in(region):
+                self.influence[other].append(territory)
+
+    # All territories adjacent to at least one territory in the mask (possibly including some of them).
+    def adjacent_mask(self, mask: int) -> int:
+        adjacent = 0
+        while mask:
+            lowest = mask & -mask
+            adjacent |= self.neighbour_mask[lowest.bit_length() - 1]
+            mask ^= lowest
+        return adjacent
+
+    # The territories in the mask that are adjacent to a territory outside of it.
+    def border_mask(self, mask: int) -> int:
+        border = 0
+        remaining = mask
+        while remaining:
+            lowest = remaining & -remaining
+            if self.neighbour_mask[lowest.bit_length() - 1] & ~mask:
+                border |= lowest
+            remaining ^= lowest
+        return border
+
+    # Hops from each territory to the nearest one in sources, only passing through territories in the
+    # through mask (sources themselves are always 0). There is no all-pairs table, as every distance
+    # the handlers use is only allowed through part of the map (fortify moves through our own
+    # territories, the claim's distance to the enemy around them), which full-map distances can't give.
+    def distances_from(self, sources: int, through: int) -> bytearray:
+        distances = bytearray([UNREACHABLE])*self.size
+        frontier = sources
+        seen = sources
+        hops = 0
+        while frontier and hops < UNREACHABLE:
+            for territory in territories_in(frontier):
+                distances[territory] = hops
+            frontier = self.adjacent_mask(frontier) & through & ~seen
+            seen |= frontier
+            hops += 1
+        return distances
+
+    # Proportion of the territory's continent covered by the mask.
+    def continent_proportion(self, territory: int, mask: int) -> float:
+        continent = self.continent_of[territory]
+        if continent == -1:
+            return 0
+        return (self.continent_mask[continent] & mask).bit_count()/self.continent_size[continent]
+
+
+# Data that never changes once built is shared by every game in the process: map indexes by the
+# map they index, the battle odds and opening books by fingerprint. The lock is only taken while
+# a bot state first looks them up.
+map_indexes: dict[tuple, MapIndex] = {}
+shared_data_lock = threading.Lock()
+
+
+def map_key(game: Game) -> tuple:
+    territories = tuple((territory, tuple(sorted(game.state.map.get_adjacent_to(territory)))) for territory in sorted(game.state.territories))
+    continents = tuple(sorted((continent, tuple(sorted(members))) for continent, members in game.state.map.get_continents().items()))
+    return territories, continents
+
+
+def get_map_index(game: Game, bot_state: BotState) -> MapIndex:
+    if bot_state.map_index is None:
+        key = map_key(game)
+        with shared_data_lock:
+            if key not in map_indexes:
+                map_indexes[key] = MapIndex(game)
+            bot_state.map_index = map_indexes[key]
+    return bot_state.map_index
+
+
+class StateTracker():
+    """Who owns each territory and how many troops are on it, kept up to date by only looking
+    at the records added to game.state.recording since the last query."""
+
+    def __init__(self, game: Game, index: MapIndex):
+        self.index = index
+        self.me = game.state.me.player_id
+        self.player_count = len(game.state.players)
+        self.occupier: list[Optional[int]] = [None]*len(index.neighbour_mask)
+        self.troops = [0]*len(index.neighbour_mask)
+        self.owned_mask: defaultdict[Optional[int], int] = defaultdict(lambda: 0)
+        self.player_troops: defaultdict[Optional[int], int] = defaultdict(lambda: 0)
+        self.continent_owned: defaultdict[Optional[int], list[int]] = defaultdict(lambda: [0]*len(index.continent_mask))
+        self.border_mask = 0
+        self.component_parent = list(range(len(index.neighbour_mask)))
+        self.component_size = [1]*len(index.neighbour_mask)
+        self.components_stale = False
+        self.ownership_hash = 0
+        self.troop_hash = 0
+        self.region_hash = [0]*len(index.neighbour_mask)
+        self.recording_seen = 0
+        self.rebuild(game)
+
+    def rebuild(self, game: Game):
+        self.occupier = [None]*len(self.occupier)
+        self.troops = [0]*len(self.troops)
+        self.owned_mask.clear()
+        self.player_troops.clear()
+        self.continent_owned.clear()
+        self.owned_mask[None] = self.index.all_mask
+        self.continent_owned[None] = list(self.index.continent_size)
+        self.border_mask = 0
+        self.components_stale = True
+        self.ownership_hash = 0
+        self.troop_hash = 0
+        self.region_hash = [0]*len(self.region_hash)
+        for territory in self.index.territories:
+            self.ownership_hash ^= self.index.zobrist_owner[territory*ZOBRIST_OWNERS]
+            self.troop_hash ^= self.index.zobrist_troops[territory*ZOBRIST_TROOPS]
+            self.update_region_hashes(territory, self.index.zobrist_owner[territory*ZOBRIST_OWNERS] ^ self.index.zobrist_troops[territory*ZOBRIST_TROOPS])
+        for territory in self.index.territories:
+            self.set_territory(territory, game.state.territories[territory].occupier, game.state.territories[territory].troops)
+        self.recording_seen = len(game.state.recording)
+
+    @property
+    def my_mask(self) -> int:
+        return self.owned_mask[self.me]
+
+    @property
+    def unclaimed_mask(self) -> int:
+        return self.owned_mask[None]
+
+    @property
+    def enemy_mask(self) -> int:
+        return self.index.all_mask & ~self.owned_mask[self.me] & ~self.owned_mask[None]
+
+    # The exact position, as far as ZOBRIST_TROOPS tells troop counts apart
+    @property
+    def position_hash(self) -> int:
+        return self.ownership_hash ^ self.troop_hash
+
+    # Each territory's region hash covers the owners and bucketed troop counts of the territories
+    # its scores look at, so it only changes when something near it does
+    def update_region_hashes(self, territory: int, change: int):
+        region_hash = self.region_hash
+        for influenced in self.index.influence[territory]:
+            region_hash[influenced] ^= change
+
+    # Our spare troops and the enemies' spare troops next to the territory, the same as the threat
+    # map's friendly_support and enemy_reach but only looking at its neighbours
+    def nearby_spare(self, territory: int) -> tuple[int, int]:
+        occupier = self.occupier
+        troops = self.troops
+        friendly = 0
+        enemy = 0
+        for neighbour in self.index.neighbours[territory]:
+            spare = troops[neighbour] - 1
+            if spare <= 0 or occupier[neighbour] is None:
+                continue
+            if occupier[neighbour] == self.me:
+                friendly += spare
+            else:
+                enemy += spare
+        return friendly, enemy
+
+    # Gives the proportion of a continent owned by the player that the territory is from
+    def continent_proportion(self, territory: int, player: Optional[int]) -> float:
+        continent = self.index.continent_of[territory]
+        return self.continent_owned[player][continent]/self.index.continent_size[continent]
+
+    # A copy that can be moved on without changing this one (the map index is shared)
+    def copy(self) -> 'StateTracker':
+        tracker = copy.copy(self)
+        tracker.occupier = self.occupier[:]
+        tracker.troops = self.troops[:]
+        tracker.owned_mask = defaultdict(lambda: 0, self.owned_mask)
+        tracker.player_troops = defaultdict(lambda: 0, self.player_troops)
+        tracker.continent_owned = defaultdict(lambda: [0]*len(self.index.continent_mask), {player: owned[:] for player, owned in self.continent_owned.items()})
+        tracker.component_parent = self.component_parent[:]
+        tracker.component_size = self.component_size[:]
+        tracker.region_hash = self.region_hash[:]
+        return tracker
+
+    # Which owner key a player's territories are hashed with
+    def relative_owner(self, player: Optional[int]) -> int:
+        return 0 if player is None else 1 + (player - self.me) % self.player_count
+
+    def set_territory(self, territory: int, occupier: Optional[int], troops: int):
+        previous = self.occupier[territory]
+        self.player_troops[previous] -= self.troops[territory]
+        self.player_troops[occupier] += troops
+        troop_keys = territory*ZOBRIST_TROOPS
+        before, after = min(self.troops[territory], ZOBRIST_TROOPS - 1), min(troops, ZOBRIST_TROOPS - 1)
+        self.troop_hash ^= self.index.zobrist_troops[troop_keys + before] ^ self.index.zobrist_troops[troop_keys + after]
+        bucket_before, bucket_after = troop_bucket(self.troops[territory]), troop_bucket(troops)
+        if bucket_before != bucket_after:
+            self.update_region_hashes(territory, self.index.zobrist_troops[troop_keys + bucket_before] ^ self.index.zobrist_troops[troop_keys + bucket_after])
+        self.troops[territory] = troops
+        if previous == occupier:
+            return
+
+        bit = 1 << territory
+        continent = self.index.continent_of[territory]
+        owner_keys = territory*ZOBRIST_OWNERS
+        owner_change = self.index.zobrist_owner[owner_keys + self.relative_owner(previous)] ^ self.index.zobrist_owner[owner_keys + self.relative_owner(occupier)]
+        self.ownership_hash ^= owner_change
+        self.update_region_hashes(territory, owner_change)
+        self.owned_mask[previous] &= ~bit
+        self.owned_mask[occupier] |= bit
+        self.continent_owned[previous][continent] -= 1
+        self.continent_owned[occupier][continent] += 1
+        self.occupier[territory] = occupier
+
+        # Only this territory and its neighbours can move on or off our border
+        if self.me in (previous, occupier):
+            my_mask = self.owned_mask[self.me]
+            for changed in [territory] + self.index.neighbours[territory]:
+                if (my_mask >> changed) & 1 and self.index.neighbour_mask[changed] & ~my_mask:
+                    self.border_mask |= 1 << changed
+                else:
+                    self.border_mask &= ~(1 << changed)
+
+            # Gaining a territory can only merge groups, but losing one may split a group, so
+            # that is left to a rebuild the next time the groups are looked at
+            if occupier == self.me and not self.components_stale:
+                self.join_component(territory, self.owned_mask[self.me])
+            else:
+                self.components_stale = True
+
+    # Our territories are grouped into connected components with a union-find
+    def find_component(self, territory: int) -> int:
+        if self.components_stale:
+            self.rebuild_components()
+        parent = self.component_parent
+        while parent[territory] != territory:
+            parent[territory] = parent[parent[territory]]
+            territory = parent[territory]
+        return territory
+
+    # Joins a territory to the groups of its neighbours in the given set of our territories
+    def join_component(self, territory: int, owned: int):
+        self.component_parent[territory] = territory
+        self.component_size[territory] = 1
+        for neighbour in territories_in(self.index.neighbour_mask[territory] & owned):
+            root, other = self.find_component(territory), self.find_component(neighbour)
+            if root == other:
+                continue
+            if self.component_size[root] < self.component_size[other]:
+                root, other = other, root
+            self.component_parent[other] = root
+            self.component_size[root] += self.component_size[other]
+
+    def rebuild_components(self):
+        self.components_stale = False
+        joined = 0
+        for territory in territories_in(self.owned_mask[self.me]):
+            self.join_component(territory, joined)
+            joined |= 1 << territory
+
+    # The number of our territories in the groups touching this territory, which for one of ours
+    # is the size of its own group (or 0 when it has no friendly neighbours)
+    def neighbouring_component_size(self, territory: int) -> int:
+        roots = {self.find_component(neighbour) for neighbour in territories_in(self.index.neighbour_mask[territory] & self.owned_mask[self.me])}
+        return sum(self.component_size[root] for root in roots)
+
+    # The territories whose occupier or troop count a record may have changed
+    def territories_changed_by(self, game: Game, record) -> list[int]:
+        match record:
+            case MoveClaimTerritory() | MovePlaceInitialTroop():
+                return [record.territory]
+            case MoveDistributeTroops():
+                return list(record.distributions)
+            case MoveAttack():
+                return [record.attacking_territory, record.defending_territory]
+            case RecordAttack():
+                return self.territories_changed_by(game, game.state.recording[record.move_attack_id])
+            case MoveTroopsAfterAttack():
+                return self.territories_changed_by(game, game.state.recording[record.record_attack_id])
+            case MoveFortify():
+                return [record.source_territory, record.target_territory]
+        return []
+
+    def sync(self, game: Game):
+        recording = game.state.recording
+        if len(recording) < self.recording_seen:
+            self.rebuild(game)
+            return
+
+        changed = 0
+        for i in range(self.recording_seen, len(recording)):
+            for territory in self.territories_changed_by(game, recording[i]):
+                changed |= 1 << territory
+        self.recording_seen = len(recording)
+
+        for territory in territories_in(changed):
+            self.set_territory(territory, game.state.territories[territory].occupier, game.state.territories[territory].troops)
+
+
+@instrumented("get_tracker")
+def get_tracker(game: Game, bot_state: BotState) -> StateTracker:
+    if bot_state.tracker is None:
+        bot_state.tracker = StateTracker(game, get_map_index(game, bot_state))
+    else:
+        bot_state.tracker.sync(game)
+    return bot_state.tracker
+
+
+# The transposition cache has 2**TRANSPOSITION_BITS entries
+TRANSPOSITION_BITS = 14
+
+
+class TranspositionCache():
+    """Scores by 64-bit hash, in a table of fixed size. A hash can go in either entry of the pair
+    its low bits pick, and when both are taken the one written longest ago is replaced, so scores
+    from earlier queries make way for the current ones. Generation 0 marks an empty entry."""
+
+    def __init__(self, bits: int = TRANSPOSITION_BITS):
+        size = 1 << bits
+        self.pair_mask = size - 2
+        self.keys = array('Q', [0])*size
+        self.values = array('d', [0.0])*size
+        self.generations = array('I', [0])*size
+        self.generation = 1
+
+    def get(self, key: int) -> Optional[float]:
+        slot = key & self.pair_mask
+        if self.keys[slot] == key and self.generations[slot]:
+            return self.values[slot]
+        if self.keys[slot + 1] == key and self.generations[slot + 1]:
+            return self.values[slot + 1]
+        return None
+
+    def put(self, key: int, value: float):
+        slot = key & self.pair_mask
+        if self.keys[slot] != key and (self.keys[slot + 1] == key or self.generations[slot + 1] < self.generations[slot]):
+            slot += 1
+        self.keys[slot] = key
+        self.values[slot] = value
+        self.generations[slot] = self.generation
+
+
+# Scores for each territory from the cache where it has them, scoring only the rest. A territory's
+# key is its region hash with its own key and the context (anything else the scores depend on) mixed in.
+@instrumented("cached_scores")
+def cached_scores(cache: TranspositionCache, index: MapIndex, tracker: StateTracker, context: int, territories: list[int], score: Callable[[list[int]], dict[int, float]]) -> dict[int, float]:
+    cached: dict[int, float] = {}
+    unscored = []
+    for territory in territories:
+        value = cache.get(tracker.region_hash[territory] ^ index.zobrist_move[territory] ^ context)
+        if value is None:
+            unscored.append(territory)
+        else:
+            cached[territory] = value
+    scored = score(unscored) if unscored else {}
+    for territory, value in scored.items():
+        cache.put(tracker.region_hash[territory] ^ index.zobrist_move[territory] ^ context, value)
+    return {territory: cached[territory] if territory in cached else scored[territory] for territory in territories}
+
+
+# The handlers score territories as a weighted sum of features: a matrix with a column for each
+# feature over all the candidate territories, times the vector of coefficients. A feature whose
+# coefficient is zero is never computed at all.
+def feature_columns(territories: list[int], features: list[Callable[[int], float]], coefficients: list[float]) -> list[list[float]]:
+    return [list(map(feature, territories)) if coefficient != 0 else [] for feature, coefficient in zip(features, coefficients)]
+
+
+# The matrix of columns times the vector of coefficients, a row at a time for each column.
+def weighted_sum(columns: list[list[float]], coefficients: list[float], rows: int) -> list[float]:
+    scores = [0.0]*rows
+    for column, coefficient in zip(columns, coefficients):
+        if coefficient != 0:
+            scores = [score + coefficient*value for score, value in zip(scores, column)]
+    return scores
+
+
+@instrumented("score_territories")
+def score_territories(territories: list[int], features: list[Callable[[int], float]], coefficients: list[float]) -> dict[int, float]:
+    columns = feature_columns(territories, features, coefficients)
+    return dict(zip(territories, weighted_sum(columns, coefficients, len(territories))))
+
+
+# How often each (attackers lost, defenders lost) outcome happens for a single roll with the given
+# number of attacking and defending dice.
+def roll_outcomes(attacking_dice: int, defending_dice: int) -> list[tuple[int, int, float]]:
+    counts = defaultdict(lambda: 0)
+    for dice in product(range(1, 7), repeat=attacking_dice + defending_dice):
+        attack = sorted(dice[:attacking_dice], reverse=True)
+        defend = sorted(dice[attacking_dice:], reverse=True)
+        defenders_lost = sum(1 for a, d in zip(attack, defend) if a > d)
+        counts[(min(attacking_dice, defending_dice) - defenders_lost, defenders_lost)] += 1
+    total = 6**(attacking_dice + defending_dice)
+    return [(attackers_lost, defenders_lost, count/total) for (attackers_lost, defenders_lost), count in sorted(counts.items())]
+
+
+ROLL_OUTCOMES = {(a, d): roll_outcomes(a, d) for a in range(1, 4) for d in range(1, 3)}
+
+
+@lru_cache(maxsize=4096)
+def survivor_distribution(attackers: int, defenders: int) -> tuple[float, ...]:
+    """The chance of conquering the territory with exactly k attacking troops left, for each k,
+    when attacking with everything until one side runs out."""
+    # We push probability forward through the battle, from the starting position to the end.
+    reach = {(attackers, defenders): 1.0}
+    result = [0.0]*(attackers + 1)
+    for total in range(attackers + defenders, 0, -1):
+        for a in range(max(0, total - defenders), min(attackers, total) + 1):
+            d = total - a
+            probability = reach.pop((a, d), 0.0)
+            if probability == 0 or a == 0:
+                continue
+            if d == 0:
+                result[a] += probability
+                continue
+            for attackers_lost, defenders_lost, p in ROLL_OUTCOMES[(min(3, a), min(2, d))]:
+                key = (a - attackers_lost, d - defenders_lost)
+                reach[key] = reach.get(key, 0.0) + probability*p
+    return tuple(result)
+
+
+class BattleOdds():
+    """Exact odds of taking a territory when attacking with `attackers` troops (not counting the one
+    that has to stay behind) against `defenders` troops, assuming both sides always roll as many
+    dice as they can. Battles up to the table size are looked up, anything bigger is scaled down
+    to fit."""
+
+    def __init__(self, max_attackers: int = 200, max_defenders: int = 200, path: Optional[str] = None):
+        self.max_attackers = max_attackers
+        self.max_defenders = max_defenders
+        if path is None or not self.load(path):
+            self.compute()
+            if path is not None:
+                self.save(path)
+
+    def compute(self):
+        width = self.max_defenders + 1
+        self.win = array('d', [0.0])*((self.max_attackers + 1)*width)
+        self.survivors = array('d', [0.0])*((self.max_attackers + 1)*width)
+        for a in range(0, self.max_attackers + 1):
+            self.win[a*width] = 1.0
+            self.survivors[a*width] = a
+            if a == 0:
+                continue
+            for d in range(1, width):
+                win = 0.0
+                survivors = 0.0
+                for attackers_lost, defenders_lost, p in ROLL_OUTCOMES[(min(3, a), min(2, d))]:
+                    next_position = (a - attackers_lost)*width + d - defenders_lost
+                    win += p*self.win[next_position]
+                    survivors += p*self.survivors[next_position]
+                self.win[a*width + d] = win
+                self.survivors[a*width + d] = survivors
+
+    def load(self, path: str) -> bool:
+        try:
+            with open(path, "rb") as file:
+                max_attackers, max_defenders = struct.unpack("<II", file.read(8))
+                if (max_attackers, max_defenders) != (self.max_attackers, self.max_defenders):
+                    return False
+                size = (max_attackers + 1)*(max_defenders + 1)
+                self.win = array('d')
+                self.win.fromfile(file, size)
+                self.survivors = array('d')
+                self.survivors.fromfile(file, size)
+            return True
+        except (OSError, EOFError, struct.error):
+            return False
+
+    def save(self, path: str):
+        try:
+            with open(path, "wb") as file:
+                file.write(struct.pack("<II", self.max_attackers, self.max_defenders))
+                self.win.tofile(file)
+                self.survivors.tofile(file)
+        except OSError:
+            pass
+
+    def _position(self, attackers: int, defenders: int) -> int:
+        attackers = max(0, attackers)
+        defenders = max(0, defenders)
+        scale = max(attackers/self.max_attackers, defenders/self.max_defenders, 1)
+        if scale > 1:
+            attackers = round(attackers/scale)
+            defenders = max(1, round(defenders/scale)) if defenders > 0 else 0
+        return attackers*(self.max_defenders + 1) + defenders
+
+    def win_probability(self, attackers: int, defenders: int) -> float:
+        return self.win[self._position(attackers, defenders)]
+
+    # The expected number of attacking troops left over, given that the attack succeeds
+    def expected_survivors(self, attackers: int, defenders: int) -> float:
+        position = self._position(attackers, defenders)
+        if self.win[position] == 0:
+            return 0
+        scale = max(attackers/self.max_attackers, defenders/self.max_defenders, 1)
+        return scale*self.survivors[position]/self.win[position]
+
+    # The chance of winning with exactly k attackers left, for each k. Battles bigger than the table
+    # are left to expected_survivors, as working them out exactly would take too long.
+    def survivor_distribution(self, attackers: int, defenders: int) -> Optional[tuple[float, ...]]:
+        if attackers > self.max_attackers or defenders > self.max_defenders:
+            return None
+        return survivor_distribution(max(0, attackers), max(0, defenders))
+
+    # The chance the defenders hold out if this roll is attacking_dice against defending_dice and the
+    # attacker then carries on with everything
+    def hold_probability(self, attackers: int, attacking_dice: int, defenders: int, defending_dice: int) -> float:
+        return sum(p*(1 - self.win_probability(attackers - attackers_lost, defenders - defenders_lost)) for attackers_lost, defenders_lost, p in ROLL_OUTCOMES[(attacking_dice, defending_dice)])
+
+
+BATTLE_ODDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "battle_odds.bin")
+battle_odds: Optional[BattleOdds] = None
+
+
+def get_battle_odds() -> BattleOdds:
+    global battle_odds
+    if battle_odds is None:
+        with shared_data_lock:
+            if battle_odds is None:
+                battle_odds = BattleOdds(path=BATTLE_ODDS_PATH)
+    return battle_odds
+
+
+OPENING_BOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opening_book.bin")
+OPENING_BOOK_MAGIC = b"RKOB"
+OPENING_BOOK_HEADER = struct.Struct("<4sQI")
+
+
+class OpeningBook():
+    """The territory to claim or place a troop on for positions that come up often in the opening,
+    built offline by build_opening_book.py. The file has a header, the position hashes in ascending
+    order and then the answer for each, and is mapped into memory and binary searched in place.
+    A book made for a different map, different parameters or different code is ignored."""
+
+    def __init__(self, path: str, fingerprint: int):
+        self.keys: Sequence[int] = []
+        self.answers: Sequence[int] = []
+        try:
+            with open(path, "rb") as file:
+                self.mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return
+
+        # The tables are read in place as native integers, and are written little endian
+        if len(self.mapped) < OPENING_BOOK_HEADER.size or sys.byteorder != "little":
+            return
+        magic, book_fingerprint, count = OPENING_BOOK_HEADER.unpack_from(self.mapped)
+        if magic != OPENING_BOOK_MAGIC or book_fingerprint != fingerprint or len(self.mapped) != OPENING_BOOK_HEADER.size + 10*count:
+            return
+        view = memoryview(self.mapped)
+        self.keys = view[OPENING_BOOK_HEADER.size:OPENING_BOOK_HEADER.size + 8*count].cast('Q')
+        self.answers = view[OPENING_BOOK_HEADER.size + 8*count:].cast('H')
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def lookup(self, position_hash: int) -> Optional[int]:
+        i = bisect_left(self.keys, position_hash)
+        if i < len(self.keys) and self.keys[i] == position_hash:
+            return self.answers[i]
+        return None
+
+    @staticmethod
+    def write(path: str, fingerprint: int, answers: dict[int, int]):
+        keys = array('Q', sorted(answers))
+        values = array('H', [answers[key] for key in keys])
+        if sys.byteorder != "little":
+            keys.byteswap()
+            values.byteswap()
+        with open(path, "wb") as file:
+            file.write(OPENING_BOOK_HEADER.pack(OPENING_BOOK_MAGIC, fingerprint, len(keys)))
+            keys.tofile(file)
+            values.tofile(file)
+
+
+@lru_cache(maxsize=1)
+def source_code() -> bytes:
+    try:
+        with open(os.path.abspath(__file__), "rb") as file:
+            return file.read()
+    except OSError:
+        return b""
+
+
+# What a book's answers depend on: the map, the parameters and the code of this file
+def opening_book_fingerprint(index: MapIndex, parameters: dict) -> int:
+    digest = hashlib.blake2b(json.dumps([index.neighbours, index.continent_of, parameters], sort_keys=True).encode(), digest_size=8)
+    digest.update(source_code())
+    return int.from_bytes(digest.digest(), "little")
+
+
+opening_books: dict[int, OpeningBook] = {}
+
+
+def get_opening_book(game: Game, bot_state: BotState) -> OpeningBook:
+    if bot_state.opening_book is None:
+        fingerprint = opening_book_fingerprint(get_map_index(game, bot_state), bot_state.parameters)
+        with shared_data_lock:
+            if fingerprint not in opening_books:
+                opening_books[fingerprint] = OpeningBook(OPENING_BOOK_PATH, fingerprint)
+            bot_state.opening_book = opening_books[fingerprint]
+    return bot_state.opening_book
+
+
+class AttackPlan():
+    """A chain of conquests worked out at the start of the attack phase. It is followed one attack
+    at a time until it runs out or a battle goes noticeably worse than expected."""
+
+    def __init__(self, steps: list[tuple[int, int]], chances: list[float]):
+        self.steps = steps
+        self.chances = chances
+        self.position = 0
+
+    def next_attack(self, tracker: StateTracker, odds: BattleOdds, min_win_chance: float, tolerance: float) -> Optional[tuple[int, int]]:
+        # Skipping over the territories we have already taken
+        while self.position < len(self.steps) and tracker.occupier[self.steps[self.position][1]] == tracker.me:
+            self.position += 1
+        if self.position == len(self.steps):
+            return None
+
+        attacker, target = self.steps[self.position]
+        if tracker.occupier[attacker] != tracker.me or tracker.troops[attacker] <= 1:
+            return None
+        chance = odds.win_probability(tracker.troops[attacker] - 1, tracker.troops[target])
+        if chance < min_win_chance or chance < self.chances[self.position] - tolerance:
+            return None
+        return attacker, target
+
+    # Whether a later attack in the plan is launched from this territory
+    def continues_from(self, territory: int) -> bool:
+        return any(attacker == territory for attacker, _ in self.steps[self.position:])
+
+
+@instrumented("plan_attacks")
+def plan_attacks(index: MapIndex, tracker: StateTracker, odds: BattleOdds, values: dict[int, float], min_win_chance: float, sweep_bonus: float, max_depth: int, threshold: float) -> Optional[AttackPlan]:
+    """Searches chains of adjacent enemy territories that a single army could take one after the
+    other, carrying the expected survivors forward, and returns the chain with the highest expected
+    value (if it beats the threshold). Completing a continent is worth an extra sweep_bonus. The
+    chance of the battle after a conquest is averaged over how many troops survived it."""
+    troops = tracker.troops
+    my_mask = tracker.my_mask
+    enemy_mask = tracker.enemy_mask
+    best_score = threshold
+    best: Optional[AttackPlan] = None
+    steps: list[tuple[int, int]] = []
+    chances: list[float] = []
+
+    # survived is the chance of each number of troops surviving the last conquest, given it was won
+    def search(territory: int, attackers: int, survived: Optional[list[float]], chance: float, conquered: int, score: float):
+        nonlocal best_score, best
+        if len(steps) > 0 and score > best_score:
+            best_score = score
+            best = AttackPlan(list(steps), list(chances))
+        if len(steps) == max_depth or attackers < 1:
+            return
+
+        for target in territories_in(index.neighbour_mask[territory] & enemy_mask & ~conquered):
+            if survived is None:
+                win = odds.win_probability(attackers, troops[target])
+            else:
+                win = sum(p*odds.win_probability(k - 1, troops[target]) for k, p in enumerate(survived) if p > 0 and k > 1)
+            if win < min_win_chance:
+                continue
+            taken = conquered | (1 << target)
+            value = values.get(target, 0)
+            continent = index.continent_of[target]
+            if index.continent_mask[continent] & ~(my_mask | taken) == 0:
+                value += sweep_bonus
+
+            # Everything that survives moves in, leaving one troop behind to hold the territory
+            survivors = round(odds.expected_survivors(attackers, troops[target]))
+            distribution = odds.survivor_distribution(attackers, troops[target]) if len(steps) + 1 < max_depth else None
+            if distribution is not None:
+                total = sum(distribution)
+                distribution = [p/total for p in distribution] if total > 0 else None
+            steps.append((territory, target))
+            chances.append(win)
+            search(target, survivors - 1, distribution, chance*win, taken, score + chance*win*value)
+            steps.pop()
+            chances.pop()
+
+    for source in territories_in(my_mask & index.adjacent_mask(enemy_mask)):
+        if troops[source] > 1:
+            search(source, troops[source] - 1, None, 1.0, 0, 0.0)
+    return best
+
+
+# How hard a territory is pressed: the troops that could attack it for each troop that could hold
+# it, with one more on each side so an empty side doesn't divide by zero. Every handler weighs the
+# two sides of a territory with this, through ThreatMap.pressure where it has the threat map.
+def pressure(attackers: float, defenders: float) -> float:
+    return (1 + attackers)/(1 + defenders)
+
+
+# How much enemy troops two hops away count towards the pressure on one of our territories, next
+# to those one hop away. They could only reach it after taking the territory in between.
+TWO_HOP_SHARE = 0.25
+
+
+class ThreatMap():
+    """How much pressure each territory is under, worked out once per query so every handler
+    sees the same numbers. Troop counts here are spare troops, the ones that could attack or
+    move (all but one on the territory)."""
+
+    def __init__(self, index: MapIndex, tracker: StateTracker, odds: BattleOdds):
+        size = len(index.neighbour_mask)
+        troops = tracker.troops
+        my_mask = tracker.my_mask
+        enemy_mask = tracker.enemy_mask
+        self.my_mask = my_mask
+        self.troops = list(troops)
+
+        # Enemy troops next to each territory, our troops next to each territory, and the
+        # largest single enemy army next to each territory
+        self.enemy_reach = [0]*size
+        self.friendly_support = [0]*size
+        self.strongest_enemy = [0]*size
+        for territory in index.territories:
+            spare = troops[territory] - 1
+            if spare <= 0:
+                continue
+            if (enemy_mask >> territory) & 1:
+                for neighbour in index.neighbours[territory]:
+                    self.enemy_reach[neighbour] += spare
+                    self.strongest_enemy[neighbour] = max(self.strongest_enemy[neighbour], spare)
+            elif (my_mask >> territory) & 1:
+                for neighbour in index.neighbours[territory]:
+                    self.friendly_support[neighbour] += spare
+
+        # Enemy troops within two hops, which could reach the territory after one conquest
+        self.enemy_reach_two = [0]*size
+        for territory in index.territories:
+            nearby = (index.adjacent_mask(index.neighbour_mask[territory]) | index.neighbour_mask[territory]) & enemy_mask & ~(1 << territory)
+            self.enemy_reach_two[territory] = sum(max(0, troops[enemy] - 1) for enemy in territories_in(nearby))
+
+        # The chance one of our territories falls if each enemy neighbour attacks it with everything
+        self.fall_probability = [0.0]*size
+        for territory in territories_in(my_mask):
+            holds = 1.0
+            for enemy in territories_in(index.neighbour_mask[territory] & enemy_mask):
+                if troops[enemy] > 1:
+                    holds *= 1 - odds.win_probability(troops[enemy] - 1, troops[territory])
+            self.fall_probability[territory] = 1 - holds
+
+    # The pressure on the territory from the side that doesn't hold it, as if it had extra more
+    # troops. Ours are pressed by the enemy within one hop, and by a share of those two hops away.
+    # Enemy territories are pressed by our troops next to them, against their own troops and those
+    # of the enemy next to them.
+    def pressure(self, territory: int, extra: int = 0) -> float:
+        if (self.my_mask >> territory) & 1:
+            attackers = self.enemy_reach[territory] + TWO_HOP_SHARE*(self.enemy_reach_two[territory] - self.enemy_reach[territory])
+            return pressure(attackers, self.troops[territory] + extra + self.friendly_support[territory])
+        return pressure(self.friendly_support[territory], self.troops[territory] + extra + self.enemy_reach[territory])
+
+
+def get_threat_map(game: Game, bot_state: BotState) -> ThreatMap:
+    if bot_state.threat_map is None or bot_state.threat_map_seen != len(game.state.recording):
+        bot_state.threat_map = ThreatMap(get_map_index(game, bot_state), get_tracker(game, bot_state), get_battle_odds())
+        bot_state.threat_map_seen = len(game.state.recording)
+    return bot_state.threat_map
+
+
+# How quickly the opponent statistics forget old turns, and what they start from before a player
+# has been seen to do anything.
+OPPONENT_DECAY = 0.2
+OPPONENT_PRIOR_TURNS = 2
+
+
+class PlayerStats():
+    """What one player tends to do, as moving averages over their turns so it takes the same
+    memory however long the game goes on."""
+    __slots__ = ("turns", "attack_turn_rate", "battles_per_turn", "attack_ratio", "min_attack_ratio", "conquests_per_turn",
+                 "battles_on_me_per_turn", "fortify_rate", "turns_between_redemptions", "last_redemption", "last_battle",
+                 "turn_battles", "turn_conquests", "turn_battles_on_me", "turn_min_ratio")
+
+    def __init__(self):
+        self.turns = 0
+        self.attack_turn_rate = 0.5
+        self.battles_per_turn = 3.0
+        self.attack_ratio = 2.0
+        self.min_attack_ratio = 1.5
+        self.conquests_per_turn = 1.0
+        self.battles_on_me_per_turn = 0.5
+        self.fortify_rate = 0.5
+        self.turns_between_redemptions = 4.0
+        self.last_redemption = 0
+        self.last_battle: Optional[tuple[int, int]] = None
+        self.turn_battles = 0
+        self.turn_conquests = 0
+        self.turn_battles_on_me = 0
+        self.turn_min_ratio = math.inf
+
+    # Weight of the newest observation, which starts higher so the priors wash out quickly
+    def decay(self) -> float:
+        return max(OPPONENT_DECAY, 1/(self.turns + OPPONENT_PRIOR_TURNS))
+
+
+class OpponentModel():
+    """Statistics on how every player plays, built up by reading each record of the game once.
+    It replays troop counts itself so attacks can be judged by the odds at the time they were made."""
+
+    def __init__(self, size: int, me: int):
+        self.me = me
+        self.occupier: list[Optional[int]] = [None]*size
+        self.troops = [0]*size
+        self.players: dict[int, PlayerStats] = {}
+        self.recording_seen = 0
+
+    def stats(self, player: int) -> PlayerStats:
+        stats = self.players.get(player)
+        if stats is None:
+            stats = self.players[player] = PlayerStats()
+        return stats
+
+    def sync(self, game: Game):
+        recording = game.state.recording
+        if len(recording) < self.recording_seen:
+            self.__init__(len(self.troops), self.me)
+        for i in range(self.recording_seen, len(recording)):
+            self.observe(game, recording[i])
+        self.recording_seen = len(recording)
+
+    def observe(self, game: Game, record):
+        match record:
+            case MoveClaimTerritory():
+                self.occupier[record.territory] = record.move_by_player
+                self.troops[record.territory] = 1
+            case MovePlaceInitialTroop():
+                self.troops[record.territory] += 1
+            case MoveRedeemCards():
+                stats = self.stats(record.move_by_player)
+                if len(record.sets) > 0:
+                    stats.turns_between_redemptions += stats.decay()*(stats.turns - stats.last_redemption - stats.turns_between_redemptions)
+                    stats.last_redemption = stats.turns
+            case MoveDistributeTroops():
+                for territory, troops in record.distributions.items():
+                    self.troops[territory] += troops
+            case MoveAttack():
+                stats = self.stats(record.move_by_player)
+                battle = (record.attacking_territory, record.defending_territory)
+                if battle != stats.last_battle:
+                    stats.last_battle = battle
+                    stats.turn_battles += 1
+                    if self.occupier[record.defending_territory] == self.me:
+                        stats.turn_battles_on_me += 1
+                    ratio = (self.troops[record.attacking_territory] - 1)/max(1, self.troops[record.defending_territory])
+                    stats.attack_ratio += OPPONENT_DECAY*(ratio - stats.attack_ratio)
+                    stats.turn_min_ratio = min(stats.turn_min_ratio, ratio)
+            case RecordAttack():
+                move_attack = cast(MoveAttack, game.state.recording[record.move_attack_id])
+                self.troops[move_attack.attacking_territory] -= record.attacking_lost
+                self.troops[move_attack.defending_territory] -= record.defending_lost
+                if record.territory_conquered:
+                    self.occupier[move_attack.defending_territory] = move_attack.move_by_player
+                    self.stats(move_attack.move_by_player).turn_conquests += 1
+            case MoveTroopsAfterAttack():
+                move_attack = cast(MoveAttack, game.state.recording[cast(RecordAttack, game.state.recording[record.record_attack_id]).move_attack_id])
+                self.troops[move_attack.attacking_territory] -= record.troop_count
+                self.troops[move_attack.defending_territory] += record.troop_count
+            case MoveFortify():
+                self.troops[record.source_territory] -= record.troop_count
+                self.troops[record.target_territory] += record.troop_count
+                self.end_turn(record.move_by_player, True)
+            case MoveFortifyPass():
+                self.end_turn(record.move_by_player, False)
+
+    # Fortifying (or passing) is the last move of a turn, so the turn's counts are folded in here
+    def end_turn(self, player: int, fortified: bool):
+        stats = self.stats(player)
+        decay = stats.decay()
+        stats.attack_turn_rate += decay*((stats.turn_battles > 0) - stats.attack_turn_rate)
+        stats.battles_per_turn += decay*(stats.turn_battles - stats.battles_per_turn)
+        stats.conquests_per_turn += decay*(stats.turn_conquests - stats.conquests_per_turn)
+        stats.battles_on_me_per_turn += decay*(stats.turn_battles_on_me - stats.battles_on_me_per_turn)
+        stats.fortify_rate += decay*(fortified - stats.fortify_rate)
+        if stats.turn_min_ratio < math.inf:
+            stats.min_attack_ratio += decay*(stats.turn_min_ratio - stats.min_attack_ratio)
+        stats.turns += 1
+        stats.last_battle = None
+        stats.turn_battles = 0
+        stats.turn_conquests = 0
+        stats.turn_battles_on_me = 0
+        stats.turn_min_ratio = math.inf
+
+
+def get_opponent_model(game: Game, bot_state: BotState) -> OpponentModel:
+    if bot_state.opponent_model is None:
+        bot_state.opponent_model = OpponentModel(len(get_map_index(game, bot_state).neighbour_mask), game.state.me.player_id)
+    bot_state.opponent_model.sync(game)
+    return bot_state.opponent_model
+
+
+# Hop distances to each of our territories, only passing through our own territories. They only
+# change when our territories do, so they are kept until then.
+class OwnedDistances():
+    def __init__(self, index: MapIndex, my_mask: int):
+        self.index = index
+        self.my_mask = my_mask
+        self.to_target: dict[int, bytearray] = {}
+
+    def distances_to(self, target: int) -> bytearray:
+        distances = self.to_target.get(target)
+        if distances is None:
+            distances = self.to_target[target] = self.index.distances_from(1 << target, self.my_mask)
+        return distances
+
+    def distance(self, source: int, target: int) -> Optional[int]:
+        hops = self.distances_to(target)[source]
+        return hops if hops != UNREACHABLE else None
+
+    # Our neighbour of source to step to first on the way to target (lowest id on ties)
+    def next_hop(self, source: int, target: int) -> Optional[int]:
+        distances = self.distances_to(target)
+        if distances[source] in (0, UNREACHABLE):
+            return None
+        return next(neighbour for neighbour in territories_in(self.index.neighbour_mask[source] & self.my_mask) if distances[neighbour] == distances[source] - 1)
+
+
+def get_owned_distances(index: MapIndex, tracker: StateTracker, bot_state: BotState) -> OwnedDistances:
+    if bot_state.owned_distances is None or bot_state.owned_distances.my_mask != tracker.my_mask:
+        bot_state.owned_distances = OwnedDistances(index, tracker.my_mask)
+    return bot_state.owned_distances
+
+
+# Sends as much supply to demand as possible for the least total cost (troops times hops), by
+# successive shortest paths: each round pushes troops along the cheapest path through the residual
+# graph, which can undo earlier sends. Pairs with no cost cannot send to each other.
+@instrumented("min_cost_transport")
+def min_cost_transport(supply: dict[int, int], demand: dict[int, int], cost: Callable[[int, int], Optional[int]]) -> dict[tuple[int, int], int]:
+    supply = {source: amount for source, amount in supply.items() if amount > 0}
+    demand = {sink: amount for sink, amount in demand.items() if amount > 0}
+    costs = {(source, sink): hops for source in sorted(supply) for sink in sorted(demand) if (hops := cost(source, sink)) is not None}
+    flow: dict[tuple[int, int], int] = defaultdict(lambda: 0)
+
+    while True:
+        # Bellman-Ford from every source with supply left; sinks are reached forwards along an
+        # arc, and sources backwards along an arc that already carries flow
+        source_cost = {source: 0 if supply[source] > 0 else math.inf for source in supply}
+        sink_cost = {sink: math.inf for sink in demand}
+        reached_from: dict[int, int] = {}
+        returned_from: dict[int, int] = {}
+        for _ in range(len(supply) + len(demand)):
+            changed = False
+            for (source, sink), hops in costs.items():
+                if source_cost[source] + hops < sink_cost[sink]:
+                    sink_cost[sink] = source_cost[source] + hops
+                    reached_from[sink] = source
+                    changed = True
+                if flow[source, sink] > 0 and sink_cost[sink] - hops < source_cost[source]:
+                    source_cost[source] = sink_cost[sink] - hops
+                    returned_from[source] = sink
+                    changed = True
+            if not changed:
+                break
+
+        open_sinks = [sink for sink in demand if demand[sink] > 0 and sink_cost[sink] < math.inf]
+        if len(open_sinks) == 0:
+            return {pair: amount for pair, amount in flow.items() if amount > 0}
+        sink = min(open_sinks, key=lambda x: (sink_cost[x], x))
+
+        # Walking the path back to where it started to find how much it can carry
+        path: list[tuple[int, int, int]] = []
+        amount = demand[sink]
+        current = sink
+        while True:
+            source = reached_from[current]
+            path.append((source, current, 1))
+            if source not in returned_from:
+                break
+            current = returned_from[source]
+            path.append((source, current, -1))
+            amount = min(amount, flow[source, current])
+        amount = min(amount, supply[source])
+
+        supply[source] -= amount
+        demand[sink] -= amount
+        for source, sink_on_path, direction in path:
+            flow[source, sink_on_path] += direction*amount
+
+
+# Hands out troops one at a time to whichever territory gains the most from its next troop, using a
+# heap of each territory's next gain (lowest id on ties). When each territory's gains never grow as
+# it gets more troops (a separable concave objective) this is an optimal integer allocation.
+@instrumented("allocate_troops")
+def allocate_troops(total: int, territories: list[int], marginal_gain: Callable[[int, int], float]) -> dict[int, int]:
+    allocation = {territory: 0 for territory in territories}
+    heap = [(-marginal_gain(territory, 0), territory) for territory in territories]
+    heapq.heapify(heap)
+    for _ in range(total if len(heap) > 0 else 0):
+        _, territory = heapq.heappop(heap)
+        allocation[territory] += 1
+        heapq.heappush(heap, (-marginal_gain(territory, allocation[territory]), territory))
+    return allocation
+
+
+# Seconds of lookahead search to spend on each attack, distribution and fortify decision. The
+# search is off unless RISK_SEARCH_BUDGET gives it some time, as it hasn't yet been shown not to
+# talk the bot out of attacking when every seat searches. The engine's move time limit always wins
+# over this, and we fall back to the heuristics when there is too little time left for the search
+# to be worth it.
+SEARCH_TIME_BUDGET = float(os.environ.get("RISK_SEARCH_BUDGET", 0))
+MOVE_TIME_LIMIT = 1.0
+MOVE_TIME_MARGIN = 0.25
+MIN_SEARCH_TIME = 0.005
+
+
+class Budget():
+    """A time allowance for a single query, measured from when the query arrived on the given clock
+    (the monotonic clock unless the bot state says otherwise). It also runs out as soon as the stop
+    event (if any) is set."""
+
+    def __init__(self, started: float, seconds: float, stop: Optional[threading.Event] = None, clock: Callable[[], float] = time.monotonic):
+        self.deadline = started + seconds
+        self.stop = stop
+        self.clock = clock
+
+    def remaining(self) -> float:
+        if self.stop is not None and self.stop.is_set():
+            return 0
+        return self.deadline - self.clock()
+
+    def expired(self) -> bool:
+        return self.clock() >= self.deadline or (self.stop is not None and self.stop.is_set())
+
+
+def query_budget(bot_state: BotState) -> Budget:
+    started = bot_state.query_started if bot_state.query_started is not None else bot_state.clock()
+    return Budget(started, min(bot_state.search_budget, MOVE_TIME_LIMIT - MOVE_TIME_MARGIN), bot_state.stop, bot_state.clock)
+
+
+# Moves that can be applied to a CompactState. Dice rolls and card redemptions in rollouts change
+# the arrays directly, as they happen too often to be worth building a move for.
+PLACE_TROOPS = 0     # (PLACE_TROOPS, territory, troops)
+MOVE_TROOPS = 1      # (MOVE_TROOPS, source, target, troops)
+CONQUER = 2          # (CONQUER, attacker, defender, troops moved in)
+
+NO_OCCUPIER = 0xFFFF
+
+
+class CompactState():
+    """A small copy of the game that moves can be tried out on, with occupiers and troop counts in
+    flat arrays so copying it is just a couple of memcpys."""
+    __slots__ = ("occupier", "troops", "cards", "troops_remaining", "me", "card_sets_redeemed")
+
+    def __init__(self, occupier: array, troops: array, cards: array, troops_remaining: array, me: int, card_sets_redeemed: int):
+        self.occupier = occupier
+        self.troops = troops
+        self.cards = cards
+        self.troops_remaining = troops_remaining
+        self.me = me
+        self.card_sets_redeemed = card_sets_redeemed
+
+    @staticmethod
+    def from_game(game: Game, tracker: Optional[StateTracker] = None) -> 'CompactState':
+        players = max(game.state.players) + 1
+        cards = array('B', [0])*players
+        troops_remaining = array('H', [0])*players
+        for player in game.state.players:
+            cards[player] = game.state.players[player].card_count
+            troops_remaining[player] = game.state.players[player].troops_remaining
+        if tracker is not None:
+            occupiers = tracker.occupier
+            troops = array('H', tracker.troops)
+        else:
+            size = max(game.state.territories) + 1
+            occupiers = [None]*size
+            troops = array('H', [0])*size
+            for territory in game.state.territories:
+                occupiers[territory] = game.state.territories[territory].occupier
+                troops[territory] = game.state.territories[territory].troops
+        occupier = array('H', [occupier if occupier is not None else NO_OCCUPIER for occupier in occupiers])
+        return CompactState(occupier, troops, cards, troops_remaining, game.state.me.player_id, game.state.card_sets_redeemed)
+
+    def copy(self) -> 'CompactState':
+        return CompactState(self.occupier[:], self.troops[:], self.cards[:], self.troops_remaining[:], self.me, self.card_sets_redeemed)
+
+    def apply_move(self, move: tuple):
+        # The move kinds are dispatched with if rather than match, as a bare name in a case
+        # pattern would capture the move rather than compare against the constant
+        kind = move[0]
+        if kind == PLACE_TROOPS:
+            _, territory, count = move
+            self.troops[territory] += count
+        elif kind == MOVE_TROOPS:
+            _, source, target, count = move
+            self.troops[source] -= count
+            self.troops[target] += count
+        elif kind == CONQUER:
+            _, attacker, defender, count = move
+            self.occupier[defender] = self.occupier[attacker]
+            self.troops[attacker] -= count
+            self.troops[defender] = count
+
+
+# Troops given for the next card set, after the given number of sets have been redeemed
+def card_set_value(card_sets_redeemed: int) -> int:
+    values = [4, 6, 8, 10, 12, 15]
+    if card_sets_redeemed < len(values):
+        return values[card_sets_redeemed]
+    return 15 + 5*(card_sets_redeemed - len(values) + 1)
+
+
+# Three cards are a set if their symbols (not counting wildcards) are all the same or all different
+def is_card_set(symbols: tuple[str, ...]) -> bool:
+    named = [symbol for symbol in symbols if symbol != "Wildcard"]
+    return len(set(named)) == 1 or len(set(named)) == len(named)
+
+
+# Every way of redeeming disjoint sets from a hand that leaves a different hand behind, as tuples of
+# index triples. Each card is given as its symbol and whether it would pay a territory bonus. Cards
+# alike in both are interchangeable, so ways of redeeming that use up the same number of each kind
+# of card are only listed once (always taking the earliest cards). That keeps the search to the
+# hands that can be left over rather than every combination of sets, and the answer only depends on
+# the kinds of card so it is remembered. There are still too many hands that can be left over from
+# a very big hand, so beyond CARD_PLAN_LIMIT cards a set is taken from the first five cards (which
+# always hold one) until the rest are few enough to search.
+CARD_PLAN_LIMIT = 12
+
+
+@lru_cache(maxsize=1024)
+def card_set_combinations(cards: tuple[tuple[str, bool], ...]) -> tuple[tuple[tuple[int, int, int], ...], ...]:
+    if len(cards) > CARD_PLAN_LIMIT:
+        first = next(triple for triple in combinations(range(5), 3) if is_card_set(tuple(cards[i][0] for i in triple)))
+        rest = [i for i in range(len(cards)) if i not in first]
+        return tuple((first,) + tuple(cast(tuple[int, int, int], tuple(rest[i] for i in triple)) for triple in combination) for combination in card_set_combinations(tuple(cards[i] for i in rest)))
+
+    kinds = sorted(set(cards))
+    members = [[i for i, card in enumerate(cards) if card == kind] for kind in kinds]
+    sets = [triple for triple in combinations_with_replacement(range(len(kinds)), 3) if is_card_set(tuple(kinds[i][0] for i in triple))]
+
+    # Going one more set at a time, from each hand that can be left over to the ones it leads to
+    left_over = {tuple(len(indices) for indices in members): ()}
+    frontier = list(left_over.items())
+    while frontier:
+        next_frontier = []
+        for remaining, chosen in frontier:
+            for triple in sets:
+                if all(remaining[kind] >= triple.count(kind) for kind in triple):
+                    after = list(remaining)
+                    for kind in triple:
+                        after[kind] -= 1
+                    if tuple(after) not in left_over:
+                        left_over[tuple(after)] = chosen + (triple,)
+                        next_frontier.append((tuple(after), chosen + (triple,)))
+        frontier = next_frontier
+
+    # Each kind's cards are handed out in order
+    def cards_for(combination: tuple[tuple[int, int, int], ...]) -> tuple[tuple[int, int, int], ...]:
+        unused = [iter(indices) for indices in members]
+        return tuple(cast(tuple[int, int, int], tuple(sorted(next(unused[kind]) for kind in triple))) for triple in combination)
+
+    return tuple(cards_for(combination) for combination in left_over.values())
+
+
+# Cumulative chances of each roll outcome, for sampling battles quickly
+ROLL_SAMPLER = {dice: [(sum(p for _, _, p in outcomes[:i + 1]), attackers_lost, defenders_lost) for i, (attackers_lost, defenders_lost, _) in enumerate(outcomes)] for dice, outcomes in ROLL_OUTCOMES.items()}
+
+
+def sample_roll(rng: random.Random, attacking_dice: int, defending_dice: int) -> tuple[int, int]:
+    roll = rng.random()
+    outcomes = ROLL_SAMPLER[(attacking_dice, defending_dice)]
+    for cumulative, attackers_lost, defenders_lost in outcomes:
+        if roll < cumulative:
+            return attackers_lost, defenders_lost
+    return outcomes[-1][1], outcomes[-1][2]
+
+
+# Attacks with everything until one side runs out, moving the survivors in on a win
+def simulate_battle(state: CompactState, rng: random.Random, attacker: int, target: int) -> bool:
+    troops = state.troops
+    while troops[attacker] > 1 and troops[target] > 0:
+        attackers_lost, defenders_lost = sample_roll(rng, min(3, troops[attacker] - 1), min(2, troops[target]))
+        troops[attacker] -= attackers_lost
+        troops[target] -= defenders_lost
+    if troops[target] > 0:
+        return False
+    state.apply_move((CONQUER, attacker, target, troops[attacker] - 1))
+    return True
+
+
+# A quick stand-in for a player's attack phase: keep making the attack with the best troop ratio
+def simulate_attacks(state: CompactState, index: MapIndex, rng: random.Random, player: int, min_ratio: float, max_attacks: int):
+    occupier = state.occupier
+    troops = state.troops
+    for _ in range(max_attacks):
+        best: Optional[tuple[int, int]] = None
+        best_ratio = min_ratio
+        for territory in index.territories:
+            if occupier[territory] != player or troops[territory] < 3:
+                continue
+            for target in index.neighbours[territory]:
+                if occupier[target] != player and (troops[territory] - 1)/troops[target] > best_ratio:
+                    best = (territory, target)
+                    best_ratio = (troops[territory] - 1)/troops[target]
+        if best is None:
+            return
+        simulate_battle(state, rng, best[0], best[1])
+
+
+# A quick stand-in for every opponent's next turn: reinforce their largest army and attack, as
+# boldly and as often as the opponent model says they usually do
+def simulate_enemy_turns(state: CompactState, index: MapIndex, rng: random.Random, model: Optional[OpponentModel] = None):
+    occupier = state.occupier
+    troops = state.troops
+    for player in sorted(set(occupier) - {state.me, NO_OCCUPIER}):
+        owned = [territory for territory in index.territories if occupier[territory] == player]
+        if len(owned) == 0:
+            continue
+        reinforcements = max(3, len(owned)//3)
+        if state.cards[player] >= 5:
+            reinforcements += card_set_value(state.card_sets_redeemed)
+            state.card_sets_redeemed += 1
+            state.cards[player] -= 3
+        strongest = max(owned, key=lambda territory: troops[territory])
+        troops[strongest] += reinforcements
+        if model is not None and player in model.players:
+            stats = model.players[player]
+            simulate_attacks(state, index, rng, player, min(4.0, max(1.0, stats.min_attack_ratio)), min(6, round(stats.battles_per_turn)))
+        else:
+            simulate_attacks(state, index, rng, player, 1.5, 3)
+
+
+def evaluate_position(state: CompactState, index: MapIndex) -> float:
+    """How good the board looks for us: territories held, continents held, troops, and how much of
+    our border is outnumbered by the enemy next to it."""
+    occupier = state.occupier
+    troops = state.troops
+    my_mask = 0
+    my_troops = 0
+    for territory in index.territories:
+        if occupier[territory] == state.me:
+            my_mask |= 1 << territory
+            my_troops += troops[territory]
+    if my_mask == 0:
+        return -100
+
+    continents = sum(index.continent_size[continent] for continent in range(len(index.continent_mask)) if index.continent_mask[continent] and index.continent_mask[continent] & ~my_mask == 0)
+    exposure = 0
+    for territory in territories_in(index.border_mask(my_mask)):
+        strongest_enemy = max((troops[neighbour] for neighbour in index.neighbours[territory] if not (my_mask >> neighbour) & 1), default=0)
+        exposure += max(0, strongest_enemy - troops[territory])
+    return my_mask.bit_count() + 0.5*continents + 0.05*my_troops - 0.1*exposure
+
+
+# What the value model sees of a position, from our side. Shares are of the whole board, and
+# the enemy features are for whichever enemy is strongest on each.
+POSITION_FEATURES = [
+    "territory_share", "troop_share", "continent_bonus_share", "best_continent_progress", "continents_nearly_held",
+    "exposure", "border_share", "cards", "card_sets_redeemed", "next_set_value", "troops_to_place",
+    "enemy_territory_share", "enemy_troop_share", "enemy_continent_bonus_share", "enemies_alive", "enemy_cards",
+]
+
+
+def position_features(state: CompactState, index: MapIndex) -> list[float]:
+    occupier = state.occupier
+    troops = state.troops
+    me = state.me
+    players = len(state.cards)
+    owned = [0]*players
+    army = [0]*players
+    for territory in index.territories:
+        player = occupier[territory]
+        if player != NO_OCCUPIER:
+            owned[player] |= 1 << territory
+            army[player] += troops[territory]
+    my_mask = owned[me]
+    territory_count = len(index.territories)
+    troop_count = max(1, sum(army))
+    bonus_count = max(1, sum(index.continent_bonus))
+
+    # Continent bonuses held by each player, and how close we are to the continents we don't hold
+    held_bonus = [0]*players
+    best_progress = 0.0
+    nearly_held = 0
+    for continent, mask in enumerate(index.continent_mask):
+        if mask == 0:
+            continue
+        owner = occupier[(mask & -mask).bit_length() - 1]
+        if owner != NO_OCCUPIER and owned[owner] & mask == mask:
+            held_bonus[owner] += index.continent_bonus[continent]
+        if mask & ~my_mask:
+            best_progress = max(best_progress, (mask & my_mask).bit_count()/index.continent_size[continent])
+            nearly_held += (mask & ~my_mask).bit_count() <= 2
+
+    border = index.border_mask(my_mask)
+    exposure = 0
+    for territory in territories_in(border):
+        exposure += max(0, max((troops[neighbour] for neighbour in index.neighbours[territory] if not (my_mask >> neighbour) & 1), default=0) - troops[territory])
+
+    enemies = [player for player in range(players) if player != me and owned[player]]
+    return [
+        my_mask.bit_count()/territory_count,
+        army[me]/troop_count,
+        held_bonus[me]/bonus_count,
+        best_progress,
+        nearly_held/len(index.continent_mask),
+        exposure/troop_count,
+        border.bit_count()/max(1, my_mask.bit_count()),
+        state.cards[me]/5,
+        state.card_sets_redeemed/10,
+        card_set_value(state.card_sets_redeemed)/troop_count,
+        state.troops_remaining[me]/troop_count,
+        max((owned[player].bit_count() for player in enemies), default=0)/territory_count,
+        max((army[player] for player in enemies), default=0)/troop_count,
+        max((held_bonus[player] for player in enemies), default=0)/bonus_count,
+        len(enemies)/max(1, players - 1),
+        max((state.cards[player] for player in enemies), default=0)/5,
+    ]
+
+
+# The value model is off unless RISK_VALUE_MODEL names a file written by train_value.py, and search
+# rollouts are scored by evaluate_position until then.
+VALUE_MODEL_PATH = os.environ.get("RISK_VALUE_MODEL")
+
+
+class ValueModel():
+    """Our chance of winning from a position, learned by train_value.py from the outcomes of
+    self-play games. The features are standardised, go through one layer of tanh units (none for a
+    linear model) and then a logistic output. Positions are scored a batch at a time, working down
+    one column of the batch for each weight."""
+
+    def __init__(self, weights: dict):
+        self.mean: list[float] = weights["mean"]
+        self.scale: list[float] = weights["scale"]
+        self.hidden: list[list[float]] = weights["hidden"]
+        self.hidden_bias: list[float] = weights["hidden_bias"]
+        self.output: list[float] = weights["output"]
+        self.output_bias: float = weights["output_bias"]
+
+    # A model trained on other features is no use, so it isn't loaded
+    @staticmethod
+    def load(path: str) -> Optional['ValueModel']:
+        try:
+            with open(path) as file:
+                weights = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if weights.get("features") != POSITION_FEATURES:
+            return None
+        return ValueModel(weights)
+
+    def save(self, path: str):
+        with open(path, "w") as file:
+            json.dump({"features": POSITION_FEATURES, "mean": self.mean, "scale": self.scale, "hidden": self.hidden,
+                       "hidden_bias": self.hidden_bias, "output": self.output, "output_bias": self.output_bias}, file)
+
+    def predict(self, rows: list[list[float]]) -> list[float]:
+        count = len(rows)
+        columns = [[(row[i] - mean)/scale for row in rows] for i, (mean, scale) in enumerate(zip(self.mean, self.scale))]
+        if self.hidden:
+            columns = [[math.tanh(value + bias) for value in weighted_sum(columns, weights, count)] for weights, bias in zip(self.hidden, self.hidden_bias)]
+        return [0.5 + 0.5*math.tanh(0.5*(value + self.output_bias)) for value in weighted_sum(columns, self.output, count)]
+
+
+value_model: Optional[ValueModel] = None
+value_model_loaded = False
+
+
+def get_value_model() -> Optional[ValueModel]:
+    global value_model, value_model_loaded
+    if not value_model_loaded:
+        with shared_data_lock:
+            if not value_model_loaded:
+                if VALUE_MODEL_PATH is not None:
+                    value_model = ValueModel.load(VALUE_MODEL_PATH)
+                value_model_loaded = True
+    return value_model
+
+
+# Scores for a batch of searched positions, in territories: the model's chance of winning from
+# each times the size of the map, or the hand-written evaluation when there is no model.
+def evaluate_positions(states: list[CompactState], index: MapIndex, model: Optional[ValueModel]) -> list[float]:
+    if model is None:
+        return [evaluate_position(state, index) for state in states]
+    return [len(index.territories)*value for value in model.predict([position_features(state, index) for state in states])]
+
+
+@instrumented("anytime_search")
+def anytime_search(state: CompactState, candidates: list[Callable[[CompactState, random.Random], None]], rollout: Callable[[CompactState, random.Random], None], evaluate: Callable[[list[CompactState]], list[float]], budget: Budget, rng: random.Random) -> Optional[int]:
+    """Plays out random continuations after each candidate move until the budget runs out, sharing
+    the rollouts between candidates with UCB1, and returns the candidate with the best average.
+    The first rollout of every candidate is evaluated in one batch. Returns None if there wasn't
+    time to try every candidate at least once."""
+    first_rollouts = []
+    for candidate in candidates:
+        if budget.expired():
+            return None
+        simulated = state.copy()
+        candidate(simulated, rng)
+        rollout(simulated, rng)
+        first_rollouts.append(simulated)
+    totals = evaluate(first_rollouts)
+    visits = [1]*len(candidates)
+    rollouts = len(candidates)
+
+    while not budget.expired():
+        choice = max(range(len(candidates)), key=lambda i: totals[i]/visits[i] + 2*math.sqrt(math.log(rollouts)/visits[i]))
+        simulated = state.copy()
+        candidates[choice](simulated, rng)
+        rollout(simulated, rng)
+        totals[choice] += evaluate([simulated])[0]
+        visits[choice] += 1
+        rollouts += 1
+    return max(range(len(candidates)), key=lambda i: totals[i]/visits[i])
+
+
+class PredictedGame():
+    """Stands in for the Game while a query is answered ahead of time. The state is a copy of the
+    parts of game.state the handlers read, and the move methods give back the name and arguments
+    of the move, to be made on the real game if the answer gets used."""
+
+    def __init__(self, game: Game):
+        state = game.state
+        self.state = SimpleNamespace(
+            map=state.map,
+            me=SimpleNamespace(player_id=state.me.player_id),
+            players={player: SimpleNamespace(player_id=player, card_count=state.players[player].card_count, troops_remaining=state.players[player].troops_remaining) for player in state.players},
+            card_sets_redeemed=state.card_sets_redeemed,
+            recording=list(state.recording),
+        )
+
+    def move_attack(self, query, attacking_territory: int, defending_territory: int, attacking_troops: int) -> tuple[str, tuple]:
+        return "move_attack", (attacking_territory, defending_territory, attacking_troops)
+
+    def move_attack_pass(self, query) -> tuple[str, tuple]:
+        return "move_attack_pass", ()
+
+
+# Speculative answers are kept by the exact position they would be asked in
+def speculation_key(tracker: StateTracker) -> tuple:
+    return (tracker.ownership_hash, tuple(tracker.troops))
+
+
+class Speculator():
+    """Answers the attack query we expect next on a background thread while the engine deals with
+    our move. Each guess is a copy of the bot state moved on to a position our move could lead to:
+    after an attack, one for each outcome of the roll that leaves the defender standing (most likely
+    first), and after moving in to a conquered territory, the one position it leads to. Those are
+    the moves that wait on another player (the defender) or come right before one, so there is
+    time to use. After our other moves the engine answers at once, and the guess would only be cut
+    short. A handler uses an answer only if the position it is asked about is the one guessed. The
+    next query stops the thread straight away, and a guess it cuts short is dropped."""
+
+    def __init__(self):
+        self.thread: Optional[threading.Thread] = None
+        self.stop = threading.Event()
+
+    # Copies of the bot state at each position our move could lead to
+    def predict(self, game: Game, bot_state: BotState, move: MoveType) -> list[tuple[PredictedGame, BotState]]:
+        if bot_state.tracker is None:
+            return []
+        tracker = bot_state.tracker
+        me = tracker.me
+        guesses: list[StateTracker] = []
+        match move:
+            case MoveAttack():
+                # Assuming the defender rolls as many dice as they can
+                attacker, defender = move.attacking_territory, move.defending_territory
+                for attackers_lost, defenders_lost, _ in sorted(ROLL_OUTCOMES[(min(3, move.attacking_troops), min(2, tracker.troops[defender]))], key=lambda outcome: -outcome[2]):
+                    if tracker.troops[defender] - defenders_lost > 0:
+                        guess = tracker.copy()
+                        guess.set_territory(attacker, me, guess.troops[attacker] - attackers_lost)
+                        guess.set_territory(defender, guess.occupier[defender], guess.troops[defender] - defenders_lost)
+                        guesses.append(guess)
+            case MoveTroopsAfterAttack():
+                move_attack = cast(MoveAttack, game.state.recording[cast(RecordAttack, game.state.recording[move.record_attack_id]).move_attack_id])
+                guess = tracker.copy()
+                guess.set_territory(move_attack.attacking_territory, me, guess.troops[move_attack.attacking_territory] - move.troop_count)
+                guess.set_territory(move_attack.defending_territory, me, guess.troops[move_attack.defending_territory] + move.troop_count)
+                guesses.append(guess)
+        if not guesses:
+            return []
+
+        predicted = PredictedGame(game)
+        speculations = []
+        for guess in guesses:
+            speculative_state = copy.copy(bot_state)
+            speculative_state.tracker = guess
+            speculative_state.threat_map = None
+            speculative_state.attack_plan = copy.copy(bot_state.attack_plan)
+            speculative_state.rng = random.Random(bot_state.rng.getrandbits(64))
+            speculative_state.stop = self.stop
+            speculative_state.speculations = {}
+            speculations.append((predicted, speculative_state))
+        return speculations
+
+    def start(self, bot_state: BotState, speculations: list[tuple[PredictedGame, BotState]]):
+        bot_state.speculations = {}
+        if not speculations:
+            return
+        self.stop.clear()
+        self.thread = threading.Thread(target=self.run, args=(bot_state.speculations, speculations), daemon=True)
+        self.thread.start()
+
+    def run(self, answers: dict, speculations: list[tuple[PredictedGame, BotState]]):
+        for predicted, speculative_state in speculations:
+            speculative_state.query_started = speculative_state.clock()
+            answer = cast(tuple[str, tuple], handle_attack(cast(Game, predicted), speculative_state, None))  # type: ignore[arg-type]
+            if self.stop.is_set():
+                return
+            answers[speculation_key(cast(StateTracker, speculative_state.tracker))] = (*answer, speculative_state)
+
+    def finish(self):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+
+# The answer worked out ahead of time for this query, if it is being asked in the position that was
+# guessed. The bot state takes on the attack plan the answer came with.
+def speculated_move(game: Game, bot_state: BotState, query, tracker: StateTracker) -> Optional[MoveType]:
+    if not bot_state.speculations:
+        return None
+    speculation = bot_state.speculations.get(speculation_key(tracker))
+    bot_state.speculations = {}
+    if speculation is None:
+        return None
+    method, arguments, speculative_state = speculation
+    bot_state.attack_plan = speculative_state.attack_plan
+    return getattr(game, method)(query, *arguments)
+
+
+# Replays are off unless RISK_REPLAY names a directory to write them to, one file per game.
+REPLAY_DIRECTORY = os.environ.get("RISK_REPLAY")
+
+# The replay file layout, see ReplayRecorder. Everything is little endian.
+REPLAY_MAGIC = b"RKRP"
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("<4sHBBH")   # magic, version, me, players, territories (largest id + 1)
+REPLAY_BLOCK = struct.Struct("<BIHHI")     # flags, first entry, entries, first turn, payload bytes
+REPLAY_ENTRY = struct.Struct("<HIBHHI")    # turn, recording length, query, card sets redeemed, territories changed, details bytes
+REPLAY_TERRITORY = struct.Struct("<HbI")   # territory, occupier (-1 for nobody), troops
+REPLAY_INDEX = struct.Struct("<IHQ")       # first entry, first turn and file offset of each block
+REPLAY_TRAILER = struct.Struct("<QI4s")    # index offset, blocks, index magic
+REPLAY_INDEX_MAGIC = b"RKRI"
+REPLAY_COMPRESSED = 1
+REPLAY_BLOCK_ENTRIES = 64
+REPLAY_QUERIES = [
+    "QueryClaimTerritory", "QueryPlaceInitialTroop", "QueryRedeemCards", "QueryDistributeTroops",
+    "QueryAttack", "QueryTroopsAfterAttack", "QueryDefend", "QueryFortify",
+]
+REPLAY_UNKNOWN_QUERY = 255
+
+
+# Queries, records and moves go into replays as JSON: objects as their type and fields, and
+# dictionaries as lists of pairs since JSON only has string keys.
+def replay_encode(value):
+    if isinstance(value, dict):
+        return {"items": [[replay_encode(key), replay_encode(item)] for key, item in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [replay_encode(item) for item in value]
+    if hasattr(value, "__dict__"):
+        return {"type": type(value).__name__, "fields": {name: replay_encode(field) for name, field in vars(value).items() if not name.startswith("_")}}
+    return value
+
+
+class ReplayRecorder():
+    """Writes down every query we are asked, what changed since the query before and the move we
+    answered with, so games can be looked at afterwards with replay.py. The file is a header and
+    then blocks of entries, each compressed with zlib unless compression is off. The first entry
+    of a block lists every territory, the players and our cards, and the rest only what changed,
+    so a block can be read without the ones before it. The records added to the recording since
+    the query before go in with each entry. When the game is over an index of the blocks by entry
+    and turn is added at the end. Turns are ours, counted at each turn_started distribution."""
+
+    def __init__(self, path: str, compress: bool = True, block_entries: int = REPLAY_BLOCK_ENTRIES):
+        self.file = open(path, "wb")
+        self.compress = compress
+        self.block_entries = block_entries
+        self.occupier: list[int] = []
+        self.troops: list[int] = []
+        self.players: Optional[list] = None
+        self.cards: Optional[list] = None
+        self.recording_seen = 0
+        self.turn = 0
+        self.entries = 0
+        self.block = bytearray()
+        self.block_size = 0
+        self.block_first_entry = 0
+        self.block_first_turn = 0
+        self.index: list[tuple[int, int, int]] = []
+
+    def add(self, game: Game, query, move):
+        state = game.state
+        if self.entries == 0:
+            size = max(state.territories) + 1
+            self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, state.me.player_id, len(state.players), size))
+            self.occupier = [0]*size
+            self.troops = [0]*size
+        # The simulator has its own query classes, so queries are told apart by name
+        name = type(query).__name__
+        if name == "QueryDistributeTroops" and query.cause == "turn_started":
+            self.turn += 1
+
+        # A new block starts from nothing, so everything counts as changed
+        if self.block_size == 0:
+            self.block_first_entry = self.entries
+            self.block_first_turn = self.turn
+            self.occupier = [-2]*len(self.occupier)
+            self.players = None
+            self.cards = None
+
+        changed = bytearray()
+        changes = 0
+        for territory, model in state.territories.items():
+            occupier = -1 if model.occupier is None else model.occupier
+            if occupier != self.occupier[territory] or model.troops != self.troops[territory]:
+                self.occupier[territory] = occupier
+                self.troops[territory] = model.troops
+                changed += REPLAY_TERRITORY.pack(territory, occupier, model.troops)
+                changes += 1
+
+        recording = state.recording
+        details = {
+            "query": replay_encode(query),
+            "move": replay_encode(move),
+            "records": [replay_encode(record) for record in recording[self.recording_seen:]],
+        }
+        self.recording_seen = len(recording)
+        players = [[player.player_id, player.troops_remaining, player.alive, player.card_count, list(player.must_place_territory_bonus)] for _, player in sorted(state.players.items())]
+        if players != self.players:
+            details["players"] = self.players = players
+        cards = [[card.card_id, card.territory_id, card.symbol] for card in state.me.cards]
+        if cards != self.cards:
+            details["cards"] = self.cards = cards
+        encoded = json.dumps(details, separators=(",", ":")).encode()
+
+        kind = REPLAY_QUERIES.index(name) if name in REPLAY_QUERIES else REPLAY_UNKNOWN_QUERY
+        self.block += REPLAY_ENTRY.pack(self.turn, len(recording), kind, state.card_sets_redeemed, changes, len(encoded))
+        self.block += changed
+        self.block += encoded
+        self.block_size += 1
+        self.entries += 1
+        if self.block_size >= self.block_entries:
+            self.flush()
+
+    # Blocks are written out as soon as they fill up, so a game cut short loses at most one block
+    def flush(self):
+        if self.block_size == 0:
+            return
+        payload = zlib.compress(bytes(self.block), 1) if self.compress else bytes(self.block)
+        self.index.append((self.block_first_entry, self.block_first_turn, self.file.tell()))
+        self.file.write(REPLAY_BLOCK.pack(REPLAY_COMPRESSED if self.compress else 0, self.block_first_entry, self.block_size, self.block_first_turn, len(payload)))
+        self.file.write(payload)
+        self.file.flush()
+        self.block = bytearray()
+        self.block_size = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        if self.entries > 0:
+            index_offset = self.file.tell()
+            for entry in self.index:
+                self.file.write(REPLAY_INDEX.pack(*entry))
+            self.file.write(REPLAY_TRAILER.pack(index_offset, len(self.index), REPLAY_INDEX_MAGIC))
+        self.file.close()
 
 
 def main():
     
+    # The battle odds table and value model are loaded (or computed) up front so no query pays for them.
+    get_battle_odds()
+    get_value_model()
+
+    # The speculation thread runs while we wait on the engine, and a query arriving should get the
+    # interpreter back from it quickly
+    speculator = Speculator()
+    sys.setswitchinterval(0.0005)
+
+    # With profiling on, the summary is written out when the engine shuts us down, and so is the
+    # end of the replay when replays are on.
+    if PROFILER is not None and PROFILE_PATH is not None:
+        atexit.register(PROFILER.dump, PROFILE_PATH)
+    recorder: Optional[ReplayRecorder] = None
+    if REPLAY_DIRECTORY is not None:
+        recorder = ReplayRecorder(os.path.join(REPLAY_DIRECTORY, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.replay"))
+        atexit.register(recorder.close)
+    if PROFILER is not None or recorder is not None:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     # Get the game object, which will connect you to the engine and
     # track the state of the game.
     game = Game()
@@ -44,6 +1990,8 @@ def main():
 
         # Get the engine's query (this will block until you receive a query).
         query = game.get_next_query()
+        bot_state.query_started = bot_state.clock()
+        speculator.finish()
 
         # Based on the type of query, respond with the correct move.
         def choose_move(query: QueryType) -> MoveType:
@@ -72,103 +2020,101 @@ def main():
                 case QueryFortify() as q:
                     return handle_fortify(game, bot_state, q)
         
-        # Send the move to the engine.
-        game.send_move(choose_move(query))
+        # Send the move to the engine, then work on the next query while waiting for it.
+        move = choose_move(query)
+        speculations = speculator.predict(game, bot_state, move)
+        game.send_move(move)
+        if recorder is not None:
+            recorder.add(game, query, move)
+        speculator.start(bot_state, speculations)
     
+@instrumented("QueryClaimTerritory")
 def handle_claim_territory(game: Game, bot_state: BotState, query: QueryClaimTerritory) -> MoveClaimTerritory:
     """At the start of the game, you can claim a single unclaimed territory every turn 
     until all the territories have been claimed by players."""
     
     # General information used
-    unclaimed_territories = game.state.get_territories_owned_by(None)
-    my_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-    all_territories = [territory for territory in game.state.territories]
-    enemy_territories = list((set(all_territories) - set(unclaimed_territories)) - set(my_territories))
-    adjacent_territories = game.state.get_all_adjacent_territories(my_territories)
-    continents = game.state.map.get_continents()
+    index = get_map_index(game, bot_state)
+    tracker = get_tracker(game, bot_state)
+
+    # Positions that come up often are answered straight from the opening book
+    selected_territory = get_opening_book(game, bot_state).lookup(tracker.position_hash)
+    if selected_territory is not None and (tracker.unclaimed_mask >> selected_territory) & 1:
+        return game.move_claim_territory(query, selected_territory)
+
+    unclaimed_territories = territories_in(tracker.unclaimed_mask)
+    my_mask = tracker.my_mask
+    my_territory_count = my_mask.bit_count()
+    enemy_mask = tracker.enemy_mask
+    adjacent_mask = index.adjacent_mask(my_mask) & ~my_mask
+    player_masks = [tracker.owned_mask[player] for player in game.state.players]
+    enemy_distance = index.distances_from(enemy_mask, index.all_mask & ~my_mask)
 
     # Gives number of friendly territories adjacent 
+    @instrumented("claim_territory.count_adjacent_friendly")
     def count_adjacent_friendly(territory: int) -> int:
-        return len(set(my_territories) & set(game.state.map.get_adjacent_to(territory)))
+        return (index.neighbour_mask[territory] & my_mask).bit_count()
     
     # Gives the proportion of a continent owned by you that the territory is from
+    @instrumented("claim_territory.proportion_continent_of_territory")
     def proportion_continent_of_territory(territory: int) -> float:
-        for continent in continents:
-            if territory in continents[continent]:
-                return len(set(my_territories) & set(continents[continent]))/len(continents[continent])
-        else:
-            return 0
+        return tracker.continent_proportion(territory, tracker.me)
 
     # Returns 1 or 0 whether the territory will break an enemy continent
+    @instrumented("claim_territory.almost_completed_enemy_continent")
     def almost_completed_enemy_continent(territory: int) -> int:
-        for continent in continents:
-            if territory in continents[continent]:
-                for player in game.state.players:
-                    if len(set(continents[continent]) & set(game.state.get_territories_owned_by(player))) == len(continents[continent]) - 1:
-                        return 1
-        else:
-            return 0
+        continent = index.continent_of[territory]
+        for player_mask in player_masks:
+            if (index.continent_mask[continent] & player_mask).bit_count() == index.continent_size[continent] - 1:
+                return 1
+        return 0
         
     # Gives the proportion of a continent owned by enemies that the territory is from
+    @instrumented("claim_territory.proportion_of_enemy_competing_continent")
     def proportion_of_enemy_competing_continent(territory: int) -> float:
-        for continent in continents:
-            if territory in continents[continent]:
-                return len((set(continents[continent]) - (set(my_territories))) - set(unclaimed_territories))/len(continents[continent]) 
+        return index.continent_proportion(territory, enemy_mask)
 
     # Gives from 0 to 3 based on how close the nearest enemy territory is, 3 being highest        
+    @instrumented("claim_territory.aggresively_guarding")
     def aggresively_guarding(territory: int) -> float:
-        edges_to_enemy = 0
-        if territory in adjacent_territories:
-            next_edges = list(set(game.state.map.get_adjacent_to(territory)) - set(my_territories))
-            checked_edges = [territory]
-            while (len(next_edges) != 0):
-                edges_to_enemy += 1
-                if len(set(enemy_territories) & set(next_edges)) > 0:
-                    return 1/edges_to_enemy
-                else:
-                    checked_edges.extend(next_edges)
-                    next_edges = list((set(game.state.get_all_adjacent_territories(next_edges)) - set(my_territories)) - set(checked_edges))
-            return 0
-        else:
-            return 0
+        if adjacent_mask & (1 << territory) and enemy_distance[territory] not in (0, UNREACHABLE):
+            return 1/enemy_distance[territory]
+        return 0
     
     # Favouring specific continents
+    @instrumented("claim_territory.favourable_continent")
     def favourable_continent(territory: int) -> float:
-        continent_weightings = [0.7, 0.5, 0.5, 0.8, 0.8, 0.7]
-        for continent in continents:
-            if territory in continents[continent]:
-                return continent_weightings[continent]
-        return 0
+        continent_weightings = cast(list[float], bot_state.parameters["claim.continent_weightings"])
+        return continent_weightings[index.continent_of[territory]]
 
     # Claiming territories that are sealed so that enemies do not take it 
+    @instrumented("claim_territory.enclose")
     def enclose(territory: int) -> int:
-        if (set(game.state.map.get_adjacent_to(territory)) & set(my_territories)) == set(game.state.map.get_adjacent_to(territory)):
+        if index.neighbour_mask[territory] & ~my_mask == 0:
             return 1
         else: 
             return 0
         
-    # For weightings
-    territory_weights = defaultdict(lambda: 0.0)
-
     # Coefficients for weightings
-    adjacent = 2
-    same_continent = 6
-    swap_continent = 0.05
-    break_continent = 2
-    guarding = 0.6
-    enclose_territory = 5
-    favouring = 1
+    parameters = bot_state.parameters
+    adjacent = parameters["claim.adjacent"]
+    same_continent = parameters["claim.same_continent"]
+    swap_continent = parameters["claim.swap_continent"]
+    break_continent = parameters["claim.break_continent"]
+    guarding = parameters["claim.guarding"]
+    enclose_territory = parameters["claim.enclose_territory"]
+    favouring = parameters["claim.favouring"]
 
     # Calculating each territory weight
-    for territory in unclaimed_territories:
-        territory_weights[territory] = \
-            adjacent*count_adjacent_friendly(territory)*len(my_territories) \
-            + same_continent*proportion_continent_of_territory(territory) \
-            - swap_continent*proportion_of_enemy_competing_continent(territory)*(9 - len(my_territories))**3 \
-            + favouring*favourable_continent(territory) \
-            + break_continent*almost_completed_enemy_continent(territory) \
-            + guarding*aggresively_guarding(territory)*proportion_continent_of_territory(territory)*(9 - len(my_territories)) \
-            + enclose_territory*enclose(territory)
+    territory_weights = score_territories(unclaimed_territories, [
+        lambda territory: count_adjacent_friendly(territory)*my_territory_count,
+        proportion_continent_of_territory,
+        lambda territory: -proportion_of_enemy_competing_continent(territory)*(9 - my_territory_count)**3,
+        favourable_continent,
+        almost_completed_enemy_continent,
+        lambda territory: aggresively_guarding(territory)*proportion_continent_of_territory(territory)*(9 - my_territory_count),
+        enclose,
+    ], [adjacent, same_continent, swap_continent, favouring, break_continent, guarding, enclose_territory])
 
     # Sorting and selecting the territories
     territory_weights = sorted(territory_weights, key=lambda x: territory_weights[x], reverse=True)
@@ -176,68 +2122,61 @@ def handle_claim_territory(game: Game, bot_state: BotState, query: QueryClaimTer
 
     return game.move_claim_territory(query, selected_territory)            
 
+@instrumented("QueryPlaceInitialTroop")
 def handle_place_initial_troop(game: Game, bot_state: BotState, query: QueryPlaceInitialTroop) -> MovePlaceInitialTroop:
     """After all the territories have been claimed, you can place a single troop on one
     of your territories each turn until each player runs out of troops."""
     
     # General information
-    unclaimed_territories = game.state.get_territories_owned_by(None)
-    my_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-    all_territories = [territory for territory in game.state.territories]
-    enemy_territories = list((set(all_territories) - set(unclaimed_territories)) - set(my_territories))
-    continents = game.state.map.get_continents()
-    border_territories = game.state.get_all_border_territories(my_territories)
+    index = get_map_index(game, bot_state)
+    tracker = get_tracker(game, bot_state)
+
+    # Positions that come up often are answered straight from the opening book, as long as every
+    # troop count is small enough to have its own key in the hash
+    if max(tracker.troops) < ZOBRIST_TROOPS - 1:
+        selected_territory = get_opening_book(game, bot_state).lookup(tracker.position_hash)
+        if selected_territory is not None and (tracker.my_mask >> selected_territory) & 1:
+            return game.move_place_initial_troop(query, selected_territory)
+
+    threat = get_threat_map(game, bot_state)
+    troops = tracker.troops
+    my_mask = tracker.my_mask
+    border_territories = territories_in(tracker.border_mask)
 
     # Gives the proportion of a continent owned by you that the territory is from
+    @instrumented("place_initial_troop.proportion_continent_of_territory")
     def proportion_continent_of_territory(territory: int) -> float:
-        for continent in continents:
-            if territory in continents[continent]:
-                return len(set(my_territories) & set(continents[continent]))/len(continents[continent])
-        else:
-            return 0
+        return tracker.continent_proportion(territory, tracker.me)
     
-    # Ratio of enemies near the territory to the number of friendly troops near those enemies
+    # How hard the enemy near the territory presses on it
+    @instrumented("place_initial_troop.difference_number_enemy")
     def difference_number_enemy(territory: int) -> float:
-        adjacent_enemies = list(set(game.state.map.get_adjacent_to(territory)) & set(enemy_territories))
-        adjacent_friendlies = list(set(my_territories) & set(game.state.get_all_adjacent_territories(adjacent_enemies)))
-        friendlies = 0.1
-        for friendly in adjacent_friendlies:
-            friendlies += game.state.territories[friendly].troops - 1
-        adjacent_enemy_troops = 1
-        for adjacent_enemy in adjacent_enemies:
-            adjacent_enemy_troops += game.state.territories[adjacent_enemy].troops - 1
-        return adjacent_enemy_troops/friendlies
+        return threat.pressure(territory)
     
     # Returns the number of adjacent friendly territories
+    @instrumented("place_initial_troop.count_adjacent_friendly")
     def count_adjacent_friendly(territory: int) -> int:
-        return len(set(my_territories) & set(game.state.map.get_adjacent_to(territory)))
+        return (index.neighbour_mask[territory] & my_mask).bit_count()
 
     # This measures how many connected territories there would be with this territory claimed
+    @instrumented("place_initial_troop.favour_territory_groups")
     def favour_territory_groups(territory: int) -> int:
-        if len(set(my_territories) & set(game.state.map.get_adjacent_to(territory))) > 0:
-            blob_territories = []
-            next_edge = list(set(my_territories) & set(game.state.map.get_adjacent_to(territory)))
-            while len(next_edge) != 0:
-                blob_territories.extend(next_edge)
-                next_edge = list((set(game.state.get_all_adjacent_territories(next_edge)) & set(my_territories)) - set(blob_territories))
-            return len(blob_territories)
-        else:
-            return 0
+        return tracker.neighbouring_component_size(territory)
 
-    # For weightings
-    territory_weights = defaultdict(lambda: 0.0)
     # Coefficients for weightings
-    same_continent = 9
-    enemies_close = 1
-    adjacency = 1
-    blobiness = 1
+    parameters = bot_state.parameters
+    same_continent = parameters["place.same_continent"]
+    enemies_close = parameters["place.enemies_close"]
+    adjacency = parameters["place.adjacency"]
+    blobiness = parameters["place.blobiness"]
 
     # Calculating the weight for each border territory
-    for territory in border_territories:
-        territory_weights[territory] = same_continent*proportion_continent_of_territory(territory) \
-            + enemies_close*difference_number_enemy(territory) \
-            + adjacency*count_adjacent_friendly(territory)**0.5 \
-            + blobiness*favour_territory_groups(territory)
+    territory_weights = score_territories(border_territories, [
+        proportion_continent_of_territory,
+        difference_number_enemy,
+        lambda territory: count_adjacent_friendly(territory)**0.5,
+        favour_territory_groups,
+    ], [same_continent, enemies_close, adjacency, blobiness])
 
     # Sorting and selecting the territories
     territory_weights = sorted(territory_weights, key=lambda x: territory_weights[x], reverse=True)
@@ -246,401 +2185,522 @@ def handle_place_initial_troop(game: Game, bot_state: BotState, query: QueryPlac
     return game.move_place_initial_troop(query, selected_territory)
 
 
+@instrumented("QueryRedeemCards")
 def handle_redeem_cards(game: Game, bot_state: BotState, query: QueryRedeemCards) -> MoveRedeemCards:
     """After the claiming and placing initial troops phases are over, you can redeem any
     cards you have at the start of each turn, or after killing another player."""
 
-    # We will always redeem the minimum number of card sets we can until the 5th card set has been redeemed.
-    # This is just an arbitrary choice to try and save our cards for the mid game.
+    index = get_map_index(game, bot_state)
+    tracker = get_tracker(game, bot_state)
+    my_mask = tracker.my_mask
 
     # We always have to redeem enough cards to reduce our card count below five.
-    card_sets: list[Tuple[CardModel, CardModel, CardModel]] = []
-    cards_remaining = game.state.me.cards.copy()
-
-    while len(cards_remaining) >= 5:
-        card_set = game.state.get_card_set(cards_remaining)
-        # According to the pigeonhole principle, we should always be able to make a set
-        # of cards if we have at least 5 cards.
-        assert card_set != None
-        card_sets.append(card_set)
-        cards_remaining = [card for card in cards_remaining if card not in card_set]
-
-    # Remember we can't redeem any more than the required number of card sets if 
-    # we have just eliminated a player.
-    if game.state.card_sets_redeemed > 5 and query.cause == "turn_started":
-        card_set = game.state.get_card_set(cards_remaining)
-        while card_set != None:
-            card_sets.append(card_set)
-            cards_remaining = [card for card in cards_remaining if card not in card_set]
-            card_set = game.state.get_card_set(cards_remaining)
+    cards = sorted(game.state.me.cards, key=lambda card: card.card_id)
+    required = max(0, math.ceil((len(cards) - 4)/3))
+
+    # Beyond that we save our cards for the mid game, until the 5th card set has been redeemed or
+    # a nearly beaten player is within reach, whose cards we would get. Remember we can't redeem
+    # any more than the required number of card sets if we have just eliminated a player.
+    within_reach = index.adjacent_mask(my_mask)
+    eliminating = any(0 < tracker.owned_mask[player].bit_count() <= 3 and tracker.owned_mask[player] & ~within_reach == 0 for player in game.state.players if player != tracker.me)
+    redeem_all = query.cause == "turn_started" and (game.state.card_sets_redeemed > 5 or eliminating)
+
+    # Only one matching territory pays its bonus, so after that we would rather keep wildcards, and
+    # then cards for territories we own, for later redemptions
+    def owned(card: CardModel) -> bool:
+        return card.territory_id is not None and bool((my_mask >> card.territory_id) & 1)
+
+    def value(combination: tuple[tuple[int, int, int], ...]) -> tuple[int, int, int]:
+        used = {i for card_set in combination for i in card_set}
+        bonus = any(owned(cards[i]) for i in used)
+        kept = [cards[i] for i in range(len(cards)) if i not in used]
+        return (bonus, sum(card.symbol == "Wildcard" for card in kept), sum(owned(card) for card in kept))
+
+    options = card_set_combinations(tuple((card.symbol, owned(card)) for card in cards))
+    sets_wanted = max(len(option) for option in options) if redeem_all else required
+    choices = [option for option in options if len(option) == sets_wanted]
+
+    # According to the pigeonhole principle, we should always be able to make a set
+    # of cards if we have at least 5 cards.
+    assert len(choices) > 0
+    best = max(choices, key=value)
+    card_sets = [(cards[a], cards[b], cards[c]) for a, b, c in best]
 
     return game.move_redeem_cards(query, [(x[0].card_id, x[1].card_id, x[2].card_id) for x in card_sets])
 
 
+@instrumented("QueryDistributeTroops")
 def handle_distribute_troops(game: Game, bot_state: BotState, query: QueryDistributeTroops) -> MoveDistributeTroops:
     """After you redeem cards (you may have chosen to not redeem any), you need to distribute
     all the troops you have available across your territories. This can happen at the start of
     your turn or after killing another player.
     """
     # General information
-    unclaimed_territories = game.state.get_territories_owned_by(None)
-    my_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-    all_territories = [territory for territory in game.state.territories]
-    enemy_territories = list((set(all_territories) - set(unclaimed_territories)) - set(my_territories))
-    continents = game.state.map.get_continents()
-    border_territories = game.state.get_all_border_territories(my_territories)
+    index = get_map_index(game, bot_state)
+    tracker = get_tracker(game, bot_state)
+    threat = get_threat_map(game, bot_state)
+    opponents = get_opponent_model(game, bot_state)
+    troops = tracker.troops
+    my_mask = tracker.my_mask
+    border_territories = territories_in(tracker.border_mask)
+
+    # A new round of attacks is coming, so any old plan is out of date
+    bot_state.attack_plan = None
 
     # Troop distribution setup
     total_troops = game.state.me.troops_remaining
     distributions = defaultdict(lambda: 0)
 
-    # Place troops from territory bonus
-    if len(game.state.me.must_place_territory_bonus) != 0:
+    # Place troops from territory bonuses
+    for territory in game.state.me.must_place_territory_bonus:
         assert total_troops >= 2
-        distributions[game.state.me.must_place_territory_bonus[0]] += 2
+        distributions[territory] += 2
         total_troops -= 2
 
     # Gives the proportion of a continent owned by you that the territory is from
+    @instrumented("distribute_troops.proportion_continent_of_territory")
     def proportion_continent_of_territory(territory: int) -> float:
-        for continent in continents:
-            if territory in continents[continent]:
-                return len(set(my_territories) & set(continents[continent]))/len(continents[continent])
-        else:
-            return 0
+        return tracker.continent_proportion(territory, tracker.me)
     
-    # Provides a ratio between nearby friendly and enemy troops except returns 0 when is deemed to difficult to defend
+    # How hard the enemy near the territory presses on it, except returns 0 when even all our troops
+    # wouldn't be enough to defend it
+    @instrumented("distribute_troops.difference_number_enemy")
     def difference_number_enemy(territory: int) -> float:
-        adjacent_enemies = list(set(game.state.map.get_adjacent_to(territory)) & set(enemy_territories))
-        adjacent_friendlies = list(set(my_territories) & set(game.state.get_all_adjacent_territories(adjacent_enemies)))
-        friendlies = 1
-        for friendly in adjacent_friendlies:
-            friendlies += game.state.territories[friendly].troops
-        adjacent_enemy_troops = 0
-        for adjacent_enemy in adjacent_enemies:
-            adjacent_enemy_troops += game.state.territories[adjacent_enemy].troops - 1
-        if (adjacent_enemy_troops/(friendlies + total_troops)) > 1.5:
+        if threat.pressure(territory, total_troops) > 1.5:
             return 0
-        return adjacent_enemy_troops/friendlies
+        return threat.pressure(territory)*aggression_near(territory)
+
+    # Neighbours who attack on more of their turns make a territory more worth defending
+    @instrumented("distribute_troops.aggression_near")
+    def aggression_near(territory: int) -> float:
+        return 0.5 + max((opponents.stats(cast(int, tracker.occupier[enemy])).attack_turn_rate for enemy in territories_in(index.neighbour_mask[territory] & tracker.enemy_mask)), default=0.5)
     
     # Returns the number of adjacent friendly territories
+    @instrumented("distribute_troops.count_adjacent_friendly")
     def count_adjacent_friendly(territory: int) -> int:
-        return len(set(my_territories) & set(game.state.map.get_adjacent_to(territory)))
+        return (index.neighbour_mask[territory] & my_mask).bit_count()
 
     # This measures how many connected territories there would be with this territory claimed
+    @instrumented("distribute_troops.favour_territory_groups")
     def favour_territory_groups(territory: int) -> int:
-        if len(list(set(my_territories) & set(game.state.map.get_adjacent_to(territory)))) > 0:
-            blob_territories = []
-            next_edge = list(set(my_territories) & set(game.state.map.get_adjacent_to(territory)))
-            while len(next_edge) != 0:
-                blob_territories.extend(next_edge)
-                next_edge = list((set(game.state.get_all_adjacent_territories(next_edge)) & set(my_territories)) - set(blob_territories))
-            return len(blob_territories)
-        else:
-            return 0
+        return tracker.neighbouring_component_size(territory)
     
     # Gives more weight to already large armies
+    @instrumented("distribute_troops.prioritise_large_army")
     def prioritise_large_army(territory: int) -> int:
-        return game.state.territories[territory].troops
+        return troops[territory]
 
     # Coefficients for weightings
-    territory_weights = defaultdict(lambda: 0.0)
-    same_continent = 7
-    same_continent2 = 4
-    adjacency = 1
-    blobiness = 2
-    troopiness = 0.1
+    parameters = bot_state.parameters
+    same_continent = parameters["distribute.same_continent"]
+    same_continent2 = parameters["distribute.same_continent2"]
+    adjacency = parameters["distribute.adjacency"]
+    blobiness = parameters["distribute.blobiness"]
+    troopiness = parameters["distribute.troopiness"]
 
     # Calculating weights for each territory
-    for territory in border_territories:
-        territory_weights[territory] = same_continent*proportion_continent_of_territory(territory)*difference_number_enemy(territory) \
-            + same_continent2*proportion_continent_of_territory(territory)\
-            + adjacency*count_adjacent_friendly(territory)**0.5 \
-            + blobiness*favour_territory_groups(territory)\
-            + troopiness*prioritise_large_army(territory)
-
-    # Matching the weighting distribution to the troop distribution
-    total_weight = sum([territory_weights[territory] for territory in territory_weights])
-    leftover = total_troops
-    for territory in border_territories:
-        distributions[territory] += math.floor((territory_weights[territory]/total_weight)*total_troops)
-        leftover -= math.floor((territory_weights[territory]/total_weight)*total_troops)
-    distributions[border_territories[0]] += leftover
+    territory_weights = score_territories(border_territories, [
+        lambda territory: proportion_continent_of_territory(territory)*difference_number_enemy(territory),
+        proportion_continent_of_territory,
+        lambda territory: count_adjacent_friendly(territory)**0.5,
+        favour_territory_groups,
+        prioritise_large_army,
+    ], [same_continent, same_continent2, adjacency, blobiness, troopiness])
+
+    # Each troop on a territory is worth its weight shared out over the troops there (so troops are
+    # spread roughly in proportion to the weights), plus how much it lowers the chance of losing
+    # the territory to its strongest neighbour, plus how much it raises the chance of taking the
+    # weakest one. The odds terms are capped by the previous troop's gain to keep each territory's
+    # gains shrinking, so the greedy allocation stays optimal.
+    odds = get_battle_odds()
+    defence = parameters["distribute.defence"]
+    offence = parameters["distribute.offence"]
+    required = dict(distributions)
+    last_gain: dict[int, float] = {}
+
+    def marginal_gain(territory: int, placed: int) -> float:
+        defenders = troops[territory] + required.get(territory, 0) + placed
+        gain = max(0, territory_weights.get(territory, 0))/(placed + 1)
+        strongest = threat.strongest_enemy[territory]
+        if strongest > 0:
+            gain += defence*(odds.win_probability(strongest, defenders) - odds.win_probability(strongest, defenders + 1))
+        weakest = min(territories_in(index.neighbour_mask[territory] & tracker.enemy_mask), key=lambda x: troops[x], default=None)
+        if weakest is not None:
+            gain += offence*(odds.win_probability(defenders, troops[weakest]) - odds.win_probability(defenders - 1, troops[weakest]))
+        gain = min(gain, last_gain.get(territory, math.inf))
+        last_gain[territory] = gain
+        return gain
+
+    # With no border left (which only happens when we own everything), anywhere will do
+    candidates = border_territories if len(border_territories) > 0 else territories_in(my_mask)
+    for territory, count in allocate_troops(total_troops, candidates, marginal_gain).items():
+        if count > 0:
+            distributions[territory] += count
+
+    # With time to spare, rollouts compare this spread with stacking everything on one of the best territories
+    budget = query_budget(bot_state)
+    if budget.remaining() > MIN_SEARCH_TIME and len(border_territories) > 1:
+        options = [dict(distributions)]
+        for territory in sorted(border_territories, key=lambda x: territory_weights[x], reverse=True)[:3]:
+            option = defaultdict(lambda: 0, required)
+            option[territory] += total_troops
+            options.append(dict(option))
+
+        def place_then_attack(option: dict[int, int]) -> Callable[[CompactState, random.Random], None]:
+            def play(state: CompactState, rng: random.Random):
+                for territory, count in option.items():
+                    state.apply_move((PLACE_TROOPS, territory, count))
+                simulate_attacks(state, index, rng, state.me, 2, 4)
+            return play
+
+        best = anytime_search(CompactState.from_game(game, tracker), [place_then_attack(option) for option in options], lambda state, rng: simulate_enemy_turns(state, index, rng, opponents), lambda states: evaluate_positions(states, index, bot_state.value_model), budget, bot_state.rng)
+        if best is not None:
+            distributions = options[best]
 
     return game.move_distribute_troops(query, distributions)
 
 
+@instrumented("QueryAttack")
 def handle_attack(game: Game, bot_state: BotState, query: QueryAttack) -> Union[MoveAttack, MoveAttackPass]:
     """After the troop phase of your turn, you may attack any number of times until you decide to
     stop attacking (by passing). After a successful attack, you may move troops into the conquered
     territory. If you eliminated a player you will get a move to redeem cards and then distribute troops."""
     # General information
-    all_territories = [territory for territory in game.state.territories]
-    my_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-    unclaimed_territories = game.state.get_territories_owned_by(None)   
-    enemy_territories = list((set(all_territories) - set(unclaimed_territories)) - set(my_territories))
-    border_territories = game.state.get_all_border_territories(my_territories)
-    bordering_territories = game.state.get_all_adjacent_territories(my_territories)
-    continents = game.state.map.get_continents()
+    index = get_map_index(game, bot_state)
+    tracker = get_tracker(game, bot_state)
+    speculated = speculated_move(game, bot_state, query, tracker)
+    if speculated is not None:
+        return cast(Union[MoveAttack, MoveAttackPass], speculated)
+
+    threat = get_threat_map(game, bot_state)
+    odds = get_battle_odds()
+    opponents = get_opponent_model(game, bot_state)
+    troops = tracker.troops
+    my_mask = tracker.my_mask
+    enemy_mask = tracker.enemy_mask
+    bordering_territories = territories_in(index.adjacent_mask(my_mask) & enemy_mask)
 
     # Finding the troop count for each player
-    all_troop_counts = defaultdict(lambda: 0)
-    for territory in all_territories:
-        all_troop_counts[game.state.territories[territory].occupier] += game.state.territories[territory].troops
+    all_troop_counts = tracker.player_troops
 
     # Finding which players have fewer troops that you and how many cards they have
     enemy_card_counts = defaultdict(lambda: 0)
     enemy_with_cards_lower_troops = []
-    for player in all_troop_counts:
+    for player in game.state.players:
+        if tracker.owned_mask[player] == 0:
+            continue
         if (all_troop_counts[player] != game.state.me.player_id) and (all_troop_counts[player] < all_troop_counts[game.state.me.player_id]):
             enemy_card_counts[player] = game.state.players[player].card_count
             enemy_with_cards_lower_troops.append(player)
 
     # Compares the number of enemy troops in the continent to the number of friendly troops bordering the territory
+    @instrumented("attack.continent_strength")
     def continent_strength(territory: int) -> float:
         strength = 0
-        for continent in continents:
-            if territory in continents[continent]:
-                for region in list(set(continents[continent]) - set(my_territories)):
-                    strength += game.state.territories[region].troops
-        friendly_adjacent = list(set(game.state.map.get_adjacent_to(territory)) & set(my_territories))
-        friendly_adjacent_troops = sum(game.state.territories[x].troops - 1 for x in friendly_adjacent)
+        for region in territories_in(index.continent_mask[index.continent_of[territory]] & ~my_mask):
+            strength += troops[region]
+        friendly_adjacent = territories_in(index.neighbour_mask[territory] & my_mask)
+        friendly_adjacent_troops = sum(troops[x] - 1 for x in friendly_adjacent)
         return friendly_adjacent_troops/strength
 
     # Returns the number of adjacent friendly territories
+    @instrumented("attack.adjacency")
     def adjacency(territory: int) -> int:
-        return len(list(set(my_territories) & set(game.state.map.get_adjacent_to(territory))))
+        return (index.neighbour_mask[territory] & my_mask).bit_count()
 
     # Gives the proportion of a continent owned by you that the territory is from
+    @instrumented("attack.proportion_continent_of_territory")
     def proportion_continent_of_territory(territory: int) -> float:
-        for continent in continents:
-            if territory in continents[continent]:
-                return len(set(my_territories) & set(continents[continent]))/len(continents[continent])
-        else:
-            return 0
+        return index.continent_proportion(territory, my_mask)
     
-    # Provides a ratio between nearby friendly and enemy troops
+    # How hard our troops near the territory press on it
+    @instrumented("attack.troop_comparison")
     def troop_comparison(territory: int) -> float:
-        adjacent_enemies = list((set(game.state.map.get_adjacent_to(territory)) & set(enemy_territories)) | set([territory]))
-        adjacent_friendlies = list((set(my_territories) & set(game.state.get_all_adjacent_territories(adjacent_enemies))))
-        friendlies = 1
-        for friendly in adjacent_friendlies:
-            friendlies += game.state.territories[friendly].troops - 1
-        adjacent_enemy_troops = 1
-        for adjacent_enemy in adjacent_enemies:
-            adjacent_enemy_troops += game.state.territories[adjacent_enemy].troops
-        return friendlies/adjacent_enemy_troops
+        return threat.pressure(territory)
     
     # Determines whether the territory is a choke point 
+    @instrumented("attack.choke_point")
     def choke_point(territory: int) -> int:
-        if territory in choke_points:
+        if choke_mask & (1 << territory):
             return 1
         else:
             return 0
 
     # Determines whether taking this territory would leave a choke point
+    @instrumented("attack.hold_choke_point")
     def hold_choke_point(territory: int) -> int:
-        if (len((set(game.state.map.get_adjacent_to(territory)) & set(choke_points)) & set(my_territories)) > 0):
+        if index.neighbour_mask[territory] & choke_mask & my_mask:
             return 1
         else:
             return 0   
 
     # Gives a weighting for how many cards you could get by eliminating this opponent
+    @instrumented("attack.get_cards")
     def get_cards(territory: int) -> int:
-        if game.state.territories[territory].occupier in enemy_with_cards_lower_troops:
-            return enemy_card_counts[game.state.territories[territory].occupier]
+        if tracker.occupier[territory] in enemy_with_cards_lower_troops:
+            return enemy_card_counts[tracker.occupier[territory]]
         else:
             return 0
     
     # Finds how many vulnerable the attacking army would leave their territory if they took this territory
+    @instrumented("attack.stay_put")
     def stay_put(territory: int) -> int:
-        adjacent_friend = list(set(game.state.map.get_adjacent_to(territory)) & set(my_territories))
-        other_enemies = list(set(game.state.get_all_adjacent_territories(adjacent_friend)) - set([territory]))
-        friend_troops = sum(game.state.territories[territory].troops for territory in adjacent_friend)
-        other_enemy_troops = sum(game.state.territories[territory].troops for territory in other_enemies)
-        return friend_troops - other_enemy_troops
+        return sum(troops[friend] - (threat.enemy_reach[friend] - (troops[territory] - 1)) for friend in territories_in(index.neighbour_mask[territory] & my_mask))
 
-    # Finds how much the size of border territories would change by taking this territory
+    # Finds how much the size of border territories would change by taking this territory. Only the
+    # territory and our neighbours of it can change, and those neighbours are all on the border now.
+    @instrumented("attack.border_size_change")
     def border_size_change(territory: int) -> int:
-        return len(border_territories) - len(game.state.get_all_border_territories(list(set(my_territories) | set([territory]))))
+        grown = my_mask | (1 << territory)
+        friends = territories_in(index.neighbour_mask[territory] & my_mask)
+        still_border = sum(1 for friend in friends if index.neighbour_mask[friend] & ~grown)
+        return len(friends) - still_border - (index.neighbour_mask[territory] & ~grown != 0)
+
+    # How many troops to leave behind on the attacker, so that the enemy next to it who keep
+    # attacking us wouldn't find it worth attacking. Players tend to attack at about their usual
+    # troop ratio, so that many times fewer troops than theirs is enough to put them off.
+    @instrumented("attack.border_garrison")
+    def border_garrison(attacker: int, target: int) -> int:
+        garrison = 0
+        for enemy in territories_in(index.neighbour_mask[attacker] & enemy_mask & ~(1 << target)):
+            stats = opponents.stats(cast(int, tracker.occupier[enemy]))
+            if stats.battles_on_me_per_turn >= garrison_aggression:
+                garrison = max(garrison, math.ceil((troops[enemy] - 1)/max(1.0, stats.attack_ratio)))
+        return garrison
+
+    # Whether the attacker can win with the troops it has to spare beyond its garrison
+    def can_attack(attacker: int, target: int) -> bool:
+        spare = troops[attacker] - 1 - border_garrison(attacker, target)
+        return spare > 0 and odds.win_probability(spare, troops[target]) >= min_win_chance
 
     # Coefficients for weightings
     choke_points = [40, 24, 29, 36, 30, 2, 4, 10, 0, 21]
-    same_continent = 4
-    chokehold = 1.5
-    staychoke = 0.5
-    cardwant = 2
-    adjacencybonus = 0.1
-    borderincrease = 0.5
-    keep_border_safe = 0
-    threshold = 2.5
-    weak_continent = 3.5
-
-    # Calculating weights for each bordering territory 
-    territory_weights = defaultdict(lambda: 0.0)
-    for territory in bordering_territories:
-        territory_weights[territory] = \
-              same_continent*proportion_continent_of_territory(territory)*troop_comparison(territory)\
-            + chokehold*choke_point(territory)*proportion_continent_of_territory(territory)\
-            - staychoke*hold_choke_point(territory)\
-            + cardwant*get_cards(territory)*game.state.card_sets_redeemed\
-            + adjacencybonus*adjacency(territory)\
-            + borderincrease*border_size_change(territory)\
-            + keep_border_safe*stay_put(territory)\
-            + weak_continent*continent_strength(territory)
+    choke_mask = mask_of(choke_points)
+    parameters = bot_state.parameters
+    same_continent = parameters["attack.same_continent"]
+    chokehold = parameters["attack.chokehold"]
+    staychoke = parameters["attack.staychoke"]
+    cardwant = parameters["attack.cardwant"]
+    adjacencybonus = parameters["attack.adjacencybonus"]
+    borderincrease = parameters["attack.borderincrease"]
+    keep_border_safe = parameters["attack.keep_border_safe"]
+    threshold = parameters["attack.threshold"]
+    weak_continent = parameters["attack.weak_continent"]
+    min_win_chance = parameters["attack.min_win_chance"]
+    sweep_bonus = parameters["attack.sweep_bonus"]
+    plan_depth = 4
+    replan_tolerance = parameters["attack.replan_tolerance"]
+    garrison_aggression = parameters["attack.garrison_aggression"]
+
+    # Following the plan made earlier this turn, as long as the battles are going as expected
+    if bot_state.attack_plan is not None:
+        planned_attack = bot_state.attack_plan.next_attack(tracker, odds, min_win_chance, replan_tolerance)
+        if planned_attack is not None:
+            attacker, territory = planned_attack
+            return game.move_attack(query, attacker, territory, min(3, troops[attacker] - 1))
+
+    # Every enemy territory a chain of attacks could reach
+    reachable = index.adjacent_mask(my_mask) & enemy_mask
+    for _ in range(plan_depth - 1):
+        reachable |= index.adjacent_mask(reachable) & enemy_mask
+
+    # Calculating weights for each reachable territory, reusing weights from earlier queries where
+    # nothing near the territory has changed. Besides the board, the weights depend on the cards.
+    cards_key = hash((game.state.card_sets_redeemed, tuple(sorted(enemy_card_counts.items())))) & 0xFFFFFFFFFFFFFFFF
+    bot_state.transpositions.generation = len(game.state.recording) + 1
+    territory_weights = cached_scores(bot_state.transpositions, index, tracker, cards_key, territories_in(reachable), lambda territories: score_territories(territories, [
+        lambda territory: proportion_continent_of_territory(territory)*troop_comparison(territory),
+        lambda territory: choke_point(territory)*proportion_continent_of_territory(territory),
+        lambda territory: -hold_choke_point(territory),
+        lambda territory: get_cards(territory)*game.state.card_sets_redeemed,
+        adjacency,
+        border_size_change,
+        stay_put,
+        continent_strength,
+    ], [same_continent, chokehold, staychoke, cardwant, adjacencybonus, borderincrease, keep_border_safe, weak_continent]))
+
+    # Looking for a chain of conquests worth more than any single attack
+    chosen_attack: Optional[tuple[int, int]] = None
+    bot_state.attack_plan = plan_attacks(index, tracker, odds, territory_weights, min_win_chance, sweep_bonus, plan_depth, threshold)
+    if bot_state.attack_plan is not None:
+        chosen_attack = bot_state.attack_plan.next_attack(tracker, odds, min_win_chance, replan_tolerance)
         
     # Sorting the territories
-    territory_weights_order = sorted(territory_weights, key=lambda x: territory_weights[x], reverse=True)
+    territory_weights_order = sorted(bordering_territories, key=lambda x: territory_weights[x], reverse=True)
 
     # Firsly determining which territories have a weighting that reach the threshold
     for territory in territory_weights_order:
+        if chosen_attack is not None:
+            break
         if territory_weights[territory] > threshold:
             # Using the attacker with the most troops
-            attacking_canditates = sorted(list(set(game.state.map.get_adjacent_to(territory)) & set(my_territories)), key=lambda x: game.state.territories[x].troops, reverse=True)
+            attacking_canditates = sorted(territories_in(index.neighbour_mask[territory] & my_mask), key=lambda x: troops[x], reverse=True)
             attacker = attacking_canditates[0]
             # Instead using an attacker that would otherwise be left in an internal territory
             for potential_attacker in attacking_canditates:
-                if (len(list(set(game.state.map.get_adjacent_to(potential_attacker)) - set(my_territories))) == 1) and (game.state.territories[potential_attacker].troops > 1):
+                if ((index.neighbour_mask[potential_attacker] & ~my_mask).bit_count() == 1) and (troops[potential_attacker] > 1):
                     attacker = potential_attacker
                     break
             
-            if game.state.territories[attacker].troops > 1: 
-                return game.move_attack(query, attacker, territory, min(3, game.state.territories[attacker].troops - 1))
-        else:
-            return game.move_attack_pass(query)   
-
-    return game.move_attack_pass(query)
+            # Falling back to the largest army if the preferred attacker is unlikely to win
+            if not can_attack(attacker, territory):
+                attacker = attacking_canditates[0]
 
+            if can_attack(attacker, territory):
+                chosen_attack = (attacker, territory)
+        else:
+            break
 
+    # With time to spare, rollouts choose between our pick, passing and the other best looking attacks
+    budget = query_budget(bot_state)
+    if budget.remaining() > MIN_SEARCH_TIME:
+        options: list[Optional[tuple[int, int]]] = [chosen_attack, None] if chosen_attack is not None else [None]
+        for territory in territory_weights_order[:3]:
+            attacker = max(territories_in(index.neighbour_mask[territory] & my_mask), key=lambda x: troops[x])
+            if can_attack(attacker, territory) and (attacker, territory) not in options:
+                options.append((attacker, territory))
+
+        def attack_then_continue(attacker: int, territory: int) -> Callable[[CompactState, random.Random], None]:
+            def play(state: CompactState, rng: random.Random):
+                simulate_battle(state, rng, attacker, territory)
+                simulate_attacks(state, index, rng, state.me, 2, 3)
+            return play
+
+        candidates = [attack_then_continue(*option) if option is not None else (lambda state, rng: None) for option in options]
+        opponents = get_opponent_model(game, bot_state)
+        best = anytime_search(CompactState.from_game(game, tracker), candidates, lambda state, rng: simulate_enemy_turns(state, index, rng, opponents), lambda states: evaluate_positions(states, index, bot_state.value_model), budget, bot_state.rng) if len(options) > 1 else None
+        if best is not None and options[best] != chosen_attack:
+            chosen_attack = options[best]
+            bot_state.attack_plan = None
+
+    if chosen_attack is None:
+        return game.move_attack_pass(query)
+    attacker, territory = chosen_attack
+    return game.move_attack(query, attacker, territory, min(3, troops[attacker] - 1))
+
+
+@instrumented("QueryTroopsAfterAttack")
 def handle_troops_after_attack(game: Game, bot_state: BotState, query: QueryTroopsAfterAttack) -> MoveTroopsAfterAttack:
     """After conquering a territory in an attack, you must move troops to the new territory."""
     # General information
-    unclaimed_territories = game.state.get_territories_owned_by(None)
-    my_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-    all_territories = [territory for territory in game.state.territories]
-    enemy_territories = list((set(all_territories) - set(unclaimed_territories)) - set(my_territories))
+    tracker = get_tracker(game, bot_state)
+    troops = tracker.troops
     record_attack = cast(RecordAttack, game.state.recording[query.record_attack_id])
     move_attack = cast(MoveAttack, game.state.recording[record_attack.move_attack_id])
-    continents = game.state.map.get_continents()
 
     # Which territory is attacking and which is defending
     from_territory = move_attack.attacking_territory
     to_territory = move_attack.defending_territory
 
+    # Everything moves forward if the plan attacks again from the new territory
+    if bot_state.attack_plan is not None and bot_state.attack_plan.continues_from(to_territory):
+        return game.move_troops_after_attack(query, troops[from_territory] - 1)
+
     # Finding the ratio of enemies and friendly troops for each territory and then finding the ratio between those ratios. 
     # If the continent largely owned then the troops will be distributed defensively otherwise all troops will go forward                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                    
-    for continent in continents:
-        if (from_territory in continents[continent]) and (len(set(continents[continent]) & set(my_territories))/len(set(continents[continent])) > 0.5):
-
-            adjacent_enemies_from = list(set(game.state.map.get_adjacent_to(from_territory)) & set(enemy_territories))
-            adjacent_friendlies_from = list(set(game.state.map.get_adjacent_to(from_territory)) & set(my_territories) - set([to_territory]))
-            
-            adjacent_enemies_to = list(set(game.state.map.get_adjacent_to(to_territory)) & set(enemy_territories))
-            adjacent_friendlies_to = list((set(game.state.map.get_adjacent_to(to_territory)) & set(my_territories)) - set([from_territory]))
-
-            friendlies_from = 0.1
-            for friendly in adjacent_friendlies_from:
-                friendlies_from += game.state.territories[friendly].troops - 1
-
-            enemies_from = 0.1
-            for adjacent_enemy in adjacent_enemies_from:
-                enemies_from += game.state.territories[adjacent_enemy].troops
-            
-            ratio_from = friendlies_from/enemies_from 
-
-
-            friendlies_to = 0.1
-            for friendly in adjacent_friendlies_to:
-                friendlies_to += game.state.territories[friendly].troops - 1
-
-            enemies_to = 0.1
-            for adjacent_enemy in adjacent_enemies_to:
-                enemies_to += game.state.territories[adjacent_enemy].troops
-            
-            ratio_to = friendlies_to/enemies_to 
-
-            ratio = ratio_from/ratio_to
-            troops_available = game.state.territories[from_territory].troops
-            sending_troops = math.floor((troops_available/(ratio + 1)) * ratio)
-
-            # Need to ensure that the number of troops attacking go to the territory
-            if troops_available < 4:
-                return game.move_troops_after_attack(query, troops_available - 1)
-            return game.move_troops_after_attack(query, max(sending_troops, 3))
-        
-    return game.move_troops_after_attack(query, game.state.territories[from_territory].troops - 1)
-
+    if tracker.continent_proportion(from_territory, tracker.me) > 0.5:
+        # Only the two territories' neighbours matter here, so the whole threat map isn't built
+        support_from, reach_from = tracker.nearby_spare(from_territory)
+        support_to, reach_to = tracker.nearby_spare(to_territory)
+
+        # Each side's support doesn't count the other side of the attack, and the troops are split
+        # in proportion to how hard each side is pressed
+        pressure_from = pressure(reach_from, max(0, support_from - max(0, troops[to_territory] - 1)))
+        pressure_to = pressure(reach_to, max(0, support_to - max(0, troops[from_territory] - 1)))
+        troops_available = troops[from_territory]
+        sending_troops = math.floor(troops_available*pressure_to/(pressure_from + pressure_to))
+
+        # Need to ensure that the number of troops attacking go to the territory
+        if troops_available < 4:
+            return game.move_troops_after_attack(query, troops_available - 1)
+        return game.move_troops_after_attack(query, max(sending_troops, 3))
+
+    return game.move_troops_after_attack(query, troops[from_territory] - 1)
+
+@instrumented("QueryDefend")
 def handle_defend(game: Game, bot_state: BotState, query: QueryDefend) -> MoveDefend:
     """If you are being attacked by another player, you must choose how many troops to defend with."""
-
-    # We will always defend with the most troops that we can.
-
-    # First we need to get the record that describes the attack we are defending against.
     move_attack = cast(MoveAttack, game.state.recording[query.move_attack_id])
-    defending_territory = move_attack.defending_territory
+    attackers = game.state.territories[move_attack.attacking_territory].troops - 1
+    defenders = game.state.territories[move_attack.defending_territory].troops
 
-    # We can only defend with up to 2 troops, and no more than we have stationed on the defending
-    # territory.
-    defending_troops = min(game.state.territories[defending_territory].troops, 2)
-    return game.move_defend(query, defending_troops)
+    # We defend with whichever number of dice gives the best chance of holding the territory, on
+    # the exact odds of this roll and of the rest of the attack after it (two dice when tied)
+    odds = get_battle_odds()
+    defending_dice = max(range(min(2, defenders), 0, -1), key=lambda dice: odds.hold_probability(attackers, move_attack.attacking_troops, defenders, dice))
+    return game.move_defend(query, defending_dice)
 
 
+@instrumented("QueryFortify")
 def handle_fortify(game: Game, bot_state: BotState, query: QueryFortify) -> Union[MoveFortify, MoveFortifyPass]:
     """At the end of your turn, after you have finished attacking, you may move a number of troops between
     any two of your territories (they must be adjacent)."""
     
     # General information
-    my_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-    border_territories = game.state.get_all_border_territories(my_territories)
-    
-    # Will always try to fortify an internal army to the border
-    candidate_territories = list(set(my_territories) - set(border_territories))
-    if len(candidate_territories) == 0:
-        return game.move_fortify_pass(query)
+    tracker = get_tracker(game, bot_state)
+    troops = tracker.troops
+    my_mask = tracker.my_mask
+    border_mask = tracker.border_mask
     
-    # Finding the largest internal army
-    max_troops = game.state.territories[candidate_territories[0]].troops
-    max_territory = candidate_territories[0]
-
-    for territory in candidate_territories:
-        if game.state.territories[territory].troops > max_troops:
-            max_territory = territory
-            max_troops = game.state.territories[territory].troops
-
-    # To find the shortest path, we will use a custom function.
-    shortest_path = find_shortest_path_from_vertex_to_set(game, max_territory, set(border_territories))
-    # We will move our troops along this path (we can only move one step, and we have to leave one troop behind).
-    # We have to check that we can move any troops though, if we can't then we will pass our turn.
-    if len(shortest_path) > 0 and game.state.territories[max_territory].troops > 1:
-        return game.move_fortify(query, shortest_path[0], shortest_path[1], game.state.territories[max_territory].troops - 1)
+    # Each border territory should hold a share of our troops in proportion to the enemy troops
+    # next to it, weighted by the chance of it falling to them next turn, with a single troop left
+    # on each internal territory
+    index = get_map_index(game, bot_state)
+    threat = get_threat_map(game, bot_state)
+    threats = {territory: threat.enemy_reach[territory]*threat.fall_probability[territory] for territory in territories_in(border_mask)}
+    total_threat = sum(threats.values())
+    movable = sum(troops[territory] - 1 for territory in territories_in(my_mask))
+    desired = {territory: 1 + movable*threats.get(territory, 0)/total_threat if total_threat > 0 else 1 for territory in territories_in(my_mask)}
+
+    # Moving the surplus to where it is short, as cheaply as possible over our own territories.
+    # Only one step of one move can be made per turn, so we take the one carrying the most troops
+    # per hop, and the rest of the plan is picked up again on later turns.
+    owned_distances = get_owned_distances(index, tracker, bot_state)
+    supply = {territory: min(troops[territory] - 1, math.floor(troops[territory] - desired[territory])) for territory in territories_in(my_mask)}
+    demand = {territory: math.ceil(desired[territory] - troops[territory]) for territory in territories_in(border_mask)}
+    flows = min_cost_transport(supply, demand, owned_distances.distance)
+
+    chosen_fortify: Optional[tuple[int, int, int]] = None
+    best_rate = 0.0
+    for (source, target), amount in sorted(flows.items()):
+        rate = amount/cast(int, owned_distances.distance(source, target))
+        if rate > best_rate:
+            step = owned_distances.next_hop(source, target)
+            moving = sum(carried for (other, towards), carried in flows.items() if other == source and owned_distances.next_hop(source, towards) == step)
+            chosen_fortify = (source, cast(int, step), moving)
+            best_rate = rate
+
+    # With time to spare, rollouts of the enemy's next turns compare this with passing and with
+    # moving one of our largest armies next to its most outnumbered neighbour
+    budget = query_budget(bot_state)
+    if budget.remaining() > MIN_SEARCH_TIME:
+        def outnumbered_by(territory: int) -> int:
+            return max((troops[neighbour] for neighbour in territories_in(index.neighbour_mask[territory] & ~my_mask)), default=0) - troops[territory]
+
+        options: list[Optional[tuple[int, int, int]]] = [chosen_fortify, None] if chosen_fortify is not None else [None]
+        for source in sorted(territories_in(my_mask), key=lambda x: troops[x], reverse=True)[:3]:
+            targets = territories_in(index.neighbour_mask[source] & my_mask)
+            if troops[source] > 1 and len(targets) > 0:
+                option = (source, max(targets, key=outnumbered_by), troops[source] - 1)
+                if option not in options:
+                    options.append(option)
+
+        def move(option: Optional[tuple[int, int, int]]) -> Callable[[CompactState, random.Random], None]:
+            def play(state: CompactState, rng: random.Random):
+                if option is not None:
+                    state.apply_move((MOVE_TROOPS, *option))
+            return play
+
+        opponents = get_opponent_model(game, bot_state)
+        best = anytime_search(CompactState.from_game(game, tracker), [move(option) for option in options], lambda state, rng: simulate_enemy_turns(state, index, rng, opponents), lambda states: evaluate_positions(states, index, bot_state.value_model), budget, bot_state.rng) if len(options) > 1 else None
+        if best is not None:
+            chosen_fortify = options[best]
+
+    if chosen_fortify is not None:
+        return game.move_fortify(query, *chosen_fortify)
     else:
         return game.move_fortify_pass(query)
 
 
-def find_shortest_path_from_vertex_to_set(game: Game, source: int, target_set: set[int]) -> list[int]:
-    """Used in move_fortify()."""
-
-    # We perform a BFS search from our source vertex, stopping at the first member of the target_set we find.
-    queue = deque()
-    queue.appendleft(source)
-
-    parent = {}
-    seen = {source: True}
-    while len(queue) != 0:
-        current = queue.pop()
-        if current in target_set:
-            break
-
-        for neighbour in game.state.map.get_adjacent_to(current):
-            if neighbour not in seen:
-                seen[neighbour] = True
-                parent[neighbour] = current
-                queue.appendleft(neighbour)
-    path = []
-    while current in parent:
-        path.append(current)
-        current = parent[current]
-    path.append(source)
-    return path[::-1]
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,318 @@
+"""Reads the replays my_submission.py writes when RISK_REPLAY names a directory (or that
+simulator.py writes with --replays), one file per game and seat.
+
+Any entry can be read on its own: the block index at the end of the file (or a scan of the block
+headers, for a game that was cut short) finds the block it is in, and only that block is
+decompressed and played forward from the full position it starts with. The recording up to an
+entry is only put together when it is asked for.
+
+    python replay.py show replays/4p-0-1.replay --turn 12
+    python replay.py corpus replays/*.replay --sample 0.05
+    python replay.py diff replays/*.replay --only QueryAttack QueryFortify
+
+diff asks the current handlers every query in the replays again, in order and with one bot state
+per game, and counts the answers that are not the ones in the replay. Searches are off unless
+--search-budget is given, so anything decided by a search can come out differently.
+"""
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import gzip
+import json
+import mmap
+import random
+import zlib
+from bisect import bisect_right
+from collections import Counter
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Iterator, Optional
+
+import benchmark
+import my_submission
+import simulator
+from my_submission import (REPLAY_BLOCK, REPLAY_COMPRESSED, REPLAY_ENTRY, REPLAY_HEADER, REPLAY_INDEX,
+                           REPLAY_INDEX_MAGIC, REPLAY_MAGIC, REPLAY_QUERIES, REPLAY_TERRITORY, REPLAY_TRAILER,
+                           REPLAY_VERSION)
+from risk_shared.models.card_model import CardModel
+
+
+# The inverse of my_submission.replay_encode. Queries, records and cards come back as the classes
+# the simulator uses, anything else as a namespace of its fields.
+def replay_decode(value):
+    if isinstance(value, list):
+        return [replay_decode(item) for item in value]
+    if isinstance(value, dict) and "items" in value:
+        return {replay_decode(key): replay_decode(item) for key, item in value["items"]}
+    if isinstance(value, dict) and "type" in value:
+        kind = value["type"]
+        fields = {name: replay_decode(field) for name, field in value["fields"].items()}
+        if kind in benchmark.QUERIES:
+            names = {field.name for field in dataclasses.fields(benchmark.QUERIES[kind])}
+            return benchmark.QUERIES[kind](**{name: field for name, field in fields.items() if name in names})
+        if kind in benchmark.RECORDS:
+            return benchmark.RECORDS[kind](**fields)
+        if kind == "CardModel":
+            return CardModel(**fields)
+        return SimpleNamespace(**fields)
+    return value
+
+
+@dataclass
+class ReplayEntry:
+    """One query we were asked, with everything as it was when it was asked."""
+    number: int
+    turn: int
+    query: str
+    recording_length: int
+    card_sets_redeemed: int
+    territories: list[list[Optional[int]]]
+    players: list[list]
+    cards: list[list]
+    details: dict
+
+    @property
+    def move(self):
+        return replay_decode(self.details["move"])
+
+    @property
+    def query_model(self):
+        return replay_decode(self.details["query"])
+
+
+class Replay():
+    """A replay file, mapped into memory and read a block at a time."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.me, self.player_count, self.size = REPLAY_HEADER.unpack_from(self.data, 0)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f"{path} is not a version {REPLAY_VERSION} replay")
+
+        # (first entry, first turn, offset) of each block, from the index or else the block headers
+        self.blocks: list[tuple[int, int, int]] = []
+        trailer_offset = len(self.data) - REPLAY_TRAILER.size
+        index_offset, block_count, index_magic = REPLAY_TRAILER.unpack_from(self.data, trailer_offset) if trailer_offset >= REPLAY_HEADER.size else (0, 0, b"")
+        if index_magic == REPLAY_INDEX_MAGIC:
+            self.blocks = [REPLAY_INDEX.unpack_from(self.data, index_offset + i*REPLAY_INDEX.size) for i in range(block_count)]
+            self.entry_count = 0
+            if self.blocks:
+                _, first_entry, entries, _, _ = self.block_header(len(self.blocks) - 1)
+                self.entry_count = first_entry + entries
+        else:
+            self.entry_count = 0
+            offset = REPLAY_HEADER.size
+            while offset + REPLAY_BLOCK.size <= len(self.data):
+                _, first_entry, entries, first_turn, length = REPLAY_BLOCK.unpack_from(self.data, offset)
+                if offset + REPLAY_BLOCK.size + length > len(self.data):
+                    break
+                self.blocks.append((first_entry, first_turn, offset))
+                self.entry_count = first_entry + entries
+                offset += REPLAY_BLOCK.size + length
+        self.first_entries = [first_entry for first_entry, _, _ in self.blocks]
+        self.first_turns = [first_turn for _, first_turn, _ in self.blocks]
+
+        self.cached_block = -1
+        self.cached_entries: list[ReplayEntry] = []
+        self.decoded_records: list = []
+        self.records_read = 0
+
+    def __len__(self) -> int:
+        return self.entry_count
+
+    def block_header(self, block: int) -> tuple[int, int, int, int, int]:
+        return REPLAY_BLOCK.unpack_from(self.data, self.blocks[block][2])
+
+    # Every entry in the block, played forward from the full position the block starts with
+    def read_block(self, block: int) -> list[ReplayEntry]:
+        if block == self.cached_block:
+            return self.cached_entries
+        flags, first_entry, entries, _, length = self.block_header(block)
+        start = self.blocks[block][2] + REPLAY_BLOCK.size
+        payload = self.data[start:start + length]
+        if flags & REPLAY_COMPRESSED:
+            payload = zlib.decompress(payload)
+
+        territories: list[list[Optional[int]]] = [[None, 0] for _ in range(self.size)]
+        players: list[list] = []
+        cards: list[list] = []
+        result = []
+        offset = 0
+        for number in range(first_entry, first_entry + entries):
+            turn, recording_length, kind, card_sets_redeemed, changes, details_length = REPLAY_ENTRY.unpack_from(payload, offset)
+            offset += REPLAY_ENTRY.size
+            for territory, occupier, troops in REPLAY_TERRITORY.iter_unpack(payload[offset:offset + changes*REPLAY_TERRITORY.size]):
+                territories[territory] = [None if occupier == -1 else occupier, troops]
+            offset += changes*REPLAY_TERRITORY.size
+            details = json.loads(payload[offset:offset + details_length])
+            offset += details_length
+            players = details.get("players", players)
+            cards = details.get("cards", cards)
+            query = REPLAY_QUERIES[kind] if kind < len(REPLAY_QUERIES) else details["query"]["type"]
+            result.append(ReplayEntry(number, turn, query, recording_length, card_sets_redeemed, [territory[:] for territory in territories], players, cards, details))
+
+        self.cached_block = block
+        self.cached_entries = result
+        return result
+
+    def entry(self, number: int) -> ReplayEntry:
+        if not 0 <= number < self.entry_count:
+            raise IndexError(f"{self.path} has {self.entry_count} entries")
+        block = bisect_right(self.first_entries, number) - 1
+        return self.read_block(block)[number - self.first_entries[block]]
+
+    # The first entry of one of our turns (turn 0 being the claims and initial placements)
+    def turn(self, turn: int) -> Optional[ReplayEntry]:
+        block = max(0, bisect_right(self.first_turns, turn) - 1)
+        for block in range(block, len(self.blocks)):
+            for entry in self.read_block(block):
+                if entry.turn >= turn:
+                    return entry if entry.turn == turn else None
+        return None
+
+    def __iter__(self) -> Iterator[ReplayEntry]:
+        for block in range(len(self.blocks)):
+            yield from self.read_block(block)
+
+    # The recording as it was when the entry was asked. The records are kept with the entries they
+    # came in with, so this reads every block up to the entry, but only once.
+    def recording(self, number: int) -> list:
+        length = self.entry(number).recording_length
+        while len(self.decoded_records) < length:
+            entry = self.entry(self.records_read)
+            self.decoded_records += [replay_decode(record) for record in entry.details["records"]]
+            self.records_read += 1
+        return self.decoded_records[:length]
+
+
+# An entry in the form benchmark.py keeps its samples in. Other players' cards aren't known, only
+# how many they hold, so they are made up.
+def sample_of(replay: Replay, entry: ReplayEntry) -> dict:
+    if entry.query in ("QueryClaimTerritory", "QueryPlaceInitialTroop"):
+        phase = "setup"
+    elif entry.turn < benchmark.MID_GAME_TURN:
+        phase = "early"
+    else:
+        phase = "mid" if entry.turn < benchmark.LATE_GAME_TURN else "late"
+    players = []
+    for player_id, troops_remaining, alive, card_count, must_place in entry.players:
+        cards = entry.cards if player_id == replay.me else [[-1 - i, None, "Wildcard"] for i in range(card_count)]
+        players.append([troops_remaining, alive, cards, must_place])
+    query = entry.query_model
+    return {
+        "query": [entry.query, vars(query)],
+        "me": replay.me,
+        "phase": phase,
+        "territories": entry.territories,
+        "players": players,
+        "card_sets_redeemed": entry.card_sets_redeemed,
+        "recording_length": entry.recording_length,
+    }
+
+
+def show(args: argparse.Namespace):
+    replay = Replay(args.replay)
+    turns = replay.entry(len(replay) - 1).turn if len(replay) else 0
+    print(f"{args.replay}: player {replay.me} of {replay.player_count}, {len(replay)} queries over {turns} turns in {len(replay.blocks)} blocks, {len(replay.data)} bytes")
+    entry = replay.turn(args.turn) if args.turn is not None else replay.entry(args.entry % len(replay))
+    if entry is None:
+        print(f"we had no turn {args.turn}")
+        return
+    owned = Counter(occupier for occupier, _ in entry.territories if occupier is not None)
+    troops: Counter[int] = Counter()
+    for occupier, count in entry.territories:
+        if occupier is not None:
+            troops[occupier] += count
+    print(f"entry {entry.number}, turn {entry.turn}: {entry.query} answered with {entry.details['move']['type']} {entry.details['move']['fields']}")
+    for player in sorted(owned):
+        print(f"  player {player}: {owned[player]} territories, {troops[player]} troops")
+
+
+def corpus(args: argparse.Namespace):
+    rng = random.Random(args.seed)
+    lines = []
+    for path in args.replays:
+        replay = Replay(path)
+        if not len(replay):
+            continue
+        recording = replay.recording(len(replay) - 1)
+        if any(type(record) not in benchmark.RECORDS.values() for record in recording):
+            print(f"{path}: skipped, its recording has records the benchmark can't replay")
+            continue
+        samples = [sample_of(replay, entry) for entry in replay if rng.random() < args.sample]
+        lines.append({"players": replay.player_count, "seed": path, "recording": [benchmark.encode_record(record) for record in recording]})
+        lines += samples
+        print(f"{path}: {len(samples)} samples from {len(replay)} queries")
+
+    with gzip.open(args.corpus, "wt") as file:
+        for line in lines:
+            file.write(json.dumps(line, separators=(",", ":")) + "\n")
+
+
+def diff(args: argparse.Namespace) -> int:
+    my_submission.get_battle_odds()
+    differences: Counter[str] = Counter()
+    asked: Counter[str] = Counter()
+    shown = 0
+    for path in args.replays:
+        replay = Replay(path)
+        if not len(replay):
+            continue
+        recording = replay.recording(len(replay) - 1)
+        bot_state = my_submission.BotState()
+        bot_state.search_budget = args.search_budget
+        bot = simulator.SubmissionBot(bot_state)
+        for entry in replay:
+            sample = sample_of(replay, entry)
+            game = simulator.SimGame(benchmark.FrozenMatch(sample, recording), replay.me)  # type: ignore[arg-type]
+            move = my_submission.replay_encode(bot(game, entry.query_model))
+            if args.only and entry.query not in args.only:
+                continue
+            asked[entry.query] += 1
+            if move != entry.details["move"]:
+                differences[entry.query] += 1
+                if shown < args.show:
+                    print(f"{path} entry {entry.number}, turn {entry.turn}: {entry.details['move']['fields']} -> {move['fields']}")
+                    shown += 1
+
+    print(f"{'query':<28}{'asked':>8}{'changed':>9}")
+    for query in sorted(asked):
+        print(f"{query:<28}{asked[query]:>8}{differences[query]:>9}")
+    return 1 if differences else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    show_parser = commands.add_parser("show", help="summarise a replay and the position at one point in it")
+    show_parser.add_argument("replay")
+    show_parser.add_argument("--entry", type=int, default=-1, help="query number (from the end if negative)")
+    show_parser.add_argument("--turn", type=int, help="the first query of this turn of ours instead")
+
+    corpus_parser = commands.add_parser("corpus", help="write a benchmark corpus from a sample of the queries in the replays")
+    corpus_parser.add_argument("replays", nargs="+")
+    corpus_parser.add_argument("--sample", type=float, default=0.02, help="fraction of queries kept")
+    corpus_parser.add_argument("--seed", type=int, default=0)
+    corpus_parser.add_argument("--corpus", default=benchmark.CORPUS_PATH)
+
+    diff_parser = commands.add_parser("diff", help="count the queries the current handlers answer differently")
+    diff_parser.add_argument("replays", nargs="+")
+    diff_parser.add_argument("--only", nargs="+", choices=REPLAY_QUERIES, help="only compare these queries")
+    diff_parser.add_argument("--search-budget", type=float, default=0.0, help="seconds of search per query")
+    diff_parser.add_argument("--show", type=int, default=10, help="differences to print")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        show(args)
+    elif args.command == "corpus":
+        corpus(args)
+    else:
+        raise SystemExit(diff(args))
+
+
+if __name__ == "__main__":
+    main()
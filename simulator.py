@@ -0,0 +1,585 @@
+"""A headless stand-in for the game engine, used to play our bot against itself offline.
+
+The simulator plays the classic 42 territory map with the same query/move protocol as the
+real engine (QueryClaimTerritory through QueryFortify) and calls the handle_* functions in
+my_submission.py directly, so thousands of games can be run without a network connection.
+
+    python simulator.py --games 1000 --workers 8
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from multiprocessing import Pool
+from typing import Callable, Optional
+
+import my_submission
+from my_submission import card_set_value
+from risk_shared.models.card_model import CardModel
+from risk_shared.records.moves.move_attack import MoveAttack
+from risk_shared.records.moves.move_attack_pass import MoveAttackPass
+from risk_shared.records.moves.move_claim_territory import MoveClaimTerritory
+from risk_shared.records.moves.move_defend import MoveDefend
+from risk_shared.records.moves.move_distribute_troops import MoveDistributeTroops
+from risk_shared.records.moves.move_fortify import MoveFortify
+from risk_shared.records.moves.move_fortify_pass import MoveFortifyPass
+from risk_shared.records.moves.move_place_initial_troop import MovePlaceInitialTroop
+from risk_shared.records.moves.move_redeem_cards import MoveRedeemCards
+from risk_shared.records.moves.move_troops_after_attack import MoveTroopsAfterAttack
+from risk_shared.records.record_attack import RecordAttack
+
+
+# The classic map. Territories are numbered alphabetically within each continent.
+CLASSIC_EDGES = [
+    (0, 1), (0, 5), (0, 21), (1, 5), (1, 6), (1, 8), (2, 3), (2, 8), (2, 31), (3, 6), (3, 7),
+    (3, 8), (4, 5), (4, 6), (4, 7), (4, 10), (5, 6), (6, 7), (6, 8), (9, 10), (9, 11), (9, 12),
+    (9, 15), (10, 12), (11, 12), (11, 13), (11, 14), (11, 15), (12, 14), (13, 14), (13, 15),
+    (13, 22), (13, 34), (13, 36), (14, 16), (14, 22), (14, 26), (15, 36), (16, 17), (16, 18),
+    (16, 22), (16, 26), (17, 18), (17, 23), (17, 24), (17, 25), (17, 26), (18, 22), (18, 24),
+    (19, 21), (19, 23), (19, 25), (19, 27), (20, 21), (20, 23), (21, 23), (21, 27), (22, 34),
+    (22, 33), (23, 25), (24, 39), (25, 26), (25, 27), (28, 29), (28, 30), (29, 30), (29, 31),
+    (29, 36), (30, 31), (32, 33), (32, 36), (32, 37), (33, 34), (33, 35), (33, 36), (33, 37),
+    (34, 36), (35, 37), (38, 40), (38, 41), (39, 40), (39, 41), (40, 41),
+]
+CLASSIC_CONTINENTS = {
+    0: list(range(0, 9)),
+    1: list(range(9, 16)),
+    2: list(range(16, 28)),
+    3: list(range(28, 32)),
+    4: list(range(32, 38)),
+    5: list(range(38, 42)),
+}
+CLASSIC_CONTINENT_BONUSES = {0: 5, 1: 5, 2: 7, 3: 2, 4: 3, 5: 2}
+
+STARTING_TROOPS = {2: 40, 3: 35, 4: 30, 5: 25, 6: 20}
+CARD_SYMBOLS = ["Infantry", "Cavalry", "Artillery"]
+
+
+class IllegalMove(Exception):
+    pass
+
+
+# Queries. The handlers only read the attributes below, so these stand in for the
+# risk_shared query models.
+@dataclass
+class QueryClaimTerritory:
+    pass
+
+@dataclass
+class QueryPlaceInitialTroop:
+    pass
+
+@dataclass
+class QueryRedeemCards:
+    cause: str = "turn_started"
+
+@dataclass
+class QueryDistributeTroops:
+    cause: str = "turn_started"
+
+@dataclass
+class QueryAttack:
+    pass
+
+@dataclass
+class QueryTroopsAfterAttack:
+    record_attack_id: int = 0
+
+@dataclass
+class QueryDefend:
+    move_attack_id: int = 0
+
+@dataclass
+class QueryFortify:
+    pass
+
+
+class SimMap():
+    def __init__(self, edges: list[tuple[int, int]], continents: dict[int, list[int]], continent_bonuses: dict[int, int]):
+        self._adjacent: dict[int, list[int]] = defaultdict(list)
+        for a, b in edges:
+            self._adjacent[a].append(b)
+            self._adjacent[b].append(a)
+        for territory in self._adjacent:
+            self._adjacent[territory].sort()
+        self._continents = continents
+        self._continent_bonuses = continent_bonuses
+
+    def get_vertices(self) -> list[int]:
+        return sorted(self._adjacent)
+
+    def get_adjacent_to(self, territory: int) -> list[int]:
+        return self._adjacent[territory]
+
+    def get_continents(self) -> dict[int, list[int]]:
+        return self._continents
+
+    def get_continent_bonuses(self) -> dict[int, int]:
+        return self._continent_bonuses
+
+
+@dataclass
+class SimTerritory:
+    territory_id: int
+    occupier: Optional[int] = None
+    troops: int = 0
+
+
+@dataclass
+class SimPlayer:
+    player_id: int
+    troops_remaining: int = 0
+    alive: bool = True
+    cards: list[CardModel] = field(default_factory=list)
+    must_place_territory_bonus: list[int] = field(default_factory=list)
+
+    @property
+    def card_count(self) -> int:
+        return len(self.cards)
+
+
+def is_card_set(cards: tuple[CardModel, ...]) -> bool:
+    symbols = [card.symbol for card in cards if card.symbol != "Wildcard"]
+    return len(set(symbols)) == 1 or len(set(symbols)) == len(symbols)
+
+
+class SimState():
+    """One player's view of the match, mirroring the parts of risk_helper's state the bot reads."""
+
+    def __init__(self, match: Match, player_id: int):
+        self._match = match
+        self.map = match.map
+        self.territories = match.territories
+        self.players = match.players
+        self.recording = match.recording
+        self.me = match.players[player_id]
+
+    @property
+    def card_sets_redeemed(self) -> int:
+        return self._match.card_sets_redeemed
+
+    def get_territories_owned_by(self, player: Optional[int]) -> list[int]:
+        return [territory for territory in self.territories if self.territories[territory].occupier == player]
+
+    def get_all_adjacent_territories(self, territories: list[int]) -> list[int]:
+        result = set()
+        for territory in territories:
+            result.update(self.map.get_adjacent_to(territory))
+        return list(result - set(territories))
+
+    def get_all_border_territories(self, territories: list[int]) -> list[int]:
+        territory_set = set(territories)
+        return [territory for territory in territories if not set(self.map.get_adjacent_to(territory)) <= territory_set]
+
+    def get_card_set(self, cards: list[CardModel]) -> Optional[tuple[CardModel, CardModel, CardModel]]:
+        for i in range(len(cards)):
+            for j in range(i + 1, len(cards)):
+                for k in range(j + 1, len(cards)):
+                    if is_card_set((cards[i], cards[j], cards[k])):
+                        return (cards[i], cards[j], cards[k])
+        return None
+
+
+class SimGame():
+    """Stands in for risk_helper's Game object for a single seat."""
+
+    def __init__(self, match: Match, player_id: int):
+        self.state = SimState(match, player_id)
+        self._player_id = player_id
+
+    def move_claim_territory(self, query, territory_id: int) -> MoveClaimTerritory:
+        return MoveClaimTerritory(move_by_player=self._player_id, territory=territory_id)
+
+    def move_place_initial_troop(self, query, territory_id: int) -> MovePlaceInitialTroop:
+        return MovePlaceInitialTroop(move_by_player=self._player_id, territory=territory_id)
+
+    def move_redeem_cards(self, query, card_ids: list[tuple[int, int, int]]) -> MoveRedeemCards:
+        return MoveRedeemCards(move_by_player=self._player_id, sets=card_ids)
+
+    def move_distribute_troops(self, query, distributions: dict[int, int]) -> MoveDistributeTroops:
+        return MoveDistributeTroops(move_by_player=self._player_id, distributions=dict(distributions))
+
+    def move_attack(self, query, attacking_territory: int, defending_territory: int, attacking_troops: int) -> MoveAttack:
+        return MoveAttack(move_by_player=self._player_id, attacking_territory=attacking_territory, defending_territory=defending_territory, attacking_troops=attacking_troops)
+
+    def move_attack_pass(self, query) -> MoveAttackPass:
+        return MoveAttackPass(move_by_player=self._player_id)
+
+    def move_troops_after_attack(self, query, troop_count: int) -> MoveTroopsAfterAttack:
+        return MoveTroopsAfterAttack(move_by_player=self._player_id, record_attack_id=query.record_attack_id, troop_count=troop_count)
+
+    def move_defend(self, query, defending_troops: int) -> MoveDefend:
+        return MoveDefend(move_by_player=self._player_id, move_attack_id=query.move_attack_id, defending_troops=defending_troops)
+
+    def move_fortify(self, query, source_territory: int, target_territory: int, troop_count: int) -> MoveFortify:
+        return MoveFortify(move_by_player=self._player_id, source_territory=source_territory, target_territory=target_territory, troop_count=troop_count)
+
+    def move_fortify_pass(self, query) -> MoveFortifyPass:
+        return MoveFortifyPass(move_by_player=self._player_id)
+
+
+class SubmissionBot():
+    """Answers queries with the handlers from my_submission.py, keeping its own BotState."""
+
+    def __init__(self, bot_state: Optional[my_submission.BotState] = None, recorder: Optional[my_submission.ReplayRecorder] = None):
+        self.bot_state = bot_state if bot_state is not None else my_submission.BotState()
+        self.recorder = recorder
+
+    def __call__(self, game: SimGame, query):
+        move = self.answer(game, query)
+        if self.recorder is not None:
+            self.recorder.add(game, query, move)
+        return move
+
+    def answer(self, game: SimGame, query):
+        self.bot_state.query_started = self.bot_state.clock()
+        match query:
+            case QueryClaimTerritory():
+                return my_submission.handle_claim_territory(game, self.bot_state, query)
+            case QueryPlaceInitialTroop():
+                return my_submission.handle_place_initial_troop(game, self.bot_state, query)
+            case QueryRedeemCards():
+                return my_submission.handle_redeem_cards(game, self.bot_state, query)
+            case QueryDistributeTroops():
+                return my_submission.handle_distribute_troops(game, self.bot_state, query)
+            case QueryAttack():
+                return my_submission.handle_attack(game, self.bot_state, query)
+            case QueryTroopsAfterAttack():
+                return my_submission.handle_troops_after_attack(game, self.bot_state, query)
+            case QueryDefend():
+                return my_submission.handle_defend(game, self.bot_state, query)
+            case QueryFortify():
+                return my_submission.handle_fortify(game, self.bot_state, query)
+
+
+Bot = Callable[[SimGame, object], object]
+
+
+@dataclass
+class MatchResult:
+    seed: int
+    winner: Optional[int]
+    turns: int
+    territories: dict[int, int]
+    eliminated_order: list[int]
+    query_times: dict[str, list[float]]
+    profile: dict[str, dict] = field(default_factory=dict)
+
+
+class Match():
+    """Plays a single game between the given bots, one per seat (seat i is player i)."""
+
+    def __init__(self, bots: list[Bot], seed: int = 0, max_turns: int = 400):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.max_turns = max_turns
+        self.bots = bots
+        self.map = SimMap(CLASSIC_EDGES, CLASSIC_CONTINENTS, CLASSIC_CONTINENT_BONUSES)
+        self.territories = {territory: SimTerritory(territory) for territory in self.map.get_vertices()}
+        self.players = {player: SimPlayer(player) for player in range(len(bots))}
+        self.recording: list = []
+        self.card_sets_redeemed = 0
+        self.games = [SimGame(self, player) for player in range(len(bots))]
+        self.turn_order = list(range(len(bots)))
+        self.rng.shuffle(self.turn_order)
+        self.deck = [CardModel(card_id=territory, territory_id=territory, symbol=CARD_SYMBOLS[territory % 3]) for territory in self.territories]
+        self.deck += [CardModel(card_id=len(self.deck) + i, territory_id=None, symbol="Wildcard") for i in range(2)]
+        self.rng.shuffle(self.deck)
+        self.discard: list[CardModel] = []
+        self.eliminated_order: list[int] = []
+        self.query_times: dict[str, list[float]] = defaultdict(list)
+        self.turns = 0
+
+    # Querying bots and recording their moves.
+    def ask(self, player: int, query):
+        start = time.perf_counter()
+        move = self.bots[player](self.games[player], query)
+        self.query_times[type(query).__name__].append(time.perf_counter() - start)
+        if getattr(move, "move_by_player", None) != player:
+            raise IllegalMove(f"player {player} answered {type(query).__name__} with {move!r}")
+        self.recording.append(move)
+        return move
+
+    def owned_by(self, player: Optional[int]) -> list[int]:
+        return [territory for territory in self.territories if self.territories[territory].occupier == player]
+
+    def alive_players(self) -> list[int]:
+        return [player for player in self.turn_order if self.players[player].alive]
+
+    def require(self, condition: bool, player: int, message: str):
+        if not condition:
+            raise IllegalMove(f"player {player}: {message}")
+
+    # Setup phases.
+    def claim_phase(self):
+        order = iter(self.turn_order * len(self.territories))
+        while len(self.owned_by(None)) > 0:
+            player = next(order)
+            move = self.ask(player, QueryClaimTerritory())
+            self.require(isinstance(move, MoveClaimTerritory), player, "expected MoveClaimTerritory")
+            self.require(self.territories[move.territory].occupier is None, player, f"territory {move.territory} is already claimed")
+            self.territories[move.territory].occupier = player
+            self.territories[move.territory].troops = 1
+
+    def place_initial_troops_phase(self):
+        for player in self.players.values():
+            player.troops_remaining = STARTING_TROOPS[len(self.players)] - len(self.owned_by(player.player_id))
+        while any(self.players[player].troops_remaining > 0 for player in self.turn_order):
+            for player in self.turn_order:
+                if self.players[player].troops_remaining == 0:
+                    continue
+                move = self.ask(player, QueryPlaceInitialTroop())
+                self.require(isinstance(move, MovePlaceInitialTroop), player, "expected MovePlaceInitialTroop")
+                self.require(self.territories[move.territory].occupier == player, player, f"territory {move.territory} is not owned")
+                self.territories[move.territory].troops += 1
+                self.players[player].troops_remaining -= 1
+
+    # Main game phases.
+    def redeem_cards(self, player: int, cause: str):
+        me = self.players[player]
+        move = self.ask(player, QueryRedeemCards(cause=cause))
+        self.require(isinstance(move, MoveRedeemCards), player, "expected MoveRedeemCards")
+        cards_by_id = {card.card_id: card for card in me.cards}
+        used: set[int] = set()
+        for card_set in move.sets:
+            self.require(all(card_id in cards_by_id and card_id not in used for card_id in card_set), player, f"invalid card set {card_set}")
+            used.update(card_set)
+            cards = tuple(cards_by_id[card_id] for card_id in card_set)
+            self.require(is_card_set(cards), player, f"{card_set} is not a set")
+            me.troops_remaining += card_set_value(self.card_sets_redeemed)
+            self.card_sets_redeemed += 1
+            # Like the classic rules, at most one matching territory card pays out per redemption.
+            for card in cards:
+                if card.territory_id is not None and self.territories[card.territory_id].occupier == player and len(me.must_place_territory_bonus) == 0:
+                    me.must_place_territory_bonus.append(card.territory_id)
+                    me.troops_remaining += 2
+                    break
+        me.cards = [card for card in me.cards if card.card_id not in used]
+        self.discard.extend(cards_by_id[card_id] for card_id in used)
+        self.require(len(me.cards) < 5 or cause != "turn_started", player, "must redeem down to fewer than 5 cards")
+        if cause == "player_eliminated":
+            self.require(len(me.cards) < 5, player, "must redeem down to fewer than 5 cards")
+
+    def distribute_troops(self, player: int, cause: str):
+        me = self.players[player]
+        move = self.ask(player, QueryDistributeTroops(cause=cause))
+        self.require(isinstance(move, MoveDistributeTroops), player, "expected MoveDistributeTroops")
+        distributions = move.distributions
+        self.require(all(count >= 0 for count in distributions.values()), player, "negative distribution")
+        self.require(sum(distributions.values()) == me.troops_remaining, player, f"distributed {sum(distributions.values())} of {me.troops_remaining} troops")
+        self.require(all(self.territories[territory].occupier == player for territory, count in distributions.items() if count > 0), player, "distributed to a territory it does not own")
+        for territory in me.must_place_territory_bonus:
+            self.require(distributions.get(territory, 0) >= 2, player, f"must place 2 troops on {territory}")
+        for territory, count in distributions.items():
+            self.territories[territory].troops += count
+        me.troops_remaining = 0
+        me.must_place_territory_bonus = []
+
+    def roll(self, attacking_troops: int, defending_troops: int) -> tuple[int, int]:
+        attack = sorted((self.rng.randint(1, 6) for _ in range(attacking_troops)), reverse=True)
+        defend = sorted((self.rng.randint(1, 6) for _ in range(defending_troops)), reverse=True)
+        attacking_lost = 0
+        defending_lost = 0
+        for a, d in zip(attack, defend):
+            if a > d:
+                defending_lost += 1
+            else:
+                attacking_lost += 1
+        return attacking_lost, defending_lost
+
+    def attack_phase(self, player: int) -> bool:
+        conquered = False
+        while True:
+            move = self.ask(player, QueryAttack())
+            if isinstance(move, MoveAttackPass):
+                return conquered
+            self.require(isinstance(move, MoveAttack), player, "expected MoveAttack or MoveAttackPass")
+            source = self.territories[move.attacking_territory]
+            target = self.territories[move.defending_territory]
+            self.require(source.occupier == player, player, "attacking from a territory it does not own")
+            self.require(target.occupier not in (player, None), player, "attacking a territory it owns")
+            self.require(target.territory_id in self.map.get_adjacent_to(source.territory_id), player, "attacking a non-adjacent territory")
+            self.require(1 <= move.attacking_troops <= min(3, source.troops - 1), player, f"attacking with {move.attacking_troops} from {source.troops}")
+            move_attack_id = len(self.recording) - 1
+
+            defender = target.occupier
+            defend = self.ask(defender, QueryDefend(move_attack_id=move_attack_id))
+            self.require(isinstance(defend, MoveDefend), defender, "expected MoveDefend")
+            self.require(1 <= defend.defending_troops <= min(2, target.troops), defender, f"defending with {defend.defending_troops} from {target.troops}")
+
+            attacking_lost, defending_lost = self.roll(move.attacking_troops, defend.defending_troops)
+            source.troops -= attacking_lost
+            target.troops -= defending_lost
+            territory_conquered = target.troops == 0
+            defender_eliminated = territory_conquered and len(self.owned_by(defender)) == 1
+            self.recording.append(RecordAttack(move_attack_id=move_attack_id, attacking_lost=attacking_lost, defending_lost=defending_lost, territory_conquered=territory_conquered, defender_eliminated=defender_eliminated))
+            if not territory_conquered:
+                continue
+
+            conquered = True
+            target.occupier = player
+            record_attack_id = len(self.recording) - 1
+            after = self.ask(player, QueryTroopsAfterAttack(record_attack_id=record_attack_id))
+            self.require(isinstance(after, MoveTroopsAfterAttack), player, "expected MoveTroopsAfterAttack")
+            minimum = min(move.attacking_troops - attacking_lost, source.troops - 1)
+            self.require(minimum <= after.troop_count <= source.troops - 1, player, f"moving {after.troop_count} troops from {source.troops}")
+            source.troops -= after.troop_count
+            target.troops = after.troop_count
+
+            if defender_eliminated:
+                self.players[defender].alive = False
+                self.eliminated_order.append(defender)
+                self.players[player].cards.extend(self.players[defender].cards)
+                self.players[defender].cards = []
+                if len(self.alive_players()) == 1:
+                    return conquered
+                if len(self.players[player].cards) >= 5:
+                    self.redeem_cards(player, "player_eliminated")
+                    self.distribute_troops(player, "player_eliminated")
+
+    def fortify(self, player: int):
+        move = self.ask(player, QueryFortify())
+        if isinstance(move, MoveFortifyPass):
+            return
+        self.require(isinstance(move, MoveFortify), player, "expected MoveFortify or MoveFortifyPass")
+        source = self.territories[move.source_territory]
+        target = self.territories[move.target_territory]
+        self.require(source.occupier == player and target.occupier == player, player, "fortifying between territories it does not own")
+        self.require(target.territory_id in self.map.get_adjacent_to(source.territory_id), player, "fortifying between non-adjacent territories")
+        self.require(0 <= move.troop_count <= source.troops - 1, player, f"fortifying {move.troop_count} from {source.troops}")
+        source.troops -= move.troop_count
+        target.troops += move.troop_count
+
+    def draw_card(self, player: int):
+        if len(self.deck) == 0:
+            self.deck, self.discard = self.discard, []
+            self.rng.shuffle(self.deck)
+        if len(self.deck) > 0:
+            self.players[player].cards.append(self.deck.pop())
+
+    def reinforcements(self, player: int) -> int:
+        owned = set(self.owned_by(player))
+        troops = max(3, len(owned) // 3)
+        for continent, territories in self.map.get_continents().items():
+            if set(territories) <= owned:
+                troops += self.map.get_continent_bonuses()[continent]
+        return troops
+
+    def play_turn(self, player: int):
+        self.redeem_cards(player, "turn_started")
+        self.players[player].troops_remaining += self.reinforcements(player)
+        self.distribute_troops(player, "turn_started")
+        conquered = self.attack_phase(player)
+        if len(self.alive_players()) == 1:
+            return
+        self.fortify(player)
+        if conquered:
+            self.draw_card(player)
+
+    def play(self) -> MatchResult:
+        self.claim_phase()
+        self.place_initial_troops_phase()
+        while self.turns < self.max_turns and len(self.alive_players()) > 1:
+            for player in self.turn_order:
+                if not self.players[player].alive:
+                    continue
+                self.play_turn(player)
+                if len(self.alive_players()) == 1:
+                    break
+            self.turns += 1
+
+        territory_counts = {player: len(self.owned_by(player)) for player in self.players}
+        alive = self.alive_players()
+        winner = alive[0] if len(alive) == 1 else None
+        return MatchResult(self.seed, winner, self.turns, territory_counts, self.eliminated_order, dict(self.query_times))
+
+
+def play_match(seed: int, players: int = 5, max_turns: int = 400, search_budget: float = my_submission.SEARCH_TIME_BUDGET, parameters: Optional[dict[int, dict]] = None, replays: Optional[str] = None, clock: Callable[[], float] = time.monotonic) -> MatchResult:
+    """Plays one game of our bot against copies of itself. Seats listed in parameters play with
+    those coefficients instead of the usual ones, keeping the usual ones for any they leave out.
+    With a replays directory, every seat's side of the game is written to it. Searches are timed
+    on the given clock."""
+    bots = []
+    for player in range(players):
+        bot_state = my_submission.BotState()
+        bot_state.search_budget = search_budget
+        bot_state.clock = clock
+        if parameters is not None and player in parameters:
+            bot_state.parameters = dict(bot_state.parameters, **parameters[player])
+        bot_state.rng.seed(seed*players + player)
+        recorder = None
+        if replays is not None:
+            recorder = my_submission.ReplayRecorder(os.path.join(replays, f"{players}p-{seed}-{player}.replay"))
+        bots.append(SubmissionBot(bot_state, recorder))
+    try:
+        result = Match(bots, seed=seed, max_turns=max_turns).play()
+    finally:
+        for bot in bots:
+            if bot.recorder is not None:
+                bot.recorder.close()
+
+    # Profiles are handed back per game, as pool workers never get to write their own
+    if my_submission.PROFILER is not None:
+        result.profile = my_submission.PROFILER.stats
+        my_submission.PROFILER.stats = {}
+    return result
+
+
+def summarise(results: list[MatchResult]):
+    wins = defaultdict(int)
+    for result in results:
+        if result.winner is not None:
+            wins[result.winner] += 1
+    draws = sum(1 for result in results if result.winner is None)
+    turns = sorted(result.turns for result in results)
+    print(f"games: {len(results)}, unfinished: {draws}, median turns: {turns[len(turns)//2]}")
+    for player in sorted(wins):
+        print(f"  seat {player}: {wins[player]} wins ({wins[player]/len(results):.1%})")
+
+    query_times: dict[str, list[float]] = defaultdict(list)
+    for result in results:
+        for query_type, times in result.query_times.items():
+            query_times[query_type].extend(times)
+    print(f"{'query':<24}{'count':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for query_type, times in sorted(query_times.items()):
+        times.sort()
+        p50 = times[len(times)//2]*1000
+        p99 = times[min(len(times) - 1, int(len(times)*0.99))]*1000
+        print(f"{query_type:<24}{len(times):>10}{p50:>10.3f}{p99:>10.3f}{times[-1]*1000:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--players", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-turns", type=int, default=400)
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--search-budget", type=float, default=my_submission.SEARCH_TIME_BUDGET, help="seconds of search per query, 0 to turn it off")
+    parser.add_argument("--replays", help="directory to write a replay of every seat's game to")
+    args = parser.parse_args()
+
+    if args.replays is not None:
+        os.makedirs(args.replays, exist_ok=True)
+    seeds = range(args.seed, args.seed + args.games)
+    if args.workers > 1:
+        with Pool(args.workers) as pool:
+            results = pool.starmap(play_match, [(seed, args.players, args.max_turns, args.search_budget, None, args.replays) for seed in seeds])
+    else:
+        results = [play_match(seed, args.players, args.max_turns, args.search_budget, None, args.replays) for seed in seeds]
+    summarise(results)
+
+    if my_submission.PROFILER is not None and my_submission.PROFILE_PATH is not None:
+        profiler = my_submission.Profiler()
+        for result in results:
+            profiler.merge(result.profile)
+        profiler.dump(my_submission.PROFILE_PATH)
+        print(profiler.summary())
+
+
+if __name__ == "__main__":
+    main()
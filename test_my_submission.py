@@ -0,0 +1,156 @@
+"""Checks on the self-contained algorithms in my_submission.py and replay.py, against brute force,
+known values or the game they came from.
+
+    python -m pytest -q
+"""
+from __future__ import annotations
+
+import math
+import random
+from itertools import combinations_with_replacement
+
+import pytest
+
+import my_submission
+import simulator
+from replay import Replay
+
+SYMBOLS = ["Infantry", "Cavalry", "Artillery", "Wildcard"]
+
+
+# Any hand of five or more cards has to be brought below five, and the planner must always offer a
+# way of doing so, whatever the symbols
+def test_card_set_combinations_can_always_redeem_down_to_four():
+    rng = random.Random(0)
+    for size in range(5, 10):
+        required = math.ceil((size - 4)/3)
+        for symbols in combinations_with_replacement(SYMBOLS, size):
+            hand = tuple((symbol, symbol != "Wildcard" and rng.random() < 0.5) for symbol in rng.sample(symbols, size))
+            options = my_submission.card_set_combinations(hand)
+            assert any(len(option) == required for option in options), hand
+            for option in options:
+                used = [i for card_set in option for i in card_set]
+                assert len(used) == len(set(used))
+                assert all(my_submission.is_card_set(tuple(hand[i][0] for i in card_set)) for card_set in option)
+
+
+def test_card_set_combinations_handles_huge_hands():
+    rng = random.Random(1)
+    hand = tuple((symbol, rng.random() < 0.5 and symbol != "Wildcard") for symbol in (rng.choice(SYMBOLS) for _ in range(30)))
+    options = my_submission.card_set_combinations(hand)
+    assert any(len(option) == math.ceil((30 - 4)/3) for option in options)
+
+
+# The most that can be sent and the least it can cost, trying every flow
+def brute_force_transport(supply: dict[int, int], demand: dict[int, int], costs: dict[tuple[int, int], int]) -> tuple[int, int]:
+    arcs = sorted(costs)
+    best = (0, 0)
+
+    def search(i: int, sent: dict[int, int], received: dict[int, int], total: int, cost: int):
+        nonlocal best
+        if i == len(arcs):
+            best = max(best, (total, -cost))
+            return
+        source, sink = arcs[i]
+        for amount in range(min(supply[source] - sent[source], demand[sink] - received[sink]) + 1):
+            sent[source] += amount
+            received[sink] += amount
+            search(i + 1, sent, received, total + amount, cost + amount*costs[source, sink])
+            sent[source] -= amount
+            received[sink] -= amount
+
+    search(0, dict.fromkeys(supply, 0), dict.fromkeys(demand, 0), 0, 0)
+    return best[0], -best[1]
+
+
+def test_min_cost_transport_is_optimal():
+    rng = random.Random(2)
+    for _ in range(200):
+        supply = {source: rng.randint(0, 3) for source in range(rng.randint(1, 3))}
+        demand = {sink: rng.randint(0, 3) for sink in range(10, 10 + rng.randint(1, 3))}
+        costs = {(source, sink): rng.randint(1, 5) for source in supply for sink in demand if rng.random() < 0.8}
+        flows = my_submission.min_cost_transport(supply, demand, lambda source, sink: costs.get((source, sink)))
+        for source in supply:
+            assert sum(amount for (other, _), amount in flows.items() if other == source) <= supply[source]
+        for sink in demand:
+            assert sum(amount for (_, other), amount in flows.items() if other == sink) <= demand[sink]
+        assert all(pair in costs for pair in flows)
+        sent = sum(flows.values())
+        cost = sum(amount*costs[pair] for pair, amount in flows.items())
+        assert (sent, cost) == brute_force_transport(supply, demand, costs), (supply, demand, costs)
+
+
+def test_battle_odds_known_values():
+    odds = my_submission.BattleOdds(20, 20)
+    assert math.isclose(odds.win_probability(1, 1), 15/36)
+    # Two dice against one win a roll 125 times in 216, and after losing one it is one against one
+    assert math.isclose(odds.win_probability(2, 1), 125/216 + 91/216*15/36)
+    assert odds.win_probability(5, 0) == 1
+    assert odds.win_probability(0, 5) == 0
+    three_against_two = {(attackers_lost, defenders_lost): p for attackers_lost, defenders_lost, p in my_submission.ROLL_OUTCOMES[(3, 2)]}
+    assert math.isclose(three_against_two[(0, 2)], 2890/7776)
+    assert math.isclose(three_against_two[(1, 1)], 2611/7776)
+    assert math.isclose(three_against_two[(2, 0)], 2275/7776)
+    for attackers, defenders in [(1, 1), (3, 2), (10, 7), (20, 20)]:
+        distribution = odds.survivor_distribution(attackers, defenders)
+        assert distribution is not None
+        assert math.isclose(sum(distribution), odds.win_probability(attackers, defenders))
+        assert math.isclose(sum(k*p for k, p in enumerate(distribution))/sum(distribution), odds.expected_survivors(attackers, defenders))
+
+
+# Keys that all land on the same pair of entries
+def test_transposition_cache_keeps_the_newest_two():
+    cache = my_submission.TranspositionCache(bits=4)
+    first, second, third = (1 << 20) | 2, (2 << 20) | 2, (3 << 20) | 2
+    cache.generation = 1
+    cache.put(first, 1.0)
+    cache.generation = 2
+    cache.put(second, 2.0)
+    assert (cache.get(first), cache.get(second)) == (1.0, 2.0)
+    cache.generation = 3
+    cache.put(third, 3.0)
+    assert (cache.get(first), cache.get(second), cache.get(third)) == (None, 2.0, 3.0)
+    cache.put(second, 4.0)
+    assert (cache.get(second), cache.get(third)) == (4.0, 3.0)
+    assert cache.get((4 << 20) | 2) is None
+
+
+class WatchedBot(simulator.SubmissionBot):
+    """Notes what every query it is asked looked like, to check the replay against."""
+
+    def __init__(self, recorder: my_submission.ReplayRecorder, seen: list[tuple]):
+        bot_state = my_submission.BotState()
+        bot_state.search_budget = 0
+        super().__init__(bot_state, recorder)
+        self.seen = seen
+
+    def __call__(self, game: simulator.SimGame, query):
+        territories = [[game.state.territories[territory].occupier, game.state.territories[territory].troops] for territory in sorted(game.state.territories)]
+        self.seen.append((type(query).__name__, len(game.state.recording), territories))
+        return super().__call__(game, query)
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_replays_read_back_as_played(tmp_path, compress):
+    path = str(tmp_path/"game.replay")
+    seen: list[tuple] = []
+    watched = WatchedBot(my_submission.ReplayRecorder(path, compress, block_entries=16), seen)
+    others = []
+    for _ in range(2):
+        bot_state = my_submission.BotState()
+        bot_state.search_budget = 0
+        others.append(simulator.SubmissionBot(bot_state))
+    match = simulator.Match([watched, *others], seed=3, max_turns=15)
+    match.play()
+    watched.recorder.close()
+
+    replay = Replay(path)
+    assert len(replay) == len(seen)
+    assert len(replay.blocks) > 1
+    for entry, (query, recording_length, territories) in zip(replay, seen):
+        assert (entry.query, entry.recording_length, entry.territories) == (query, recording_length, territories)
+
+    # Reading entries out of order gives the same answers as reading them in order
+    for number in [len(seen) - 1, 0, len(seen)//2, 17]:
+        assert replay.entry(number).territories == seen[number][2]
+    assert len(replay.recording(len(seen) - 1)) == seen[-1][1]
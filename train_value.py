@@ -0,0 +1,186 @@
+"""Trains the value model my_submission.py scores searched positions with.
+
+Self-play games are played in the simulator, and at the start of each of its turns every seat
+notes the features of the position from its side. Once the game is over, each noted position is
+labelled with how it turned out for that seat: 1 for a win and 0 for a loss, or the share of the
+map held at the end when nobody won. A linear model and a network with one hidden layer are then
+fitted by minibatch Adam on the log loss, with a fifth of the games held out, and whichever does
+better on the held out games is written to --output.
+
+    python train_value.py --games 400 --workers 16
+    python train_value.py --hidden 0 --epochs 50
+
+The bot only uses a model when RISK_VALUE_MODEL names its file, and otherwise scores searched
+positions with evaluate_position as before:
+
+    RISK_VALUE_MODEL=value_model.json python simulator.py
+
+The model is only loaded when it was trained on the features my_submission.py computes now, so
+it needs training again after POSITION_FEATURES changes.
+"""
+from __future__ import annotations
+
+import argparse
+import math
+import os
+import random
+from multiprocessing import Pool
+
+import my_submission
+import simulator
+from my_submission import CompactState, ValueModel, position_features
+
+
+class SamplingBot(simulator.SubmissionBot):
+    """Answers like the submission, noting the features of the position at the start of each turn."""
+
+    def __init__(self, bot_state: my_submission.BotState, samples: list[tuple[int, list[float]]]):
+        super().__init__(bot_state)
+        self.samples = samples
+
+    def __call__(self, game: simulator.SimGame, query):
+        if isinstance(query, simulator.QueryDistributeTroops) and query.cause == "turn_started":
+            tracker = my_submission.get_tracker(game, self.bot_state)
+            state = CompactState.from_game(game, tracker)  # type: ignore[arg-type]
+            self.samples.append((game._player_id, position_features(state, tracker.index)))
+        return super().__call__(game, query)
+
+
+def play_game(seed: int, players: int, max_turns: int, search_budget: float) -> list[tuple[list[float], float]]:
+    samples: list[tuple[int, list[float]]] = []
+    bots = []
+    for player in range(players):
+        bot_state = my_submission.BotState()
+        bot_state.search_budget = search_budget
+        bot_state.value_model = None
+        bot_state.rng.seed(seed*players + player)
+        bots.append(SamplingBot(bot_state, samples))
+    result = simulator.Match(bots, seed=seed, max_turns=max_turns).play()
+
+    territories = max(1, sum(result.territories.values()))
+    outcomes = {player: (1.0 if result.winner == player else 0.0) if result.winner is not None else result.territories.get(player, 0)/territories for player in range(players)}
+    return [(features, outcomes[player]) for player, features in samples]
+
+
+class Trainer():
+    """Fits the weights of a ValueModel by minibatch Adam on the log loss, one example at a time
+    within each batch."""
+
+    def __init__(self, features: int, hidden: int, rng: random.Random, rate: float):
+        self.hidden = [[rng.gauss(0, 1/math.sqrt(features)) for _ in range(features)] for _ in range(hidden)]
+        self.hidden_bias = [0.0]*hidden
+        self.output = [rng.gauss(0, 1/math.sqrt(max(1, hidden))) for _ in range(hidden if hidden else features)]
+        self.output_bias = 0.0
+        self.rate = rate
+        self.steps = 0
+        sizes = [len(row) for row in self.hidden] + [len(self.hidden_bias), len(self.output), 1]
+        self.first_moment = [[0.0]*size for size in sizes]
+        self.second_moment = [[0.0]*size for size in sizes]
+
+    def forward(self, x: list[float]) -> tuple[list[float], float]:
+        if not self.hidden:
+            return x, sum(w*v for w, v in zip(self.output, x)) + self.output_bias
+        activations = [math.tanh(sum(w*v for w, v in zip(weights, x)) + bias) for weights, bias in zip(self.hidden, self.hidden_bias)]
+        return activations, sum(w*v for w, v in zip(self.output, activations)) + self.output_bias
+
+    def step(self, batch: list[tuple[list[float], float]]):
+        gradients = [[0.0]*len(row) for row in self.hidden] + [[0.0]*len(self.hidden_bias), [0.0]*len(self.output), [0.0]]
+        for x, label in batch:
+            activations, logit = self.forward(x)
+            error = (0.5 + 0.5*math.tanh(0.5*logit) - label)/len(batch)
+            for i, value in enumerate(activations):
+                gradients[-2][i] += error*value
+            gradients[-1][0] += error
+            for j, weights in enumerate(self.hidden):
+                delta = error*self.output[j]*(1 - activations[j]*activations[j])
+                row = gradients[j]
+                for i, value in enumerate(x):
+                    row[i] += delta*value
+                gradients[-3][j] += delta
+
+        self.steps += 1
+        parameters = self.hidden + [self.hidden_bias, self.output]
+        for k, gradient in enumerate(gradients):
+            first = self.first_moment[k]
+            second = self.second_moment[k]
+            for i, g in enumerate(gradient):
+                first[i] = 0.9*first[i] + 0.1*g
+                second[i] = 0.999*second[i] + 0.001*g*g
+                update = self.rate*(first[i]/(1 - 0.9**self.steps))/(math.sqrt(second[i]/(1 - 0.999**self.steps)) + 1e-8)
+                if k < len(parameters):
+                    parameters[k][i] -= update
+                else:
+                    self.output_bias -= update
+
+    def model(self, mean: list[float], scale: list[float]) -> ValueModel:
+        return ValueModel({"mean": mean, "scale": scale, "hidden": self.hidden, "hidden_bias": self.hidden_bias, "output": self.output, "output_bias": self.output_bias})
+
+
+def log_loss(model: ValueModel, examples: list[tuple[list[float], float]]) -> float:
+    predictions = model.predict([features for features, _ in examples])
+    return -sum(label*math.log(max(p, 1e-9)) + (1 - label)*math.log(max(1 - p, 1e-9)) for p, (_, label) in zip(predictions, examples))/len(examples)
+
+
+def train(examples: list[tuple[list[float], float]], held_out: list[tuple[list[float], float]], hidden: int, args: argparse.Namespace) -> tuple[ValueModel, float]:
+    # Features are standardised on the training games, and the trainer works on standardised values
+    columns = list(zip(*(features for features, _ in examples)))
+    mean = [sum(column)/len(column) for column in columns]
+    scale = [max(1e-6, math.sqrt(sum((value - m)**2 for value in column)/len(column))) for column, m in zip(columns, mean)]
+    standardised = [([(value - m)/s for value, m, s in zip(features, mean, scale)], label) for features, label in examples]
+
+    rng = random.Random(args.seed)
+    trainer = Trainer(len(mean), hidden, rng, args.rate)
+    for epoch in range(args.epochs):
+        rng.shuffle(standardised)
+        for start in range(0, len(standardised), args.batch):
+            trainer.step(standardised[start:start + args.batch])
+        if (epoch + 1) % 10 == 0 or epoch + 1 == args.epochs:
+            model = trainer.model(mean, scale)
+            print(f"  {hidden} hidden, epoch {epoch + 1}: training loss {log_loss(model, examples):.4f}, held out loss {log_loss(model, held_out):.4f}", flush=True)
+    model = trainer.model(mean, scale)
+    return model, log_loss(model, held_out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=100, help="games for each number of players")
+    parser.add_argument("--players", type=int, nargs="+", default=[2, 3, 4, 5, 6])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-turns", type=int, default=400)
+    parser.add_argument("--search-budget", type=float, default=0.0, help="seconds of search per query while playing the games")
+    parser.add_argument("--hidden", type=int, default=16, help="hidden units in the network (0 to only fit the linear model)")
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--rate", type=float, default=0.003)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default="value_model.json")
+    args = parser.parse_args()
+    if args.games*len(args.players) < 2:
+        parser.error("at least two games are needed, so one can be held out")
+
+    tasks = [(args.seed + game, players, args.max_turns, args.search_budget) for players in args.players for game in range(args.games)]
+    if args.workers > 1:
+        with Pool(args.workers) as pool:
+            games = pool.starmap(play_game, tasks)
+    else:
+        games = [play_game(*task) for task in tasks]
+
+    # Positions from the same game are alike, so whole games are held out, at least one of them
+    held_out_games = set(random.Random(args.seed).sample(range(len(games)), max(1, len(games)//5)))
+    examples = [example for i, game in enumerate(games) if i not in held_out_games for example in game]
+    held_out = [example for i, game in enumerate(games) if i in held_out_games for example in game]
+    print(f"{len(examples)} training positions, {len(held_out)} held out from {len(games)} games")
+    if not examples or not held_out:
+        raise SystemExit("no positions to train on or hold out, play more or longer games")
+    # Kept off 0 and 1, where every game went the same way, so the baseline's logit is finite
+    average = min(max(sum(label for _, label in examples)/len(examples), 1e-9), 1 - 1e-9)
+    print(f"  predicting the average outcome: held out loss {log_loss(ValueModel({'mean': [0.0], 'scale': [1.0], 'hidden': [], 'hidden_bias': [], 'output': [0.0], 'output_bias': math.log(average/(1 - average))}), [([0.0], label) for _, label in held_out]):.4f}")
+
+    candidates = [train(examples, held_out, hidden, args) for hidden in sorted({0, args.hidden})]
+    model, loss = min(candidates, key=lambda candidate: candidate[1])
+    model.save(args.output)
+    print(f"wrote {args.output} ({len(model.hidden)} hidden units, held out loss {loss:.4f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Tunes the coefficients in my_submission.DEFAULT_PARAMETERS by self-play in the simulator.
+
+Each generation samples a population of parameter vectors around the current mean with a
+separable CMA-ES (a diagonal covariance), and scores each one by playing it in one seat against
+the starting parameters in the others. Every candidate in a generation plays the same seeds and
+seats, so they are compared on the same dice. The games are spread over a process pool, and the
+search state is written to a checkpoint after each generation so a run can be picked up again.
+
+    python tune.py --generations 50 --games 40 --workers 16
+    python tune.py --resume --generations 100
+
+The mean of the search is written to --output, which can be copied to parameters.json.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import random
+from multiprocessing import Pool
+from typing import Optional
+
+import my_submission
+from simulator import play_match
+
+
+def score_game(seed: int, players: int, seat: int, parameters: dict, opponents: dict, max_turns: int, search_budget: float) -> float:
+    """A win is worth 1, with a little credit for the share of the map held at the end."""
+    seats = {player: opponents for player in range(players)}
+    seats[seat] = parameters
+    result = play_match(seed, players, max_turns, search_budget, seats)
+    share = result.territories.get(seat, 0)/max(1, sum(result.territories.values()))
+    return (1.0 if result.winner == seat else 0.0) + 0.25*share
+
+
+def score_task(task: tuple) -> tuple[int, float]:
+    candidate, *arguments = task
+    return candidate, score_game(*arguments)
+
+
+class SeparableCMA():
+    """CMA-ES with a diagonal covariance, working in coordinates where each parameter is scaled
+    by the size of its starting value."""
+
+    def __init__(self, start: list[float], sigma: float, population: Optional[int] = None):
+        n = len(start)
+        self.start = list(start)
+        self.scale = [max(abs(value), 0.1) for value in start]
+        self.population = population if population is not None else 4 + int(3*math.log(n))
+        self.parents = self.population//2
+        weights = [math.log(self.parents + 0.5) - math.log(i + 1) for i in range(self.parents)]
+        self.weights = [weight/sum(weights) for weight in weights]
+        self.mueff = 1/sum(weight*weight for weight in self.weights)
+        self.cs = (self.mueff + 2)/(n + self.mueff + 5)
+        self.ds = 1 + 2*max(0.0, math.sqrt((self.mueff - 1)/(n + 1)) - 1) + self.cs
+        self.cmu = min(1.0, (n + 2)/3*2*(self.mueff - 2 + 1/self.mueff)/((n + 2)**2 + self.mueff))
+        self.chi = math.sqrt(n)*(1 - 1/(4*n) + 1/(21*n*n))
+
+        self.mean = [0.0]*n
+        self.sigma = sigma
+        self.variance = [1.0]*n
+        self.path = [0.0]*n
+        self.generation = 0
+
+    def to_parameters(self, point: list[float]) -> list[float]:
+        return [start + scale*value for start, scale, value in zip(self.start, self.scale, point)]
+
+    def ask(self, rng: random.Random) -> list[list[float]]:
+        """Steps (before sigma and the mean are applied) for each member of the next population."""
+        return [[math.sqrt(variance)*rng.gauss(0, 1) for variance in self.variance] for _ in range(self.population)]
+
+    def point(self, step: list[float]) -> list[float]:
+        return [mean + self.sigma*value for mean, value in zip(self.mean, step)]
+
+    def tell(self, steps: list[list[float]], fitnesses: list[float]):
+        ranked = sorted(range(len(steps)), key=lambda i: fitnesses[i], reverse=True)[:self.parents]
+        weighted = [sum(weight*steps[i][d] for weight, i in zip(self.weights, ranked)) for d in range(len(self.mean))]
+
+        self.mean = [mean + self.sigma*value for mean, value in zip(self.mean, weighted)]
+        factor = math.sqrt(self.cs*(2 - self.cs)*self.mueff)
+        self.path = [(1 - self.cs)*path + factor*value/math.sqrt(variance) for path, value, variance in zip(self.path, weighted, self.variance)]
+        length = math.sqrt(sum(path*path for path in self.path))
+        self.sigma *= math.exp(self.cs/self.ds*(length/self.chi - 1))
+        self.variance = [(1 - self.cmu)*self.variance[d] + self.cmu*sum(weight*steps[i][d]**2 for weight, i in zip(self.weights, ranked)) for d in range(len(self.mean))]
+        self.generation += 1
+
+    def to_json(self) -> dict:
+        return {"start": self.start, "population": self.population, "mean": self.mean, "sigma": self.sigma,
+                "variance": self.variance, "path": self.path, "generation": self.generation}
+
+    @staticmethod
+    def from_json(data: dict) -> 'SeparableCMA':
+        search = SeparableCMA(data["start"], data["sigma"], data["population"])
+        search.mean = data["mean"]
+        search.variance = data["variance"]
+        search.path = data["path"]
+        search.generation = data["generation"]
+        return search
+
+
+def save_checkpoint(path: str, search: SeparableCMA, history: list[dict]):
+    temporary = path + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump({"search": search.to_json(), "history": history}, file)
+    os.replace(temporary, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--generations", type=int, default=20)
+    parser.add_argument("--games", type=int, default=20, help="games per candidate per generation")
+    parser.add_argument("--population", type=int, default=None)
+    parser.add_argument("--sigma", type=float, default=0.3, help="starting step size, relative to each parameter")
+    parser.add_argument("--players", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-turns", type=int, default=400)
+    parser.add_argument("--search-budget", type=float, default=0.0, help="seconds of search per query while tuning")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--checkpoint", default="tune_checkpoint.json")
+    parser.add_argument("--resume", action="store_true", help="carry on from the checkpoint")
+    parser.add_argument("--output", default="tuned_parameters.json")
+    args = parser.parse_args()
+
+    opponents = my_submission.load_parameters()
+    history: list[dict] = []
+    if args.resume and os.path.exists(args.checkpoint):
+        with open(args.checkpoint) as file:
+            checkpoint = json.load(file)
+        search = SeparableCMA.from_json(checkpoint["search"])
+        history = checkpoint["history"]
+    else:
+        search = SeparableCMA(my_submission.parameter_vector(opponents), args.sigma, args.population)
+
+    with Pool(args.workers) as pool:
+        while search.generation < args.generations:
+            generation = search.generation
+            rng = random.Random(args.seed*1000003 + generation)
+            steps = search.ask(rng)
+            candidates = [my_submission.parameters_from_vector(search.to_parameters(search.point(step))) for step in steps]
+
+            # Every candidate plays the same seeds from the same seats
+            seeds = [args.seed + generation*args.games + game for game in range(args.games)]
+            tasks = [(candidate, seed, args.players, seed % args.players, candidates[candidate], opponents, args.max_turns, args.search_budget)
+                     for candidate in range(len(candidates)) for seed in seeds]
+            fitnesses = [0.0]*len(candidates)
+            for candidate, score in pool.imap_unordered(score_task, tasks):
+                fitnesses[candidate] += score/len(seeds)
+
+            search.tell(steps, fitnesses)
+            history.append({"generation": generation, "best": max(fitnesses), "mean": sum(fitnesses)/len(fitnesses), "sigma": search.sigma})
+            save_checkpoint(args.checkpoint, search, history)
+            print(f"generation {generation}: best {max(fitnesses):.3f}, mean {sum(fitnesses)/len(fitnesses):.3f}, sigma {search.sigma:.3f}", flush=True)
+
+    with open(args.output, "w") as file:
+        json.dump(my_submission.parameters_from_vector(search.to_parameters(search.mean)), file, indent=4)
+
+
+if __name__ == "__main__":
+    main()